@@ -0,0 +1,129 @@
+"""Compare alertStream reading: legacy line loop vs MultipartParser.
+
+Usage: python benchmarks/bench_alert_stream.py [capture ...]
+
+Captures are raw alertStream bodies (for example saved with
+``curl --digest -u user:pass http://cam/ISAPI/Event/notification/alertStream``),
+without arguments a synthetic capture with JPEG parts is used.
+"""
+import io
+import sys
+import xml.etree.ElementTree as ET
+
+import requests
+
+from common import Timer, jpeg_bytes, load, load_captures, report, synthetic_capture
+
+stream = load('stream')
+
+
+def legacy_loop(capture):
+    """The pre-parser loop: one read per byte, events found by str.find."""
+    response = requests.models.Response()
+    response.raw = io.BytesIO(capture)
+    events = 0
+    next_content = False
+    start_event = False
+    parse_string = ''
+    for line in response.iter_lines(chunk_size=1):
+        if line:
+            str_line = line.decode('utf-8', 'ignore')
+            if 'image/jpeg' in str_line:
+                next_content = True
+                continue
+            if next_content:
+                content_length = int(line.decode().split(' ')[1])
+                next_content = False
+                response.raw.read(content_length + 3)
+                continue
+            if str_line.find('<EventNotificationAlert') != -1:
+                start_event = True
+                parse_string = str_line
+            elif str_line.find('</EventNotificationAlert>') != -1:
+                parse_string += str_line
+                start_event = False
+                ET.fromstring(parse_string)
+                events += 1
+                parse_string = ''
+            elif start_event:
+                parse_string += str_line
+    return events
+
+
+def parser_loop(capture):
+    """Feed the capture in read-sized chunks through MultipartParser."""
+    events = 0
+
+    def on_part(content_type, body):
+        nonlocal events
+        if 'xml' in content_type:
+            ET.fromstring(body)
+            events += 1
+
+    parser = stream.MultipartParser(on_part)
+    raw = io.BytesIO(capture)
+    while chunk := raw.read(stream.READ_CHUNK_SIZE):
+        parser.feed(chunk)
+    return events
+
+
+def streaming_loop(capture):
+    """MultipartParser streaming XML parts straight into AlertParser.
+
+    This is the path large alerts and alerts without Content-Length take.
+    """
+    events = 0
+
+    def on_event(event):
+        nonlocal events
+        events += 1
+
+    alerts = stream.AlertParser(on_event)
+    parser = stream.MultipartParser(
+        lambda content_type, body: None,
+        open_part=lambda content_type, length: alerts.open() if 'xml' in content_type else None)
+    raw = io.BytesIO(capture)
+    while chunk := raw.read(stream.READ_CHUNK_SIZE):
+        parser.feed(chunk)
+    return events
+
+
+def check_decoding(capture):
+    """Assert streamed and buffered XML parts decode to the same events."""
+    buffered = []
+    streamed = []
+    decoder = stream.AlertDecoder()
+
+    def on_part(content_type, body):
+        if 'xml' in content_type:
+            buffered.append(decoder.decode(ET.fromstring(body)))
+
+    alerts = stream.AlertParser(streamed.append)
+    for parser in (stream.MultipartParser(on_part),
+                   stream.MultipartParser(
+                       lambda content_type, body: None,
+                       open_part=lambda content_type, length:
+                       alerts.open() if 'xml' in content_type else None)):
+        raw = io.BytesIO(capture)
+        while chunk := raw.read(stream.READ_CHUNK_SIZE):
+            parser.feed(chunk)
+    assert len(streamed) == len(buffered), (len(streamed), len(buffered))
+    for event, expected in zip(streamed, buffered):
+        assert event == expected, (event, expected)
+
+
+def main(paths):
+    captures = load_captures(paths) or [synthetic_capture(2000, jpeg_bytes())]
+    for i, capture in enumerate(captures):
+        print(f'capture {i}: {len(capture)} bytes')
+        check_decoding(capture)
+        for name, func in (('legacy iter_lines(chunk_size=1)', legacy_loop),
+                           ('MultipartParser + fromstring', parser_loop),
+                           ('MultipartParser + AlertParser', streaming_loop)):
+            with Timer() as t:
+                count = func(capture)
+            report(name, count, t.elapsed)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,191 @@
+"""Clip search, download and snapshot endpoints against a fake device.
+
+Usage: python benchmarks/bench_api.py [--events N] [--clients N] [--search-delay S]
+
+Needs Home Assistant, the views of api.py are mounted on a bare aiohttp
+application with a stand-in for hass and a camera of fake_isapi.py
+behind it. Measured:
+
+- POST /api/hikvisioncam: the first request of an event (search and
+  download through the clip cache), ``clients`` concurrent requests of one
+  new event, and the same event again from the cache
+- POST /api/hikvisioncam/search with ``events`` events, cold and warm
+- GET /api/hikvisioncam/clips/<id> Range requests of a cached clip
+- GET /api/hikvisioncam/snapshot/<camera>: ``clients`` concurrent
+  requests, polling through the frame cache and cropped snapshots
+"""
+import argparse
+import asyncio
+import datetime
+import tempfile
+import types
+
+import homeassistant.bootstrap  # noqa: F401 breaks the import cycle of the http component
+import httpx
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from common import Timer, load, percentile, report
+from fake_isapi import DEFAULT_PORT, spawn
+
+api = load('api')
+clips = load('clips')
+const = load('const')
+proxy = load('proxy')
+snapshots = load('snapshots')
+
+TRIP_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+EVENT_SPACING = 20
+RANGE_REQUESTS = 200
+SNAPSHOT_REQUESTS = 200
+
+
+def make_hass(port, cache_dir):
+    """Return the parts of hass the views use."""
+    camera = types.SimpleNamespace(
+        name='fake0',
+        snapshot_channel=1,
+        snapshot_stream=snapshots.STREAM_MAIN,
+        client=httpx.AsyncClient(),
+        camdata=types.SimpleNamespace(
+            root_url=f'http://127.0.0.1:{port}', httpx_auth=httpx.BasicAuth('user', 'pass')))
+    clip_cache = clips.ClipDiskCache(cache_dir, 1024 * 1024 * 1024)
+    clip_cache.load()
+    return types.SimpleNamespace(
+        config=types.SimpleNamespace(time_zone='UTC'),
+        async_add_executor_job=lambda func, *args: asyncio.get_running_loop().run_in_executor(
+            None, func, *args),
+        data={const.DOMAIN: {
+            const.DATA_CAMERAS: {camera.name: camera},
+            const.DATA_CLIP_LOOKUP: clips.ClipLookupCache(),
+            const.DATA_CLIP_CACHE: clip_cache,
+            const.DATA_CLIP_TRIM: False,
+            const.DATA_CLIP_POST_ROLL: 10,
+            const.DATA_FRAMES: snapshots.FrameCache(),
+            const.DATA_TRANSFERS: proxy.ClipTransfers(),
+        }})
+
+
+def mount(hass):
+    app = web.Application()
+    app['hass'] = hass
+    for view_class in (api.APIHikvisionCamView, api.APIHikvisionCamSearchView,
+                       api.APIHikvisionCamClipView, api.APIHikvisionCamSnapshotView):
+        view = view_class()
+        for method in ('get', 'post'):
+            handler = getattr(view, method, None)
+            if handler is not None:
+                app.router.add_route(
+                    method.upper(), view.url,
+                    lambda request, handler=handler: handler(request, **request.match_info))
+    return app
+
+
+def trip_times(count, start):
+    return [(start + datetime.timedelta(seconds=i * EVENT_SPACING)).strftime(TRIP_TIME_FORMAT)
+            for i in range(count)]
+
+
+async def timed(request):
+    with Timer() as t:
+        async with request as resp:
+            await resp.read()
+    return resp, t.elapsed
+
+
+async def clip_request(client, trip_time):
+    return await timed(client.post('/api/hikvisioncam', json={
+        'friendly_name': 'fake0 Motion', 'last_tripped_time': trip_time}))
+
+
+async def bench(client, fake, args):
+    times = trip_times(args.events + 2, datetime.datetime.utcnow() - datetime.timedelta(hours=2))
+
+    resp, elapsed = await clip_request(client, times[0])
+    print(f'{"clip, first request":<32} {elapsed * 1000:>10.1f} ms  status {resp.status}')
+    resp, elapsed = await clip_request(client, times[0])
+    print(f'{"clip, cached":<32} {elapsed * 1000:>10.1f} ms  status {resp.status}')
+    location = resp.headers['Content-Location']
+
+    before = (await fake.get('/replay/stats')).json()
+    with Timer() as t:
+        results = await asyncio.gather(*(clip_request(client, times[1])
+                                         for _ in range(args.clients)))
+    after = (await fake.get('/replay/stats')).json()
+    latencies = [elapsed for _, elapsed in results]
+    print(f'{f"clip, {args.clients} concurrent":<32} {t.elapsed * 1000:>10.1f} ms  '
+          f'p50 {percentile(latencies, 50) * 1000:.1f} ms, '
+          f'{after["searches"] - before["searches"]} searches, '
+          f'{after["downloads"] - before["downloads"]} downloads')
+
+    events = [{'friendly_name': 'fake0', 'last_tripped_time': trip_time}
+              for trip_time in times[2:]]
+    for name in ('cold', 'warm'):
+        before = (await fake.get('/replay/stats')).json()
+        resp, elapsed = await timed(client.post('/api/hikvisioncam/search', json={'events': events}))
+        after = (await fake.get('/replay/stats')).json()
+        found = sum(1 for result in await resp.json() if result['playback_uri'])
+        print(f'{f"search {len(events)} events, {name}":<32} {elapsed * 1000:>10.1f} ms  '
+              f'{found} found, {after["searches"] - before["searches"]} searches')
+
+    with Timer() as t:
+        for i in range(RANGE_REQUESTS):
+            # The fake clips are 4 MiB
+            start = i % 64 * 65536
+            resp, _ = await timed(client.get(location, headers={
+                'Range': f'bytes={start}-{start + 65535}'}))
+            assert resp.status == 206, resp.status
+    report('clip range requests', RANGE_REQUESTS, t.elapsed, unit='requests')
+
+    snapshot = '/api/hikvisioncam/snapshot/fake0'
+    before = (await fake.get('/replay/stats')).json()
+    with Timer() as t:
+        results = await asyncio.gather(*(timed(client.get(snapshot)) for _ in range(args.clients)))
+    after = (await fake.get('/replay/stats')).json()
+    latencies = [elapsed for _, elapsed in results]
+    print(f'{f"snapshot, {args.clients} concurrent":<32} {t.elapsed * 1000:>10.1f} ms  '
+          f'p50 {percentile(latencies, 50) * 1000:.1f} ms, '
+          f'{after["pictures"] - before["pictures"]} pictures')
+
+    for name, query in (('snapshot polls', ''), ('snapshot polls, crop', '?crop=0.4,0.2,0.2,0.4'),
+                        ('snapshot polls, size 320', '?size=320')):
+        before = (await fake.get('/replay/stats')).json()
+        with Timer() as t:
+            for _ in range(SNAPSHOT_REQUESTS):
+                resp, _ = await timed(client.get(snapshot + query))
+                assert resp.status == 200, resp.status
+        after = (await fake.get('/replay/stats')).json()
+        report(name, SNAPSHOT_REQUESTS, t.elapsed, unit='requests')
+        print(f'{"":<32} {after["pictures"] - before["pictures"]} pictures')
+
+
+async def run(args, port):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        hass = make_hass(port, cache_dir)
+        client = TestClient(TestServer(mount(hass)))
+        await client.start_server()
+        try:
+            async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}') as fake:
+                await bench(client, fake, args)
+        finally:
+            await client.close()
+            await hass.data[const.DOMAIN][const.DATA_CAMERAS]['fake0'].client.aclose()
+        print(f'clip cache {hass.data[const.DOMAIN][const.DATA_CLIP_CACHE].stats}')
+        print(f'clip lookup {hass.data[const.DOMAIN][const.DATA_CLIP_LOOKUP].stats}')
+        print(f'frames {hass.data[const.DOMAIN][const.DATA_FRAMES].stats}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=100)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--search-delay', type=float, default=0.05)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    with spawn(1, args.port, search_delay=args.search_delay, jpeg=False) as ports:
+        asyncio.run(run(args, ports[0]))
+
+
+if __name__ == '__main__':
+    main()
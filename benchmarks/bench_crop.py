@@ -0,0 +1,89 @@
+"""Crop time and peak memory per event: legacy crop vs crop_image.
+
+Usage: python benchmarks/bench_crop.py [snapshot.jpg] [--max-size N]
+
+Each method runs in its own interpreter and peak memory is read from
+VmHWM, so it reflects only that method (Linux only). Without a snapshot a noisy 4K frame is generated.
+"""
+import argparse
+import io
+import subprocess
+import sys
+import tempfile
+
+from common import Timer, load
+
+BOX = [0.412, 0.223, 0.061, 0.214]
+ROUNDS = 20
+
+
+def make_snapshot(path):
+    from PIL import Image
+
+    # A gradient with mild noise compresses about like a camera frame.
+    size = (3840, 2160)
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 24)
+    img = Image.merge('RGB', (gradient, Image.blend(gradient, noise, 0.3), noise))
+    img.save(path, 'JPEG', quality=85)
+
+
+def legacy(data, max_size):
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        width, height = img.size
+        crop = img.crop((width * BOX[0], height * BOX[1],
+                         width * (BOX[0] + BOX[2]), height * (BOX[1] + BOX[3])))
+        crop.save(io.BytesIO(), 'JPEG')
+
+
+def fast(data, max_size):
+    load('images').crop_image(data, BOX, max_size)
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in KiB."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return 0
+
+
+def run_one(method, path, max_size):
+    with open(path, 'rb') as f:
+        data = f.read()
+    func = {'legacy': legacy, 'crop_image': fast}[method]
+    load('images')
+    baseline = peak_rss()
+    with Timer() as t:
+        for _ in range(ROUNDS):
+            func(data, max_size)
+    peak = peak_rss()
+    print(f'{method:<12} max_size={max_size!s:<6} {t.elapsed / ROUNDS * 1000:8.2f} ms/event '
+          f'peak rss {peak / 1024:8.1f} MiB (+{(peak - baseline) / 1024:.1f})')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('snapshot', nargs='?')
+    parser.add_argument('--max-size', type=int, default=160)
+    parser.add_argument('--method')
+    args = parser.parse_args()
+
+    if args.method:
+        run_one(args.method, args.snapshot, args.max_size or None)
+        return
+
+    snapshot = args.snapshot
+    if snapshot is None:
+        snapshot = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False).name
+        make_snapshot(snapshot)
+    for method, max_size in (('legacy', 0), ('crop_image', 0), ('crop_image', args.max_size)):
+        subprocess.run([sys.executable, __file__, snapshot, '--method', method,
+                        '--max-size', str(max_size)], check=True)
+
+
+if __name__ == '__main__':
+    main()
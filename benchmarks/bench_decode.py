@@ -0,0 +1,85 @@
+"""Events/sec of EventNotificationAlert field extraction.
+
+Usage: python benchmarks/bench_decode.py [payload.xml ...]
+
+Payloads are single EventNotificationAlert documents, without arguments a
+corpus of synthetic line crossing, motion and video loss alerts is used.
+Both variants start from the parsed tree, so only the extraction differs.
+"""
+import sys
+import xml.etree.ElementTree as ET
+
+from pyhik.constants import ID_TYPES
+
+from common import Timer, load, report, xml_event
+
+stream = load('stream')
+
+ROUNDS = 20000
+NAMESPACE = 'http://www.hikvision.com/ver20/XMLSchema'
+
+
+def element_query(element):
+    return '{%s}%s' % (NAMESPACE, element)
+
+
+def legacy_extract(tree):
+    """The tree.find sequence process_stream used before AlertDecoder."""
+    etype = tree.find(element_query('eventType')).text.lower()
+    estate = tree.find(element_query('eventState')).text
+    for idtype in ID_TYPES:
+        echid = tree.find(element_query(idtype))
+        if echid is not None:
+            try:
+                echid = int(echid.text)
+                break
+            except (ValueError, TypeError):
+                pass
+    ecount = tree.find(element_query('activePostCount')).text
+    try:
+        region_id = tree.find(f"{element_query('DetectionRegionList')}"
+                              f"/{element_query('DetectionRegionEntry')}"
+                              f"/{element_query('regionID')}").text
+        target = tree.find(f"{element_query('DetectionRegionList')}"
+                           f"/{element_query('DetectionRegionEntry')}"
+                           f"/{element_query('detectionTarget')}").text
+        box_tree = tree.find(f"{element_query('DetectionRegionList')}"
+                             f"/{element_query('DetectionRegionEntry')}"
+                             f"/{element_query('TargetRect')}")
+        box = [float(q.text) for q in box_tree.iter() if not len(q)]
+    except Exception:
+        region_id, box, target = '', [], 'others'
+    return etype, estate == 'active', echid, int(ecount), region_id, box, target
+
+
+def corpus(paths):
+    if paths:
+        return [ET.fromstring(open(p, 'rb').read()) for p in paths]
+    payloads = [xml_event(etype='linedetection'), xml_event(etype='VMD', state='inactive'),
+                xml_event(etype='videoloss', channel=3)]
+    # Video loss heartbeats carry no detection region.
+    payloads[2] = payloads[2].split(b'<DetectionRegionList>')[0] + b'</EventNotificationAlert>'
+    return [ET.fromstring(p) for p in payloads]
+
+
+def main(paths):
+    trees = corpus(paths)
+    decoder = stream.AlertDecoder()
+    for tree in trees:
+        event = decoder.decode(tree)
+        assert (*event[:5], list(event.box), event.target) == legacy_extract(tree)
+    events = ROUNDS * len(trees)
+    with Timer() as t:
+        for _ in range(ROUNDS):
+            for tree in trees:
+                legacy_extract(tree)
+    report('tree.find per field', events, t.elapsed)
+    with Timer() as t:
+        for _ in range(ROUNDS):
+            for tree in trees:
+                decoder.decode(tree)
+    report('AlertDecoder', events, t.elapsed)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
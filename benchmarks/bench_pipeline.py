@@ -0,0 +1,161 @@
+"""Event pipeline throughput against replayed alertStreams.
+
+Usage: python benchmarks/bench_pipeline.py [--cameras N] [--rate R] [--seconds S]
+                                           [--mode async|thread] [--no-jpeg] [--metrics]
+                                           [capture ...]
+
+Starts fake_isapi.py in a subprocess and runs the alert stream of one
+HikCamera per fake device for ``seconds``, with ``async_alert_stream`` on
+an event loop or ``alert_stream`` in its thread. Every alert goes through
+process_stream, snapshot saving in the image worker pool and the entity
+callbacks, publish coalescing is turned off so each one reaches them.
+
+Reported: alerts/s delivered to the callbacks, CPU time of this process
+per camera, p50/p99 latency from the fake writing an alert to its
+callback, and peak RSS. With ``--metrics`` the pipeline metrics are
+collected and their per stage p50/p99 printed as well.
+"""
+import argparse
+import asyncio
+import resource
+import tempfile
+import threading
+import time
+
+import httpx
+import requests
+
+from common import load, percentile
+from fake_isapi import DEFAULT_PORT, spawn
+
+images = load('images')
+metrics = load('metrics')
+storage = load('storage')
+utils = load('utils')
+
+
+class Probe:
+    """Entity callbacks recording when each alert arrived."""
+
+    def __init__(self):
+        self.arrived = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, cam):
+        for sensor, channels in cam.event_states.items():
+            regions = [''] + ([str(r) for r in utils.REGION_IDS]
+                              if sensor in utils.REGION_SENSORS else [])
+            for channel in channels:
+                for region in regions:
+                    cam.add_event_callback(self.callback(cam.name), sensor, channel[1], region)
+
+    def callback(self, name):
+        arrived = self.arrived.setdefault(name, {})
+
+        def on_event(msg, region, estate, attr):
+            # Inactive alerts of region sensors reach every region
+            if attr.count not in arrived:
+                with self._lock:
+                    arrived.setdefault(attr.count, time.time())
+        return on_event
+
+
+def connect(ports, pool, snapshots, registry):
+    cams = []
+    for port in ports:
+        cam = utils.HikCamera('http://127.0.0.1', port, 'user', 'pass')
+        cam.image_pool = pool
+        cam.storage = snapshots
+        if registry is not None:
+            cam.metrics = registry.camera(cam.name)
+        cam.coalescer.default_interval = 0
+        cams.append(cam)
+    return cams
+
+
+async def run_async(cams, seconds):
+    clients = [httpx.AsyncClient(timeout=httpx.Timeout(30)) for _ in cams]
+    tasks = [asyncio.create_task(cam.async_alert_stream(client))
+             for cam, client in zip(cams, clients)]
+    await asyncio.sleep(seconds)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for client in clients:
+        await client.aclose()
+
+
+def run_thread(cams, seconds):
+    for cam in cams:
+        cam.start_stream()
+    time.sleep(seconds)
+    for cam in cams:
+        cam.disconnect()
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cameras', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=100, help='alerts/s per camera, 0 unlimited')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--mode', choices=['async', 'thread'], default='async')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--no-jpeg', dest='jpeg', action='store_false')
+    parser.add_argument('--metrics', action='store_true')
+    parser.add_argument('captures', nargs='*')
+    args = parser.parse_args()
+
+    with spawn(args.cameras, args.port, args.rate, jpeg=args.jpeg,
+               captures=args.captures) as ports, \
+            tempfile.TemporaryDirectory() as root:
+        pool = images.ImageWorkerPool()
+        registry = metrics.PipelineMetrics() if args.metrics else None
+        cams = connect(ports, pool, storage.SnapshotStorage(root), registry)
+        probe = Probe()
+        for cam in cams:
+            probe.subscribe(cam)
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cpu_before = cpu_time()
+        if args.mode == 'async':
+            asyncio.run(run_async(cams, args.seconds))
+        else:
+            run_thread(cams, args.seconds)
+        cpu = cpu_time() - cpu_before
+        pool.stop()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        latencies = []
+        sent_total = 0
+        for cam, port in zip(cams, ports):
+            sent = requests.get(f'http://127.0.0.1:{port}/replay/sent', timeout=10).json()
+            sent_total += len(sent)
+            for count, arrived in probe.arrived.get(cam.name, {}).items():
+                if str(count) in sent:
+                    latencies.append(arrived - sent[str(count)])
+        delivered = sum(len(arrived) for arrived in probe.arrived.values())
+
+    print(f'{args.cameras} cameras, {args.mode}, {args.rate or "unlimited"} alerts/s per '
+          f'camera, {args.seconds:.0f}s, jpeg {"on" if args.jpeg else "off"}')
+    print(f'alerts sent {sent_total}, delivered {delivered}, '
+          f'{delivered / args.seconds:.0f} alerts/s')
+    print(f'cpu {cpu:.2f}s, {cpu / args.cameras / args.seconds * 100:.1f}% of a core per camera')
+    if latencies:
+        print(f'latency p50 {percentile(latencies, 50) * 1000:.2f} ms, '
+              f'p99 {percentile(latencies, 99) * 1000:.2f} ms')
+    print(f'peak rss {rss / 1024:.1f} MiB ({(rss - rss_before) / 1024:+.1f} MiB while streaming)')
+    print(f'image pool {pool.stats}')
+    if registry is not None:
+        for name, stats in registry.stats.items():
+            print(f'{name}: ' + ', '.join(
+                f'{stage} p50 {stage_stats["p50_ms"]:.3f} ms p99 {stage_stats["p99_ms"]:.3f} ms'
+                for stage, stage_stats in stats['stages'].items() if stage_stats['count']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""Trimming a recording to an event window: planning time and bytes saved.
+
+Usage: python benchmarks/bench_trim.py [recording.mp4 START END]
+
+Without a recording a 60 second MP4 (25 fps video with a keyframe every
+2 seconds plus audio, about 20 MB) and the same as a Hikvision program
+stream are generated and cut to seconds 20 to 35. The trimmed MP4 is
+parsed again and its samples compared to the source.
+"""
+import struct
+import sys
+import tempfile
+
+from common import Timer, load
+
+trim = load('trim')
+
+SECONDS = 60
+FPS = 25
+GOP = 50
+FRAME = 12000
+KEYFRAME = 60000
+AUDIO_RATE = 8000
+AUDIO_DELTA = 320
+ROUNDS = 20
+
+
+def box(kind, *payload):
+    body = b''.join(payload)
+    return struct.pack('>I4s', len(body) + 8, kind) + body
+
+
+def full_box(kind, version, *payload):
+    return box(kind, struct.pack('>B3x', version), *payload)
+
+
+def table(kind, fmt, entries):
+    return full_box(kind, 0, struct.pack('>I', len(entries)),
+                    *(struct.pack(fmt, *e) for e in entries))
+
+
+def sample(track, index, size):
+    """Sample payload identifying its track and index."""
+    return struct.pack('>BI', track, index).ljust(size, b'\x00')
+
+
+def trak(track_id, handler, timescale, delta, sizes, chunk_offsets, per_chunk, sync=None):
+    duration = delta * len(sizes)
+    stbl = [
+        full_box(b'stsd', 0, struct.pack('>I', 0)),
+        table(b'stts', '>II', [(len(sizes), delta)]),
+        table(b'stsc', '>III', [(1, per_chunk, 1)]),
+        full_box(b'stsz', 0, struct.pack('>II', 0, len(sizes)), struct.pack(f'>{len(sizes)}I', *sizes)),
+        table(b'stco', '>I', [(o,) for o in chunk_offsets]),
+    ]
+    if sync is not None:
+        stbl.insert(2, table(b'stss', '>I', [(n + 1,) for n in sync]))
+    return box(
+        b'trak',
+        full_box(b'tkhd', 0, struct.pack('>IIII', 0, 0, track_id, 0),
+                 struct.pack('>I', duration * 1000 // timescale), bytes(60)),
+        box(b'mdia',
+            full_box(b'mdhd', 0, struct.pack('>IIII', 0, 0, timescale, duration), bytes(4)),
+            full_box(b'hdlr', 0, bytes(4), handler, bytes(12), b'\x00'),
+            box(b'minf', box(b'stbl', *stbl))))
+
+
+def synthetic_mp4():
+    """Return an MP4 with moov at the end and interleaved chunks of a second."""
+    frames = SECONDS * FPS
+    video_sizes = [KEYFRAME if i % GOP == 0 else FRAME for i in range(frames)]
+    audio_per_second = AUDIO_RATE // AUDIO_DELTA
+    audio_sizes = [AUDIO_DELTA] * (SECONDS * audio_per_second)
+
+    ftyp = box(b'ftyp', b'isom', struct.pack('>I', 512), b'isomiso2mp41')
+    mdat = []
+    video_chunks, audio_chunks = [], []
+    position = len(ftyp) + 16
+    for second in range(SECONDS):
+        video_chunks.append(position)
+        for i in range(second * FPS, (second + 1) * FPS):
+            mdat.append(sample(1, i, video_sizes[i]))
+            position += video_sizes[i]
+        audio_chunks.append(position)
+        for i in range(second * audio_per_second, (second + 1) * audio_per_second):
+            mdat.append(sample(2, i, AUDIO_DELTA))
+            position += AUDIO_DELTA
+    body = b''.join(mdat)
+    mdat = struct.pack('>I4sQ', 1, b'mdat', len(body) + 16) + body
+    moov = box(
+        b'moov',
+        full_box(b'mvhd', 0, struct.pack('>IIII', 0, 0, 1000, SECONDS * 1000), bytes(80)),
+        trak(1, b'vide', 90000, 90000 // FPS, video_sizes, video_chunks, FPS,
+             sync=range(0, frames, GOP)),
+        trak(2, b'soun', AUDIO_RATE, AUDIO_DELTA, audio_sizes, audio_chunks, audio_per_second))
+    return ftyp + mdat + moov
+
+
+def pack_header(scr):
+    return (b'\x00\x00\x01\xba'
+            + bytes([0x44 | ((scr >> 27) & 0x38) | ((scr >> 28) & 0x03),
+                     (scr >> 20) & 0xff,
+                     ((scr >> 12) & 0xf8) | 0x04 | ((scr >> 13) & 0x03),
+                     (scr >> 5) & 0xff,
+                     ((scr << 3) & 0xf8) | 0x04,
+                     0x01, 0x01, 0x89, 0xc3, 0xf8]))
+
+
+def synthetic_ps():
+    """Return a program stream with a stream map in front of every keyframe."""
+    out = [b'IMKH'.ljust(40, b'\x00')]
+    for i in range(SECONDS * FPS):
+        out.append(pack_header(i * 90000 // FPS))
+        size = KEYFRAME if i % GOP == 0 else FRAME
+        if i % GOP == 0:
+            out.append(b'\x00\x00\x01\xbc\x00\x06' + bytes(6))
+        while size > 0:
+            length = min(size, 65000)
+            out.append(b'\x00\x00\x01\xe0' + struct.pack('>H', length) + bytes(length))
+            size -= length
+    return b''.join(out)
+
+
+def write(plan, src, dst):
+    with open(src, 'rb') as f, open(dst, 'wb') as out:
+        out.write(plan.header)
+        for offset, length in plan.ranges:
+            f.seek(offset)
+            out.write(f.read(length))
+
+
+def verify_mp4(path, start, end):
+    with open(path, 'rb') as f:
+        data = f.read()
+    moov = None
+    for kind, _, payload, box_end in trim._boxes(data, 0, len(data)):
+        if kind == b'moov':
+            moov = [kind, trim._parse_tree(data, payload, box_end)]
+    for trak_node in (c for c in moov[1] if c[0] == b'trak'):
+        track = trim._Track(trak_node)
+        for n, (offset, size) in enumerate(zip(track.offsets, track.sizes)):
+            track_no, index = struct.unpack_from('>BI', data, offset)
+            assert data[offset:offset + size] == sample(track_no, index, size), 'sample mismatch'
+            if n == 0 and track.handler == b'vide':
+                first = index
+        print(f'  track {track.handler.decode()}: {len(track.sizes)} samples, '
+              f'{track.times[-1] / track.timescale:.2f}s')
+    assert first % GOP == 0 and first / FPS <= start, 'does not start on a keyframe'
+
+
+def bench(name, path, start, end, verify=None):
+    size = len(open(path, 'rb').read())
+    with Timer() as t:
+        for _ in range(ROUNDS):
+            plan = trim.trim_plan(path, start, end)
+    if plan is None:
+        print(f'{name}: nothing to trim')
+        return
+    print(f'{name:<12} plan {t.elapsed / ROUNDS * 1000:7.1f} ms  '
+          f'{size / 1e6:6.1f} MB -> {plan.size / 1e6:5.1f} MB '
+          f'({len(plan.header)} header bytes, {len(plan.ranges)} ranges)')
+    if verify:
+        with tempfile.NamedTemporaryFile(suffix='.mp4') as out:
+            write(plan, path, out.name)
+            verify(out.name, start, end)
+
+
+def main():
+    if len(sys.argv) == 4:
+        bench('recording', sys.argv[1], float(sys.argv[2]), float(sys.argv[3]))
+        return
+    with tempfile.NamedTemporaryFile(suffix='.mp4') as mp4, \
+            tempfile.NamedTemporaryFile(suffix='.ps') as ps:
+        mp4.write(synthetic_mp4())
+        mp4.flush()
+        ps.write(synthetic_ps())
+        ps.flush()
+        bench('mp4', mp4.name, 20, 35, verify_mp4)
+        bench('ps', ps.name, 20, 35)
+
+
+if __name__ == '__main__':
+    main()
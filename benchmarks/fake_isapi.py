@@ -0,0 +1,246 @@
+"""Fake ISAPI devices replaying recorded alertStream sessions.
+
+Usage: python benchmarks/fake_isapi.py [--cameras N] [--port PORT] [--rate R]
+                                       [--search-delay S] [--no-jpeg] [capture ...]
+
+Camera ``n`` answers on ``PORT + n`` with its own deviceInfo, an event
+trigger list built from the alerts of the captures, an alertStream
+replaying the captures in a loop at ``rate`` alerts/s (0 sends as fast as
+the client reads) and a ContentMgmt search/download service with
+recordings in 4 second segments and a snapshot of every streaming channel.
+Without captures a synthetic session with JPEG parts is replayed.
+
+Replayed alerts get a running activePostCount, ``GET /replay/sent``
+returns the send time of every count so clients can measure latency and
+``GET /replay/stats`` counts the requests served.
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import re
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from aiohttp import web
+
+from common import ROOT, jpeg_bytes, load, load_captures, synthetic_capture
+
+stream = load('stream')
+
+NAMESPACE = 'http://www.hikvision.com/ver20/XMLSchema'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+BOUNDARY = b'boundary'
+SEGMENT = datetime.timedelta(seconds=4)
+DEFAULT_PORT = 18080
+DEFAULT_CLIP_SIZE = 4 * 1024 * 1024
+DOWNLOAD_CHUNK = 65536
+
+_COUNT = re.compile(rb'<activePostCount>\d+</activePostCount>')
+
+
+def split_capture(capture):
+    """Return the alerts of a capture as [(xml, [jpeg, ...])]."""
+    alerts = []
+
+    def on_part(content_type, body):
+        if 'xml' in content_type:
+            alerts.append((bytes(body), []))
+        elif content_type.startswith('image/') and alerts:
+            alerts[-1][1].append(bytes(body))
+
+    stream.MultipartParser(on_part).feed(capture)
+    return alerts
+
+
+def event_triggers(alerts):
+    """Return the EventTriggerList announcing the events of the alerts."""
+    decoder = stream.AlertDecoder()
+    triggers = set()
+    for xml, _ in alerts:
+        event = decoder.decode(ET.fromstring(xml))
+        if event.channel is not None:
+            triggers.add((event.event_type, event.channel))
+    return (f'<EventTriggerList xmlns="{NAMESPACE}">' + ''.join(
+        f'<EventTrigger><id>{etype}-{channel}</id><eventType>{etype}</eventType>'
+        f'<videoInputChannelID>{channel}</videoInputChannelID>'
+        '<EventTriggerNotificationList><EventTriggerNotification>'
+        '<notificationMethod>center</notificationMethod>'
+        '</EventTriggerNotification></EventTriggerNotificationList></EventTrigger>'
+        for etype, channel in sorted(triggers)) + '</EventTriggerList>')
+
+
+def multipart(content_type, body):
+    return b'--%s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n%s\r\n' % (
+        BOUNDARY, content_type, len(body), body)
+
+
+class FakeCamera:
+    """One replaying device."""
+
+    def __init__(self, index, alerts, rate=0, search_delay=0.0, clip_size=DEFAULT_CLIP_SIZE):
+        self.index = index
+        self.alerts = alerts
+        self.rate = rate
+        self.search_delay = search_delay
+        self.clip = bytes(range(256)) * (clip_size // 256)
+        self.triggers = event_triggers(alerts)
+        self.picture = None
+        self.count = 0
+        self.sent = {}
+        self.stats = {'streams': 0, 'searches': 0, 'downloads': 0, 'pictures': 0}
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/ISAPI/System/deviceInfo', self.device_info)
+        app.router.add_get('/ISAPI/Event/triggers', self.event_triggers)
+        app.router.add_get('/ISAPI/Event/notification/alertStream', self.alert_stream)
+        app.router.add_post('/ISAPI/ContentMgmt/search', self.search)
+        app.router.add_post('/ISAPI/ContentMgmt/download', self.download)
+        app.router.add_get('/ISAPI/Streaming/channels/{channel}/picture', self.snapshot)
+        app.router.add_get('/replay/sent', self.replay_sent)
+        app.router.add_get('/replay/stats', self.replay_stats)
+        return app
+
+    async def device_info(self, request):
+        return web.Response(
+            text=f'<DeviceInfo xmlns="{NAMESPACE}"><deviceName>fake{self.index}</deviceName>'
+                 f'<deviceID>fake-isapi-{self.index:08d}</deviceID></DeviceInfo>',
+            content_type='application/xml')
+
+    async def event_triggers(self, request):
+        return web.Response(text=self.triggers, content_type='application/xml')
+
+    async def alert_stream(self, request):
+        self.stats['streams'] += 1
+        resp = web.StreamResponse(
+            headers={'Content-Type': f'multipart/mixed; boundary={BOUNDARY.decode()}'})
+        await resp.prepare(request)
+        started = time.monotonic()
+        sent = 0
+        while True:
+            for xml, images in self.alerts:
+                if self.rate:
+                    delay = started + sent / self.rate - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                self.count += 1
+                body = _COUNT.sub(b'<activePostCount>%d</activePostCount>' % self.count, xml)
+                data = multipart(b'application/xml; charset="UTF-8"', body) + b''.join(
+                    multipart(b'image/jpeg', image) for image in images)
+                self.sent[self.count] = time.time()
+                try:
+                    await resp.write(data)
+                except ConnectionError:
+                    return resp
+                sent += 1
+
+    async def search(self, request):
+        self.stats['searches'] += 1
+        body = await request.text()
+        if self.search_delay:
+            await asyncio.sleep(self.search_delay)
+        segments = []
+        for start, end in re.findall(
+                r'<startTime>(.*?)</startTime><endTime>(.*?)</endTime>', body):
+            t = datetime.datetime.strptime(start, TIME_FORMAT) - SEGMENT / 2
+            end = datetime.datetime.strptime(end, TIME_FORMAT)
+            while t < end:
+                segments.append((t, t + SEGMENT))
+                t += SEGMENT
+        position = int(re.search(r'<searchResultPostion>(\d+)', body).group(1))
+        max_results = int(re.search(r'<maxResults>(\d+)', body).group(1))
+        page = segments[position:position + max_results]
+        items = ''.join(
+            f'<searchMatchItem><timeSpan><startTime>{a:{TIME_FORMAT}}</startTime>'
+            f'<endTime>{b:{TIME_FORMAT}}</endTime></timeSpan><mediaSegmentDescriptor>'
+            f'<playbackURI>rtsp://127.0.0.1/Streaming/tracks/101?starttime={a:{TIME_FORMAT}}'
+            f'&amp;endtime={b:{TIME_FORMAT}}&amp;name=ch01_{self.index}&amp;size={len(self.clip)}'
+            '</playbackURI></mediaSegmentDescriptor></searchMatchItem>'
+            for a, b in page)
+        status = 'MORE' if position + max_results < len(segments) else 'OK'
+        return web.Response(
+            text=f'<CMSearchResult xmlns="{NAMESPACE}"><responseStatus>true</responseStatus>'
+                 f'<responseStatusStrg>{status}</responseStatusStrg>'
+                 f'<numOfMatches>{len(page)}</numOfMatches><matchList>{items}</matchList>'
+                 '</CMSearchResult>',
+            content_type='application/xml')
+
+    async def download(self, request):
+        self.stats['downloads'] += 1
+        await request.read()
+        resp = web.StreamResponse(headers={'Content-Type': 'video/mp4'})
+        resp.content_length = len(self.clip)
+        await resp.prepare(request)
+        for i in range(0, len(self.clip), DOWNLOAD_CHUNK):
+            await resp.write(self.clip[i:i + DOWNLOAD_CHUNK])
+        await resp.write_eof()
+        return resp
+
+    async def snapshot(self, request):
+        self.stats['pictures'] += 1
+        if self.picture is None:
+            self.picture = jpeg_bytes((1920, 1080))
+        return web.Response(body=self.picture, content_type='image/jpeg')
+
+    async def replay_sent(self, request):
+        return web.json_response(self.sent)
+
+    async def replay_stats(self, request):
+        return web.json_response({'alerts': self.count, **self.stats})
+
+
+async def serve(cameras, port):
+    for n, camera in enumerate(cameras):
+        runner = web.AppRunner(camera.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port + n).start()
+    print('ready', flush=True)
+    await asyncio.Event().wait()
+
+
+@contextlib.contextmanager
+def spawn(cameras=1, port=DEFAULT_PORT, rate=0, search_delay=0.0, jpeg=True, captures=()):
+    """Run the fake devices in a subprocess, yields their ports."""
+    args = [sys.executable, str(ROOT / 'benchmarks' / 'fake_isapi.py'),
+            '--cameras', str(cameras), '--port', str(port), '--rate', str(rate),
+            '--search-delay', str(search_delay), *captures]
+    if not jpeg:
+        args.append('--no-jpeg')
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, text=True)
+    try:
+        if proc.stdout.readline().strip() != 'ready':
+            raise RuntimeError('fake_isapi.py did not start')
+        yield [port + n for n in range(cameras)]
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cameras', type=int, default=1)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--rate', type=float, default=0, help='alerts/s per camera, 0 unlimited')
+    parser.add_argument('--search-delay', type=float, default=0.0)
+    parser.add_argument('--no-jpeg', dest='jpeg', action='store_false')
+    parser.add_argument('captures', nargs='*')
+    args = parser.parse_args()
+
+    captures = load_captures(args.captures) or [
+        synthetic_capture(200, jpeg_bytes() if args.jpeg else None)]
+    alerts = [alert for capture in captures for alert in split_capture(capture)]
+    if not args.jpeg:
+        alerts = [(xml, []) for xml, _ in alerts]
+    cameras = [FakeCamera(n, alerts, args.rate, args.search_delay)
+               for n in range(args.cameras)]
+    try:
+        asyncio.run(serve(cameras, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
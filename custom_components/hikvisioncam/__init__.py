@@ -1,12 +1,295 @@
-from .api import APIHikvisionCamView
+from .api import (
+    APIHikvisionCamClipView,
+    APIHikvisionCamEventsView,
+    APIHikvisionCamSearchView,
+    APIHikvisionCamSnapshotView,
+    APIHikvisionCamView,
+)
+from .clips import (
+    DEFAULT_CACHE_SIZE,
+    DEFAULT_LOOKUP_SIZE,
+    DEFAULT_LOOKUP_TTL,
+    ClipDiskCache,
+    ClipLookupCache,
+)
+from .const import (
+    CONF_CLIP_CACHE_DIR,
+    CONF_CLIP_CACHE_SIZE,
+    CONF_CLIP_CHUNK_SIZE,
+    CONF_CLIP_LOOKUP_SIZE,
+    CONF_CLIP_LOOKUP_TTL,
+    CONF_CLIP_POST_ROLL,
+    CONF_CLIP_READ_TIMEOUT,
+    CONF_CLIP_TOTAL_TIMEOUT,
+    CONF_CLIP_TRIM,
+    CONF_CROP_MAX_SIZE,
+    CONF_DEVICE_CACHE_PATH,
+    CONF_DISCOVERY_CONCURRENCY,
+    CONF_DISCOVERY_TIMEOUT,
+    CONF_EVENT_INDEX,
+    CONF_EVENT_INDEX_MAX_AGE_DAYS,
+    CONF_EVENT_INDEX_PATH,
+    CONF_EVENT_TYPES,
+    CONF_IMAGE_BACKPRESSURE,
+    CONF_IMAGE_QUEUE_SIZE,
+    CONF_IMAGE_WORKERS,
+    CONF_INTERVAL,
+    CONF_MAX_AGE_DAYS,
+    CONF_MAX_CONCURRENT,
+    CONF_MAX_PER_CAMERA,
+    CONF_MAX_SIZE,
+    CONF_METRICS,
+    CONF_MIN_INTERVAL,
+    CONF_POST_ROLL,
+    CONF_PREFETCH,
+    CONF_RETENTION,
+    CONF_SNAPSHOT_TTL,
+    CONF_STORAGE_DIR,
+    DATA_CAMERAS,
+    DATA_CLIP_CACHE,
+    DATA_CLIP_LOOKUP,
+    DATA_CLIP_POST_ROLL,
+    DATA_CLIP_TRIM,
+    DATA_CONNECTIONS,
+    DATA_DISCOVERY,
+    DATA_EVENT_INDEX,
+    DATA_FRAMES,
+    DATA_IMAGE_POOL,
+    DATA_METRICS,
+    DATA_PREFETCH,
+    DATA_RETENTION,
+    DATA_STORAGE,
+    DATA_TRANSFERS,
+    DOMAIN,
+)
+from .connections import ConnectionManager
+from .discovery import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_TIMEOUT,
+    DeviceCache,
+    DeviceDiscovery,
+)
+from .events import DEFAULT_FLUSH_INTERVAL, DEFAULT_MAX_AGE_DAYS, EventIndex
+from .images import (
+    DEFAULT_POLICY,
+    DEFAULT_QUEUE_SIZE,
+    DEFAULT_WORKERS,
+    POLICIES,
+    ImageWorkerPool,
+)
+from .metrics import PipelineMetrics
+from .prefetch import (
+    DEFAULT_MAX_CONCURRENT,
+    DEFAULT_MIN_INTERVAL,
+    DEFAULT_POST_ROLL,
+    ClipPrefetcher,
+)
+from .proxy import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_READ_TIMEOUT,
+    DEFAULT_TOTAL_TIMEOUT,
+    ClipTransfers,
+)
+from .snapshots import DEFAULT_FRAME_TTL, FrameCache
+from .storage import (
+    DEFAULT_SWEEP_BATCH,
+    DEFAULT_SWEEP_INTERVAL,
+    RetentionSweeper,
+    SnapshotStorage,
+)
+from .trim import DEFAULT_TRIM_POST_ROLL
+from datetime import timedelta
+
+import voluptuous as vol
+
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
 from homeassistant.core import HomeAssistant
+import homeassistant.helpers.config_validation as cv
+from homeassistant.helpers.event import async_track_time_interval
 from homeassistant.helpers.typing import ConfigType
 
+CONFIG_SCHEMA = vol.Schema(
+    {
+        DOMAIN: vol.Schema(
+            {
+                vol.Optional(CONF_IMAGE_WORKERS, default=DEFAULT_WORKERS): vol.All(
+                    vol.Coerce(int), vol.Range(min=1)
+                ),
+                vol.Optional(CONF_IMAGE_QUEUE_SIZE, default=DEFAULT_QUEUE_SIZE): vol.All(
+                    vol.Coerce(int), vol.Range(min=1)
+                ),
+                vol.Optional(CONF_IMAGE_BACKPRESSURE, default=DEFAULT_POLICY): vol.In(POLICIES),
+                vol.Optional(CONF_CROP_MAX_SIZE): vol.All(vol.Coerce(int), vol.Range(min=16)),
+                vol.Optional(CONF_CLIP_LOOKUP_TTL, default=DEFAULT_LOOKUP_TTL): cv.positive_int,
+                vol.Optional(CONF_CLIP_LOOKUP_SIZE, default=DEFAULT_LOOKUP_SIZE): cv.positive_int,
+                vol.Optional(CONF_CLIP_CACHE_DIR): cv.string,
+                vol.Optional(CONF_CLIP_CACHE_SIZE, default=DEFAULT_CACHE_SIZE): cv.positive_int,
+                vol.Optional(CONF_CLIP_CHUNK_SIZE, default=DEFAULT_CHUNK_SIZE): vol.All(
+                    vol.Coerce(int), vol.Range(min=4)
+                ),
+                vol.Optional(CONF_CLIP_READ_TIMEOUT, default=DEFAULT_READ_TIMEOUT): vol.All(
+                    vol.Coerce(int), vol.Range(min=1)
+                ),
+                vol.Optional(CONF_CLIP_TOTAL_TIMEOUT, default=DEFAULT_TOTAL_TIMEOUT): vol.All(
+                    vol.Coerce(int), vol.Range(min=1)
+                ),
+                vol.Optional(CONF_CLIP_TRIM, default=False): cv.boolean,
+                vol.Optional(CONF_SNAPSHOT_TTL, default=DEFAULT_FRAME_TTL): vol.All(
+                    vol.Coerce(float), vol.Range(min=0)
+                ),
+                vol.Optional(CONF_CLIP_POST_ROLL, default=DEFAULT_TRIM_POST_ROLL): cv.positive_int,
+                vol.Optional(CONF_DEVICE_CACHE_PATH): cv.string,
+                vol.Optional(
+                    CONF_DISCOVERY_CONCURRENCY, default=DEFAULT_CONCURRENCY
+                ): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional(CONF_DISCOVERY_TIMEOUT, default=DEFAULT_TIMEOUT): vol.All(
+                    vol.Coerce(int), vol.Range(min=1)
+                ),
+                vol.Optional(CONF_EVENT_INDEX, default=True): cv.boolean,
+                vol.Optional(CONF_METRICS, default=True): cv.boolean,
+                vol.Optional(CONF_EVENT_INDEX_PATH): cv.string,
+                vol.Optional(
+                    CONF_EVENT_INDEX_MAX_AGE_DAYS, default=DEFAULT_MAX_AGE_DAYS
+                ): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional(CONF_STORAGE_DIR): cv.string,
+                vol.Optional(CONF_RETENTION): vol.Schema(
+                    {
+                        vol.Optional(CONF_MAX_AGE_DAYS): cv.positive_int,
+                        vol.Optional(CONF_MAX_SIZE): cv.positive_int,
+                        vol.Optional(CONF_MAX_PER_CAMERA): cv.positive_int,
+                        vol.Optional(CONF_INTERVAL, default=DEFAULT_SWEEP_INTERVAL): vol.All(
+                            vol.Coerce(int), vol.Range(min=10)
+                        ),
+                    }
+                ),
+                vol.Optional(CONF_PREFETCH): vol.Schema(
+                    {
+                        vol.Required(CONF_EVENT_TYPES): vol.All(cv.ensure_list, [cv.string]),
+                        vol.Optional(CONF_POST_ROLL, default=DEFAULT_POST_ROLL): cv.positive_int,
+                        vol.Optional(CONF_MIN_INTERVAL, default=DEFAULT_MIN_INTERVAL): cv.positive_int,
+                        vol.Optional(CONF_MAX_CONCURRENT, default=DEFAULT_MAX_CONCURRENT): vol.All(
+                            vol.Coerce(int), vol.Range(min=1)
+                        ),
+                    }
+                ),
+            }
+        )
+    },
+    extra=vol.ALLOW_EXTRA,
+)
 
 
 async def async_setup(hass: HomeAssistant, config: ConfigType) -> bool:
     """Register the API with the HTTP interface."""
+    conf = config.get(DOMAIN) or CONFIG_SCHEMA({DOMAIN: {}})[DOMAIN]
+
+    image_pool = ImageWorkerPool(
+        conf[CONF_IMAGE_WORKERS],
+        conf[CONF_IMAGE_QUEUE_SIZE],
+        conf[CONF_IMAGE_BACKPRESSURE],
+        conf.get(CONF_CROP_MAX_SIZE),
+    )
+    clip_cache = None
+    if conf[CONF_CLIP_CACHE_SIZE]:
+        clip_cache = ClipDiskCache(
+            conf.get(CONF_CLIP_CACHE_DIR) or hass.config.path("hikvisioncam_clips"),
+            conf[CONF_CLIP_CACHE_SIZE] * 1024 * 1024,
+        )
+        await hass.async_add_executor_job(clip_cache.load)
+    device_cache = DeviceCache(
+        conf.get(CONF_DEVICE_CACHE_PATH) or hass.config.path("hikvisioncam_devices.json")
+    )
+    await hass.async_add_executor_job(device_cache.load)
+    event_index = None
+    if conf[CONF_EVENT_INDEX]:
+        event_index = await hass.async_add_executor_job(
+            EventIndex,
+            conf.get(CONF_EVENT_INDEX_PATH) or hass.config.path("hikvisioncam_events.db"),
+            DEFAULT_FLUSH_INTERVAL,
+            conf[CONF_EVENT_INDEX_MAX_AGE_DAYS],
+        )
+    storage = SnapshotStorage(conf.get(CONF_STORAGE_DIR) or hass.config.path("www", "hikvision"))
+    sweeper = None
+    if CONF_RETENTION in conf:
+        retention = conf[CONF_RETENTION]
+        max_size = retention.get(CONF_MAX_SIZE)
+        sweeper = RetentionSweeper(
+            storage.root,
+            retention.get(CONF_MAX_AGE_DAYS),
+            max_size * 1024 * 1024 if max_size else None,
+            retention.get(CONF_MAX_PER_CAMERA),
+            DEFAULT_SWEEP_BATCH,
+        )
+        if event_index is not None:
+            # Events of deleted snapshots leave the index with them
+            sweeper.on_deleted = event_index.forget
+    prefetcher = None
+    if clip_cache is not None and CONF_PREFETCH in conf:
+        prefetch = conf[CONF_PREFETCH]
+        prefetcher = ClipPrefetcher(
+            hass,
+            clip_cache,
+            prefetch[CONF_EVENT_TYPES],
+            prefetch[CONF_POST_ROLL],
+            prefetch[CONF_MIN_INTERVAL],
+            prefetch[CONF_MAX_CONCURRENT],
+        )
+    hass.data[DOMAIN] = {
+        DATA_IMAGE_POOL: image_pool,
+        DATA_CAMERAS: {},
+        DATA_CLIP_LOOKUP: ClipLookupCache(
+            conf[CONF_CLIP_LOOKUP_TTL], conf[CONF_CLIP_LOOKUP_SIZE]
+        ),
+        DATA_CLIP_CACHE: clip_cache,
+        DATA_CLIP_TRIM: conf[CONF_CLIP_TRIM],
+        DATA_CLIP_POST_ROLL: conf[CONF_CLIP_POST_ROLL],
+        DATA_CONNECTIONS: ConnectionManager(),
+        DATA_DISCOVERY: DeviceDiscovery(
+            hass,
+            device_cache,
+            conf[CONF_DISCOVERY_CONCURRENCY],
+            conf[CONF_DISCOVERY_TIMEOUT],
+        ),
+        DATA_EVENT_INDEX: event_index,
+        DATA_FRAMES: FrameCache(conf[CONF_SNAPSHOT_TTL]),
+        DATA_METRICS: PipelineMetrics() if conf[CONF_METRICS] else None,
+        DATA_PREFETCH: prefetcher,
+        DATA_RETENTION: sweeper,
+        DATA_STORAGE: storage,
+        DATA_TRANSFERS: ClipTransfers(
+            conf[CONF_CLIP_CHUNK_SIZE] * 1024,
+            conf[CONF_CLIP_READ_TIMEOUT],
+            conf[CONF_CLIP_TOTAL_TIMEOUT],
+        ),
+    }
+
+    cancel_sweep = None
+    if sweeper is not None:
+        async def _async_sweep(now=None):
+            await hass.async_add_executor_job(sweeper.sweep)
+
+        cancel_sweep = async_track_time_interval(
+            hass, _async_sweep, timedelta(seconds=conf[CONF_RETENTION][CONF_INTERVAL])
+        )
+        hass.async_create_task(_async_sweep())
+
+    async def _async_stop(event):
+        if cancel_sweep is not None:
+            cancel_sweep()
+        if prefetcher is not None:
+            await prefetcher.async_stop()
+        if clip_cache is not None:
+            await clip_cache.async_stop()
+        await hass.async_add_executor_job(image_pool.stop)
+        if event_index is not None:
+            await hass.async_add_executor_job(event_index.stop)
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, _async_stop)
+
     hass.http.register_view(APIHikvisionCamView)
+    hass.http.register_view(APIHikvisionCamClipView)
+    hass.http.register_view(APIHikvisionCamSearchView)
+    hass.http.register_view(APIHikvisionCamEventsView)
+    hass.http.register_view(APIHikvisionCamSnapshotView)
 #    hass.http.register_view(APIDomainServicesView)
     return True
-
@@ -1,11 +1,210 @@
-from datetime import datetime, timedelta
+import asyncio
+from datetime import timedelta
+from http import HTTPStatus
+import json
+import logging
+import math
 from aiohttp import web
 
-import pytz
 import httpx
+import pytz
 import xml.etree.ElementTree as ET
 
 from homeassistant.components.http import HomeAssistantView
+import homeassistant.util.dt as dt_util
+
+from .clips import clip_id
+from .events import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from .const import (
+    DATA_CAMERAS,
+    DATA_CLIP_CACHE,
+    DATA_CLIP_LOOKUP,
+    DATA_CLIP_POST_ROLL,
+    DATA_CLIP_TRIM,
+    DATA_CONNECTIONS,
+    DATA_DISCOVERY,
+    DATA_EVENT_INDEX,
+    DATA_FRAMES,
+    DATA_IMAGE_POOL,
+    DATA_METRICS,
+    DATA_PREFETCH,
+    DATA_RETENTION,
+    DATA_TRANSFERS,
+    DOMAIN,
+)
+from .search import (
+    event_window,
+    match_segment,
+    merge_windows,
+    search_segments,
+    segment_start,
+)
+from .snapshots import STREAMS, channel_id, fetch_frame, render_frame
+from .trim import iter_plan, trim_plan
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_DELTA = 5
+CLIP_URL = "/api/hikvisioncam/clips/{clip_id}"
+SNAPSHOT_URL = "/api/hikvisioncam/snapshot/{camera}"
+MIN_SNAPSHOT_SIZE = 16
+MAX_BATCH_EVENTS = 200
+MAX_POST_ROLL = 600
+
+
+def xml_search(timezone, native_time_string, delta=DEFAULT_DELTA):
+    start_time, end_time = event_window(timezone, native_time_string, delta)
+    return f'<?xml version="1.0" encoding="utf-8"?><CMSearchDescription><searchID>1</searchID><trackIDList><trackID>101</trackID></trackIDList><timeSpanList><timeSpan><startTime>{start_time.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}</startTime><endTime>{end_time.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}</endTime></timeSpan></timeSpanList><maxResults>2</maxResults><searchResultPostion>0</searchResultPostion><metadataList><metadataDescriptor>//recordType.meta.std-cgi.com</metadataDescriptor></metadataList></CMSearchDescription>'
+
+
+async def search_clip(client, auth, root_url, xml_search):
+    """Return the escaped playbackURI of the last matching recording."""
+    url_search = f'{root_url}/ISAPI/ContentMgmt/search'
+    r = await client.post(url_search, content=xml_search, auth=auth)
+    xml_string = r.text
+    _LOGGER.debug('Search of %s returned %s: %s', root_url, r.status_code, xml_string)
+    namespace = '{http://www.hikvision.com/ver20/XMLSchema}'
+    root = ET.fromstring(xml_string)
+    download_name_list = root.findall(f'{namespace}matchList/{namespace}searchMatchItem/{namespace}mediaSegmentDescriptor/{namespace}playbackURI')
+    if not download_name_list:
+        return None
+    return download_name_list[-1].text.replace('&', '&amp;')
+
+
+async def find_clip(hass, camera, last_tripped_time):
+    """Return the escaped playbackURI recorded for an event trip time."""
+    search = xml_search(hass.config.time_zone, last_tripped_time)
+    client = camera.client
+    auth = camera.camdata.httpx_auth
+    root_url = camera.camdata.root_url
+    lookup = hass.data[DOMAIN][DATA_CLIP_LOOKUP]
+    return await lookup.get(
+        (camera.name, last_tripped_time, DEFAULT_DELTA),
+        lambda: search_clip(client, auth, root_url, search))
+
+
+async def find_clips(hass, camera, trip_times):
+    """Return {trip_time: escaped playbackURI or None} for events of a camera.
+
+    Events missing from the lookup cache are resolved with a single paged
+    search over their merged windows and cached for the single lookups.
+    """
+    lookup = hass.data[DOMAIN][DATA_CLIP_LOOKUP]
+    found = {}
+    windows = {}
+    for trip_time in trip_times:
+        download_name = lookup.cached((camera.name, trip_time, DEFAULT_DELTA))
+        if download_name is not None:
+            found[trip_time] = download_name
+        else:
+            windows[trip_time] = event_window(hass.config.time_zone, trip_time, DEFAULT_DELTA)
+    if not windows:
+        return found
+
+    segments = await search_segments(
+        camera.client, camera.camdata.httpx_auth, camera.camdata.root_url,
+        merge_windows(windows.values()))
+    for trip_time, window in windows.items():
+        segment = match_segment(window, segments)
+        download_name = segment[2].replace('&', '&amp;') if segment else None
+        lookup.put((camera.name, trip_time, DEFAULT_DELTA), download_name)
+        found[trip_time] = download_name
+    return found
+
+
+def download_request(camera, download_name):
+    """Return a function opening the download stream of a recording."""
+    xml_download = f'<downloadRequest><playbackURI>{download_name}</playbackURI></downloadRequest>'
+    url_download = f'{camera.camdata.root_url}/ISAPI/ContentMgmt/download'
+    _LOGGER.debug('Download request: %s', xml_download)
+    return lambda: camera.client.stream(
+        'POST', url_download, content=xml_download, auth=camera.camdata.httpx_auth)
+
+
+def cache_clip(clip_cache, transfers, camera, download_name):
+    """Start caching a recording unless it is already, return its clip id."""
+    cid = clip_id(download_name)
+    if cid not in clip_cache:
+        clip_cache.fill(cid, transfers.stream(
+            f'{camera.name} {cid}', download_request(camera, download_name)))
+    return cid
+
+
+async def _next_chunk(chunks):
+    """Return the next chunk or b'' at the end, anext needs Python 3.10."""
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return b''
+
+
+async def stream_clip(request, chunks, headers):
+    """Respond with the chunks of a clip, closing them when the client leaves."""
+    try:
+        try:
+            chunk = await _next_chunk(chunks)
+        except Exception as err:
+            return web.json_response({'message': f'Download failed: {err}'},
+                                     status=HTTPStatus.BAD_GATEWAY)
+        resp = web.StreamResponse(headers=headers)
+        await resp.prepare(request)
+        try:
+            while chunk:
+                await resp.write(chunk)
+                chunk = await _next_chunk(chunks)
+        except ConnectionResetError:
+            _LOGGER.debug('Client closed the clip download')
+            return resp
+        await resp.write_eof()
+        return resp
+    finally:
+        await chunks.aclose()
+
+
+async def serve_clip(request, clip_cache, cid):
+    """Respond with a cached clip, None when it is not cached.
+
+    Complete clips are served from disk with Range support, a clip that is
+    still downloading is streamed as it is written.
+    """
+    headers = {
+        'Content-Type': 'video/mp4',
+        'Content-Location': CLIP_URL.format(clip_id=cid),
+    }
+    path = clip_cache.lookup(cid)
+    if path is not None:
+        return web.FileResponse(path, headers=headers)
+    fill = clip_cache.filling(cid)
+    if fill is None:
+        return None
+    return await stream_clip(request, fill.iter_chunks(), headers)
+
+
+async def serve_trimmed(request, hass, clip_cache, cid, download_name, trip_time, post_roll):
+    """Respond with the event window of a clip, None when it can not be cut.
+
+    The clip has to be complete before it can be cut, the trimmed file is
+    then streamed with its Content-Length.
+    """
+    clip_start = segment_start(download_name)
+    if clip_start is None:
+        return None
+    fill = clip_cache.filling(cid)
+    if fill is not None:
+        await fill.wait()
+    path = clip_cache.lookup(cid)
+    if path is None:
+        return None
+    start, end = event_window(hass.config.time_zone, trip_time, DEFAULT_DELTA)
+    end += timedelta(seconds=post_roll)
+    plan = await hass.async_add_executor_job(
+        trim_plan, path,
+        max(0.0, (start - clip_start).total_seconds()),
+        (end - clip_start).total_seconds())
+    if plan is None:
+        return None
+    headers = {'Content-Type': 'video/mp4', 'Content-Length': str(plan.size)}
+    return await stream_clip(request, iter_plan(path, plan), headers)
 
 
 class APIHikvisionCamView(HomeAssistantView):
@@ -17,84 +216,282 @@ class APIHikvisionCamView(HomeAssistantView):
     #
 
     async def get(self, request):
-        """Get registered services."""
-        #services = await async_services_json(request.app["hass"])
-        print(request)
-        print(dir(request))
-        body = await request.text()
-        print(body)
-        services = {'aaa': 'bbb'}
-        return self.json(body)
-
-    def xml_search(self, timezone, native_time_string, delta=5):
-        native_time = datetime.strptime(native_time_string, '%Y-%m-%dT%H:%M:%S.%f')
-        last_tripped_time = pytz.timezone(timezone).localize(native_time, is_dst=None)
-        start_time = last_tripped_time - timedelta(seconds=delta)
-        end_time = last_tripped_time
-        return f'<?xml version="1.0" encoding="utf-8"?><CMSearchDescription><searchID>1</searchID><trackIDList><trackID>101</trackID></trackIDList><timeSpanList><timeSpan><startTime>{start_time.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}</startTime><endTime>{end_time.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}</endTime></timeSpan></timeSpanList><maxResults>2</maxResults><searchResultPostion>0</searchResultPostion><metadataList><metadataDescriptor>//recordType.meta.std-cgi.com</metadataDescriptor></metadataList></CMSearchDescription>'
+        """Return the counters of the event and clip pipelines.
+
+        With ``?format=prometheus`` the event pipeline metrics are returned
+        in the Prometheus text format instead.
+        """
+        hass = request.app["hass"]
+        metrics = hass.data[DOMAIN][DATA_METRICS]
+        if request.query.get('format') == 'prometheus':
+            if metrics is None:
+                return self.json_message('Metrics disabled', HTTPStatus.NOT_FOUND)
+            return web.Response(
+                body=metrics.prometheus().encode(),
+                headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+        clip_cache = hass.data[DOMAIN][DATA_CLIP_CACHE]
+        prefetcher = hass.data[DOMAIN][DATA_PREFETCH]
+        event_index = hass.data[DOMAIN][DATA_EVENT_INDEX]
+        sweeper = hass.data[DOMAIN][DATA_RETENTION]
+        return self.json({
+            'clip_lookup': hass.data[DOMAIN][DATA_CLIP_LOOKUP].stats,
+            'clip_cache': clip_cache.stats if clip_cache is not None else None,
+            'prefetch': prefetcher.stats if prefetcher is not None else None,
+            'transfers': hass.data[DOMAIN][DATA_TRANSFERS].stats,
+            'event_index': event_index.stats if event_index is not None else None,
+            'retention': sweeper.stats if sweeper is not None else None,
+            'image_pool': hass.data[DOMAIN][DATA_IMAGE_POOL].stats,
+            'cameras': metrics.stats if metrics is not None else None,
+            'connections': hass.data[DOMAIN][DATA_CONNECTIONS].stats,
+            'discovery': hass.data[DOMAIN][DATA_DISCOVERY].stats,
+            'frames': hass.data[DOMAIN][DATA_FRAMES].stats,
+        })
 
     async def post(self, request):
         data = await request.json()
         hass = request.app["hass"]
-        print(data)
         friendly_name = data.get('friendly_name').split()[0]
         last_tripped_time = data.get('last_tripped_time')
 
-        xml_search = self.xml_search(hass.config.time_zone, last_tripped_time)
-
-        cam_list = hass.data['binary_sensor'].config['binary_sensor']
-        url_data = get_url(cam_list, friendly_name)
-        print(url_data)
-        host = url_data.get('host')
-        username = url_data.get('username')
-        password = url_data.get('password')
-
-        #data = '<?xml version="1.0" encoding="utf-8"?><CMSearchDescription><searchID>1</searchID><trackIDList><trackID>101</trackID></trackIDList><timeSpanList><timeSpan><startTime>2022-07-22T15:09:15Z</startTime><endTime>2022-07-22T15:09:20Z</endTime></timeSpan></timeSpanList><maxResults>2500</maxResults><searchResultPostion>0</searchResultPostion><metadataList><metadataDescriptor>//recordType.meta.std-cgi.com</metadataDescriptor></metadataList></CMSearchDescription>'
-        url_search = f'http://{host}/ISAPI/ContentMgmt/search'
-        auth = httpx.DigestAuth(username, password)
-        async with httpx.AsyncClient() as client:
-            r = await client.post(url_search, data=xml_search, auth=auth)
-        print(r)
-        xml_string = r.text
-        print(xml_string)
-        namespace = '{http://www.hikvision.com/ver20/XMLSchema}'
-        root = ET.fromstring(xml_string)
-        download_name_list = root.findall(f'{namespace}matchList/{namespace}searchMatchItem/{namespace}mediaSegmentDescriptor/{namespace}playbackURI')
+        camera = hass.data[DOMAIN][DATA_CAMERAS].get(friendly_name)
+        if camera is None:
+            return self.json_message(f'Unknown camera {friendly_name}', HTTPStatus.NOT_FOUND)
+
+        download_name = await find_clip(hass, camera, last_tripped_time)
+        if download_name is None:
+            return self.json_message('No recording found', HTTPStatus.NOT_FOUND)
+
+        clip_cache = hass.data[DOMAIN][DATA_CLIP_CACHE]
+        transfers = hass.data[DOMAIN][DATA_TRANSFERS]
+        if clip_cache is None:
+            chunks = transfers.stream(camera.name, download_request(camera, download_name))
+            return await stream_clip(request, chunks, {'Content-Type': 'video/mp4'})
+
+        trim = data.get('trim', hass.data[DOMAIN][DATA_CLIP_TRIM])
+        if trim:
+            try:
+                post_roll = float(data.get('post', hass.data[DOMAIN][DATA_CLIP_POST_ROLL]))
+                if not math.isfinite(post_roll):
+                    raise ValueError(post_roll)
+            except (TypeError, ValueError):
+                return self.json_message('post must be a number of seconds',
+                                         HTTPStatus.BAD_REQUEST)
+            post_roll = min(max(post_roll, 0.0), MAX_POST_ROLL)
+
+        cid = cache_clip(clip_cache, transfers, camera, download_name)
+        if trim:
+            resp = await serve_trimmed(
+                request, hass, clip_cache, cid, download_name, last_tripped_time, post_roll)
+            if resp is not None:
+                return resp
+        resp = await serve_clip(request, clip_cache, cid)
+        if resp is None:
+            # The download failed before it could be served
+            return self.json_message('Clip download failed', HTTPStatus.BAD_GATEWAY)
+        return resp
+
+
+class APIHikvisionCamSearchView(HomeAssistantView):
+    """Resolve the clips of many events at once.
+
+    Takes {"events": [{"friendly_name": ..., "last_tripped_time": ...}]}
+    and answers with one result per event, as a JSON list or, with
+    "format": "ndjson", one line per event as soon as its camera answered.
+    """
+
+    url = "/api/hikvisioncam/search"
+    name = "api:hikvision:search"
+
+    async def post(self, request):
+        hass = request.app["hass"]
+        data = await request.json()
+        events = data.get('events')
+        if not isinstance(events, list) or len(events) > MAX_BATCH_EVENTS:
+            return self.json_message(
+                f'events must be a list of at most {MAX_BATCH_EVENTS} events',
+                HTTPStatus.BAD_REQUEST)
+
+        cameras = hass.data[DOMAIN][DATA_CAMERAS]
+        errors = []
+        by_camera = {}
+        for event in events:
+            friendly_name = str(event.get('friendly_name', '')).split(' ')[0]
+            trip_time = event.get('last_tripped_time')
+            camera = cameras.get(friendly_name)
+            if camera is None:
+                errors.append(self._result(friendly_name, trip_time, error='Unknown camera'))
+                continue
+            try:
+                event_window(hass.config.time_zone, trip_time, DEFAULT_DELTA)
+            except (TypeError, ValueError):
+                errors.append(self._result(friendly_name, trip_time, error='Invalid last_tripped_time'))
+                continue
+            by_camera.setdefault(friendly_name, (camera, []))[1].append(trip_time)
+
+        clip_cache = hass.data[DOMAIN][DATA_CLIP_CACHE]
+        searches = [self._search(hass, clip_cache, camera, trip_times)
+                    for camera, trip_times in by_camera.values()]
+
+        if data.get('format') != 'ndjson':
+            results = list(errors)
+            for batch in await asyncio.gather(*searches):
+                results.extend(batch)
+            return self.json(results)
+
+        resp = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await resp.prepare(request)
+        for result in errors:
+            await resp.write(json.dumps(result).encode() + b'\n')
+        for search in asyncio.as_completed(searches):
+            for result in await search:
+                await resp.write(json.dumps(result).encode() + b'\n')
+        await resp.write_eof()
+        return resp
+
+    async def _search(self, hass, clip_cache, camera, trip_times):
         try:
-            download_name = download_name_list[-1].text.replace('&', '&amp;')
-        except Exception as e:
-            return e
-        #download_name = 'rtsp://10.10.0.12/Streaming/tracks/101?starttime=2022-08-09T02:44:58Z&amp;endtime=2022-08-09T02:45:22Z&amp;name=ch01_00000000319000413&amp;size=15181692'
-
-        xml_download = f'<downloadRequest><playbackURI>{download_name}</playbackURI></downloadRequest>'
-        url_download = f'http://{host}/ISAPI/ContentMgmt/download'
-        print('xml_download', xml_download)
-
-        #async with httpx.AsyncClient() as client:
-        #    r = await client.post(url_download, data=xml_download, auth=auth)
-
-        client = httpx.AsyncClient()
-        resp = web.StreamResponse()
-        resp.headers['Content-Type'] = 'video/mp4'
-        async with client.stream('POST', url_download, data=xml_download, auth=auth) as response:
-            await resp.prepare(request)
-            async for chunk in response.aiter_raw():
-                await resp.write(chunk)
-            await resp.write_eof()
-            return resp
+            found = await find_clips(hass, camera, trip_times)
+        except Exception as err:  # pylint: disable=broad-except
+            return [self._result(camera.name, trip_time, error=f'Search failed: {err}')
+                    for trip_time in trip_times]
+        results = []
+        for trip_time in trip_times:
+            download_name = found.get(trip_time)
+            if download_name is None:
+                results.append(self._result(camera.name, trip_time))
+                continue
+            cid = clip_id(download_name)
+            results.append(self._result(
+                camera.name, trip_time,
+                playback_uri=download_name.replace('&amp;', '&'),
+                clip_id=cid,
+                cached=clip_cache is not None and clip_cache.lookup(cid) is not None))
+        return results
+
+    @staticmethod
+    def _result(friendly_name, trip_time, **fields):
+        return {'friendly_name': friendly_name, 'last_tripped_time': trip_time,
+                'playback_uri': None, **fields}
+
+
+def parse_time(value):
+    """Return the POSIX timestamp of an epoch or ISO 8601 query value."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = dt_util.parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f'Invalid time {value}')
+    return dt_util.as_utc(parsed).timestamp()
+
+
+class APIHikvisionCamEventsView(HomeAssistantView):
+    """Page through the event index, newest first.
 
-        #print(r)
-        #services = [friendly_name, start_time, end_time, rtsp_url]
-        #print(len(r.content))
-        #print(r)
-        #return r.stream
+    Filters are the camera, event_type, start and end query parameters,
+    times as POSIX timestamps or ISO 8601. Pass the returned next cursor as
+    cursor for the following page.
+    """
+
+    url = "/api/hikvisioncam/events"
+    name = "api:hikvision:events"
+
+    async def get(self, request):
+        hass = request.app["hass"]
+        event_index = hass.data[DOMAIN][DATA_EVENT_INDEX]
+        if event_index is None:
+            return self.json_message('Event index disabled', HTTPStatus.NOT_FOUND)
+        query = request.query
+        try:
+            limit = min(int(query.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+            start = parse_time(query['start']) if 'start' in query else None
+            end = parse_time(query['end']) if 'end' in query else None
+            events, next_cursor = await hass.async_add_executor_job(
+                event_index.query, query.get('camera'), query.get('event_type'),
+                start, end, max(limit, 1), query.get('cursor'))
+        except ValueError as err:
+            return self.json_message(str(err), HTTPStatus.BAD_REQUEST)
+        for event in events:
+            event['time'] = dt_util.as_local(
+                dt_util.utc_from_timestamp(event['time'])).isoformat()
+        return self.json({'events': events, 'next': next_cursor})
+
+
+class APIHikvisionCamClipView(HomeAssistantView):
+    """Serve clips from the clip cache."""
+
+    url = CLIP_URL
+    name = "api:hikvision:clip"
+
+    async def get(self, request, clip_id):
+        hass = request.app["hass"]
+        clip_cache = hass.data[DOMAIN][DATA_CLIP_CACHE]
+        resp = None
+        if clip_cache is not None:
+            resp = await serve_clip(request, clip_cache, clip_id)
+        if resp is None:
+            return self.json_message('Clip not cached', HTTPStatus.NOT_FOUND)
+        return resp
+
+
+class APIHikvisionCamSnapshotView(HomeAssistantView):
+    """Serve snapshots of a camera through the frame cache."""
+
+    url = SNAPSHOT_URL
+    name = "api:hikvision:snapshot"
+
+    async def get(self, request, camera):
+        """Return a snapshot, query: channel, stream (main or sub), crop and size.
+
+        ``crop`` is ``x,y,width,height`` as fractions of the frame, ``size``
+        the longest side in pixels. Without either the JPEG of the device is
+        returned as it is.
+        """
+        hass = request.app["hass"]
+        cam = hass.data[DOMAIN][DATA_CAMERAS].get(camera)
+        if cam is None:
+            return self.json_message(f'Unknown camera {camera}', HTTPStatus.NOT_FOUND)
+        query = request.query
+        try:
+            stream_id = channel_id(query.get('channel', cam.snapshot_channel),
+                                   query.get('stream', cam.snapshot_stream))
+            crop = None
+            if 'crop' in query:
+                crop = [float(value) for value in query['crop'].split(',')]
+                if len(crop) != 4 or not all(0 <= value <= 1 for value in crop):
+                    raise ValueError(crop)
+            size = int(query['size']) if 'size' in query else None
+            if size is not None and size < MIN_SNAPSHOT_SIZE:
+                raise ValueError(size)
+        except (KeyError, ValueError):
+            return self.json_message(
+                f'channel must be a number, stream one of {", ".join(STREAMS)}, crop '
+                f'four fractions and size at least {MIN_SNAPSHOT_SIZE}',
+                HTTPStatus.BAD_REQUEST)
+
+        camdata = cam.camdata
+        try:
+            # Keyed by device, entries sharing it share its frames
+            frame = await hass.data[DOMAIN][DATA_FRAMES].get(
+                (camdata.root_url, stream_id),
+                lambda: fetch_frame(cam.client, camdata.httpx_auth, camdata.root_url, stream_id))
+        except httpx.HTTPError as err:
+            return self.json_message(f'Snapshot failed: {err}', HTTPStatus.BAD_GATEWAY)
+        if frame is None:
+            return self.json_message(f'No snapshot of {camera} channel {stream_id}',
+                                     HTTPStatus.NOT_FOUND)
 
+        content_type, data = frame
+        if crop is not None or size is not None:
+            try:
+                data = await hass.async_add_executor_job(render_frame, data, crop, size)
+            except (OSError, ValueError) as err:
+                return self.json_message(f'Unable to decode snapshot: {err}',
+                                         HTTPStatus.BAD_GATEWAY)
+            content_type = 'image/jpeg'
+        return web.Response(body=data, headers={'Content-Type': content_type})
 
-def get_url(cam_list, cam_name):
-    for item in cam_list:
-        if item.get('name') == cam_name:
-            return item
-    return {}
 
 #class APIDomainServicesView(HomeAssistantView):
 #    """View to handle DomainServices requests."""
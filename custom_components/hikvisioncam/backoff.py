@@ -0,0 +1,94 @@
+"""Reconnect backoff and circuit breaker of the alert stream."""
+import random
+import time
+
+DEFAULT_INITIAL_DELAY = 1.0
+DEFAULT_MAX_DELAY = 300.0
+DEFAULT_BREAKER_THRESHOLD = 5
+
+# While waiting the device is probed with a TCP connect this often
+PROBE_INTERVAL = 5.0
+PROBE_TIMEOUT = 2.0
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+
+class ReconnectBackoff:
+    """Capped exponential backoff with jitter and a circuit breaker.
+
+    Every failed attempt doubles the delay up to ``max_delay``. The delay
+    is drawn between half and all of it, so devices failing together, like
+    the cameras behind a rebooting NVR, do not come back in lockstep. After
+    ``threshold`` failures in a row the breaker opens: the delay is held at
+    ``max_delay`` and once it is over the next attempt, a half open trial,
+    waits for the device to accept a probe. The first success closes it.
+    """
+
+    def __init__(self, initial_delay=DEFAULT_INITIAL_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 threshold=DEFAULT_BREAKER_THRESHOLD, rand=random.random):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.threshold = threshold
+        self._rand = rand
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.unreachable = False
+        self.last_error = None
+        self.next_retry = None
+        self.connected_at = None
+        self.reconnects = 0
+
+    def failed(self, err, unreachable=False):
+        """Record a failed attempt, returns the seconds to wait.
+
+        ``unreachable`` tells the device did not answer at all, only then
+        a successful probe ends the wait early.
+        """
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.state = STATE_OPEN
+            delay = self.max_delay
+        else:
+            delay = min(self.max_delay, self.initial_delay * 2 ** (self.failures - 1))
+        delay = delay / 2 + self._rand() * delay / 2
+        self.unreachable = unreachable
+        self.last_error = str(err)
+        self.next_retry = time.time() + delay
+        return delay
+
+    @property
+    def is_open(self):
+        """Return True while attempts wait for a successful probe."""
+        return self.state == STATE_OPEN
+
+    def attempt(self):
+        """Record the start of an attempt."""
+        self.next_retry = None
+        if self.state == STATE_OPEN:
+            self.state = STATE_HALF_OPEN
+
+    def connected(self):
+        """Record a successful connection, returns True if it had failed."""
+        recovered = self.failures > 0
+        if recovered:
+            self.reconnects += 1
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.unreachable = False
+        self.next_retry = None
+        self.connected_at = time.time()
+        return recovered
+
+    @property
+    def stats(self):
+        """Return the breaker state and the time of the next retry."""
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'next_retry': self.next_retry,
+            'connected_at': self.connected_at,
+            'reconnects': self.reconnects,
+        }
@@ -1,12 +1,34 @@
 """Support for Hikvision event stream events represented as binary sensors."""
 from __future__ import annotations
 
+import asyncio
 import datetime
 from datetime import timedelta
+import functools
 import logging
 import time
 
+import httpx
+from pyhik.constants import CONNECT_TIMEOUT, READ_TIMEOUT
+
 # from pyhik.hikvision import HikCamera
+from .const import (
+    DATA_CAMERAS,
+    DATA_CONNECTIONS,
+    DATA_DISCOVERY,
+    DATA_EVENT_INDEX,
+    DATA_IMAGE_POOL,
+    DATA_METRICS,
+    DATA_PREFETCH,
+    DATA_STORAGE,
+    DOMAIN,
+)
+from .coalesce import DEFAULT_MIN_PUBLISH_INTERVAL
+from .connections import ConnectionManager
+from .discovery import DeviceDiscovery
+from .metrics import STAGE_STATE
+from .record import EventRecord
+from .snapshots import STREAM_MAIN, STREAMS
 from .utils import HikCamera, REGION_IDS, REGION_SENSORS
 import voluptuous as vol
 
@@ -25,25 +47,43 @@ from homeassistant.const import (
     CONF_PORT,
     CONF_SSL,
     CONF_USERNAME,
-    EVENT_HOMEASSISTANT_START,
     EVENT_HOMEASSISTANT_STOP,
     CONF_FILE_PATH,
     CONF_REGION,
 )
 from homeassistant.core import HomeAssistant
+from homeassistant.exceptions import PlatformNotReady
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
-from homeassistant.helpers.event import track_point_in_utc_time
+from homeassistant.helpers.event import (
+    async_track_point_in_utc_time,
+    track_point_in_utc_time,
+)
+from homeassistant.helpers.start import async_at_start
 from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
 from homeassistant.util.dt import utcnow
 
 _LOGGER = logging.getLogger(__name__)
 
 CONF_IGNORED = "ignored"
+CONF_CHANNELS = "channels"
+CONF_STREAM_MODE = "stream_mode"
+CONF_STALE_AFTER = "stale_after"
+CONF_MIN_PUBLISH_INTERVAL = "min_publish_interval"
+CONF_SNAPSHOT_CHANNEL = "snapshot_channel"
+CONF_SNAPSHOT_STREAM = "snapshot_stream"
+
+STREAM_MODE_ASYNC = "async"
+STREAM_MODE_THREAD = "thread"
 
 DEFAULT_PORT = 80
 DEFAULT_IGNORED = False
 DEFAULT_DELAY = 0
+DEFAULT_STREAM_MODE = STREAM_MODE_ASYNC
+
+CLIENT_MAX_CONNECTIONS = 4
+CLIENT_MAX_KEEPALIVE = 2
+CLIENT_KEEPALIVE_EXPIRY = 60
 
 ATTR_DELAY = "delay"
 
@@ -76,6 +116,9 @@ CUSTOMIZE_SCHEMA = vol.Schema(
     {
         vol.Optional(CONF_IGNORED, default=DEFAULT_IGNORED): cv.boolean,
         vol.Optional(CONF_DELAY, default=DEFAULT_DELAY): cv.positive_int,
+        vol.Optional(CONF_MIN_PUBLISH_INTERVAL): vol.All(
+            vol.Coerce(float), vol.Range(min=0)
+        ),
     }
 )
 
@@ -87,6 +130,18 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
         vol.Optional(CONF_SSL, default=False): cv.boolean,
         vol.Required(CONF_USERNAME): cv.string,
         vol.Required(CONF_PASSWORD): cv.string,
+        vol.Optional(CONF_CHANNELS): vol.All(cv.ensure_list, [cv.positive_int]),
+        vol.Optional(CONF_STREAM_MODE, default=DEFAULT_STREAM_MODE): vol.In(
+            [STREAM_MODE_ASYNC, STREAM_MODE_THREAD]
+        ),
+        vol.Optional(CONF_STALE_AFTER, default={}): vol.Schema(
+            {cv.string: vol.All(vol.Coerce(float), vol.Range(min=0))}
+        ),
+        vol.Optional(
+            CONF_MIN_PUBLISH_INTERVAL, default=DEFAULT_MIN_PUBLISH_INTERVAL
+        ): vol.All(vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONF_SNAPSHOT_CHANNEL): cv.positive_int,
+        vol.Optional(CONF_SNAPSHOT_STREAM, default=STREAM_MAIN): vol.In(list(STREAMS)),
         vol.Optional(CONF_CUSTOMIZE, default={}): vol.Schema(
             {cv.string: CUSTOMIZE_SCHEMA}
         ),
@@ -94,10 +149,10 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
 )
 
 
-def setup_platform(
+async def async_setup_platform(
         hass: HomeAssistant,
         config: ConfigType,
-        add_entities: AddEntitiesCallback,
+        async_add_entities: AddEntitiesCallback,
         discovery_info: DiscoveryInfoType | None = None,
 ) -> None:
     """Set up the Hikvision binary sensor devices."""
@@ -108,21 +163,55 @@ def setup_platform(
     password = config[CONF_PASSWORD]
 
     customize = config[CONF_CUSTOMIZE]
+    stream_mode = config[CONF_STREAM_MODE]
 
     protocol = "https" if config[CONF_SSL] else "http"
 
     url = f"{protocol}://{host}"
 
-    data = HikvisionData(hass, url, port, name, username, password)
-
-    if data.sensors is None:
-        _LOGGER.error("Hikvision event stream has no data, unable to set up")
-        return
-
+    data = HikvisionData(hass, url, port, name, username, password, stream_mode)
+    await data.async_setup()
+    if data.opened:
+        # Stream options come from the entry opening the device
+        data.camdata.stale_after = config[CONF_STALE_AFTER]
+        data.camdata.coalescer.default_interval = config[CONF_MIN_PUBLISH_INTERVAL]
+    elif (data.camdata.stale_after != config[CONF_STALE_AFTER]
+          or data.camdata.coalescer.default_interval != config[CONF_MIN_PUBLISH_INTERVAL]):
+        _LOGGER.warning(
+            "%s uses the %s and %s of %s, which opened the device",
+            data.name,
+            CONF_STALE_AFTER,
+            CONF_MIN_PUBLISH_INTERVAL,
+            data.connection_name,
+        )
+
+    channels = config.get(CONF_CHANNELS)
+    # Each channel of a device belongs to one entry, a second entry would
+    # create its sensors again with the same unique_id.
+    taken = data.claim_channels({
+        int(channel[1])
+        for channel_list in data.sensors.values()
+        for channel in channel_list
+        if channels is None or int(channel[1]) in channels
+    })
+    if taken:
+        _LOGGER.error(
+            "%s: channel(s) %s of the device are already set up by another entry, "
+            "skipping them. Use the %s option to split a device between entries",
+            data.name,
+            ", ".join(str(channel) for channel in sorted(taken)),
+            CONF_CHANNELS,
+        )
+    data.snapshot_channel = config.get(CONF_SNAPSHOT_CHANNEL) or (channels or [1])[0]
+    data.snapshot_stream = config[CONF_SNAPSHOT_STREAM]
     entities = []
 
     for sensor, channel_list in data.sensors.items():
         for channel in channel_list:
+            if channels is not None and int(channel[1]) not in channels:
+                continue
+            if int(channel[1]) in taken:
+                continue
             # Build sensor name, then parse customize config.
             if data.type == "NVR":
                 sensor_name = f"{sensor.replace(' ', '_')}_{channel[1]}"
@@ -132,6 +221,10 @@ def setup_platform(
             custom = customize.get(sensor_name.lower(), {})
             ignore = custom.get(CONF_IGNORED)
             delay = custom.get(CONF_DELAY)
+            if CONF_MIN_PUBLISH_INTERVAL in custom:
+                data.camdata.coalescer.intervals[(sensor, int(channel[1]))] = custom[
+                    CONF_MIN_PUBLISH_INTERVAL
+                ]
 
             _LOGGER.debug(
                 "Entity: %s - %s, Options - Ignore: %s, Delay: %s",
@@ -149,42 +242,161 @@ def setup_platform(
                     entities.append(
                         HikvisionBinarySensor(hass, sensor, channel[1], data, delay, region)
                     )
-    add_entities(entities)
+    async_add_entities(entities)
 
 
 class HikvisionData:
-    """Hikvision device event stream object."""
+    """Hikvision device event stream object.
+
+    Entries of the same device share its camera, client and alert stream
+    through the connection manager, async_setup opens or joins it.
+    """
 
-    def __init__(self, hass, url, port, name, username, password):
+    def __init__(self, hass, url, port, name, username, password,
+                 stream_mode=DEFAULT_STREAM_MODE):
         """Initialize the data object."""
+        self._hass = hass
         self._url = url
         self._port = port
         self._name = name
         self._username = username
         self._password = password
-
-        # Establish camera
-        self.camdata = HikCamera(self._url, self._port, self._username, self._password)
+        self._stream_mode = stream_mode
+        self._connections = hass.data.get(DOMAIN, {}).get(DATA_CONNECTIONS)
+        if self._connections is None:
+            self._connections = ConnectionManager()
+        self._connection = None
+        self.opened = False
+        self.camdata = None
+        self.client = None
+        self.snapshot_channel = 1
+        self.snapshot_stream = STREAM_MAIN
+
+    async def async_setup(self):
+        """Open the device or join its connection, raises PlatformNotReady."""
+        hass = self._hass
+        self._connection = await self._connections.async_acquire(
+            ConnectionManager.key(self._url, self._port, self._username),
+            self,
+            self._async_open_device,
+        )
+        self.camdata = self._connection.camdata
+        self.client = self._connection.client
 
         if self._name is None:
             self._name = self.camdata.get_name
+        if self._connection.stream_mode != self._stream_mode:
+            _LOGGER.warning(
+                "%s shares the %s alert stream of %s",
+                self._name,
+                self._connection.stream_mode,
+                self._connection.name,
+            )
+        hass.data.setdefault(DOMAIN, {}).setdefault(DATA_CAMERAS, {})[self._name] = self
 
-        hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, self.stop_hik)
-        hass.bus.listen_once(EVENT_HOMEASSISTANT_START, self.start_hik)
-
-    def stop_hik(self, event):
-        """Shutdown Hikvision subscriptions and subscription thread on exit."""
-        self.camdata.disconnect()
-
-    def start_hik(self, event):
+        # Entries set up after startup, e.g. retried after PlatformNotReady,
+        # start their stream right away, the others once Home Assistant runs.
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, self.async_stop_hik)
+        if self._connection.stream_mode == STREAM_MODE_ASYNC:
+            async_at_start(hass, self.async_start_hik)
+        else:
+            async_at_start(hass, self.start_hik)
+
+    def claim_channels(self, channels):
+        """Assign channels to this entry, returns those of other entries."""
+        return self._connection.claim_channels(self, channels)
+
+    async def _async_open_device(self, connection):
+        """Set up the camera and client of a device not opened yet."""
+        hass = self._hass
+        discovery = hass.data.get(DOMAIN, {}).get(DATA_DISCOVERY)
+        if discovery is None:
+            discovery = DeviceDiscovery(hass)
+
+        # Establish camera, from the device cache when possible
+        camdata = await discovery.async_camera(
+            connection.key,
+            functools.partial(
+                HikCamera, self._url, self._port, self._username, self._password, True
+            ),
+        )
+        if camdata is None:
+            raise PlatformNotReady(f"Unable to discover {self._url}:{self._port}")
+        self.opened = True
+        camdata.image_pool = hass.data.get(DOMAIN, {}).get(DATA_IMAGE_POOL)
+        camdata.storage = hass.data.get(DOMAIN, {}).get(DATA_STORAGE)
+        prefetcher = hass.data.get(DOMAIN, {}).get(DATA_PREFETCH)
+        if prefetcher is not None:
+            camdata.on_event_end = functools.partial(prefetcher.event_ended, self)
+
+        name = self._name if self._name is not None else camdata.get_name
+        event_index = hass.data.get(DOMAIN, {}).get(DATA_EVENT_INDEX)
+        if event_index is not None:
+            camdata.event_index = event_index.camera(name)
+        metrics = hass.data.get(DOMAIN, {}).get(DATA_METRICS)
+        if metrics is not None:
+            camdata.metrics = metrics.camera(name)
+
+        connection.name = name
+        connection.camdata = camdata
+        connection.stream_mode = self._stream_mode
+        # Pooled keep-alive client shared by the event stream and the ISAPI
+        # calls of the API view, so requests skip the TCP setup and reuse
+        # the Digest challenge of the camera.
+        connection.client = httpx.AsyncClient(
+            verify=camdata.hik_request.verify,
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=CLIENT_MAX_CONNECTIONS,
+                max_keepalive_connections=CLIENT_MAX_KEEPALIVE,
+                keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY,
+            ),
+        )
+
+    def start_hik(self, hass):
         """Start Hikvision event stream thread."""
-        self.camdata.start_stream()
+        if self._connection.claim_start():
+            self.camdata.start_stream()
+
+    async def async_start_hik(self, hass):
+        """Start Hikvision event stream as a task on the event loop."""
+        if self._connection.claim_start():
+            self._connection.task = self._hass.async_create_background_task(
+                self.camdata.async_alert_stream(self.client),
+                f"hikvisioncam alert stream {self._connection.name}",
+            )
+
+    async def async_stop_hik(self, event):
+        """Release the device, the last entry stops its stream and client."""
+        connection = self._connection
+        if not self._connections.release(connection, self):
+            return
+        if connection.task is not None:
+            connection.task.cancel()
+            try:
+                await connection.task
+            except asyncio.CancelledError:
+                pass
+            connection.task = None
+        elif connection.started:
+            # Shutdown the subscription thread
+            await self._hass.async_add_executor_job(self.camdata.disconnect)
+        await self.async_close()
+
+    async def async_close(self, event=None):
+        """Close the pooled client."""
+        await self.client.aclose()
 
     @property
     def sensors(self):
         """Return list of available sensors and their states."""
         return self.camdata.current_event_states
 
+    @property
+    def connection_name(self):
+        """Return the name of the entry that opened the device."""
+        return self._connection.name
+
     @property
     def cam_id(self):
         """Return device id."""
@@ -233,7 +445,7 @@ class HikvisionBinarySensor(BinarySensorEntity):
 
         self._state = False
         self._box = None
-        self._attr = [False, 1, None, datetime.datetime(2022, 1, 1, 1, 0, 0, 0)]
+        self._attr = EventRecord(False, channel, 0, datetime.datetime(2022, 1, 1, 1, 0, 0, 0))
         self._path = ''
 
         if delay is None:
@@ -244,8 +456,13 @@ class HikvisionBinarySensor(BinarySensorEntity):
         self._timer = None
 
         # Register callback function with pyHik
-        self._cam.camdata.add_update_callback(self._update_callback, f"{self._cam.cam_id}.{sensor}.{channel}{region}")
-        # self._cam.camdata.add_update_callback(self._update_callback, f"{self._cam.cam_id}.{sensor}.{channel}")
+        self._remove_callback = self._cam.camdata.add_event_callback(
+            self._update_callback, sensor, channel, region
+        )
+
+    async def async_will_remove_from_hass(self) -> None:
+        """Stop receiving events when the entity is removed."""
+        self._remove_callback()
 
     def _sensor_state(self):
         """Extract sensor state."""
@@ -253,57 +470,7 @@ class HikvisionBinarySensor(BinarySensorEntity):
 
     def _sensor_last_update(self):
         """Extract sensor last update time."""
-        return self._attr[3] #self._cam.get_attributes(self._sensor, self._channel)[3]
-
-    def _sensor_region(self, attr=None):
-        """Extract sensor last update time."""
-        try:
-            region = int(attr[4])
-        except:
-            region = ''
-        return region
-
-    def _sensor_box(self, attr=None):
-        """Extract sensor box."""
-        if not attr:
-            try:
-                attr =self._cam.get_attributes(self._sensor, self._channel)
-            except:
-                attr = None
-        try:
-            box = attr[5]
-        except Exception as e:
-            _LOGGER.warning(f'_sensor_box Except {e}')
-            box = None
-        return box
-
-    def _sensor_last_tripped_time(self):
-        """Extract sensor last update time."""
-        try:
-            attr = self._attr  #self._cam.get_attributes(self._sensor, self._channel)
-            time_stamp = attr[3].timestamp()
-        except Exception as e:
-            _LOGGER.warning(f'_sensor_last_tripped_time Except {e}')
-            return time.time()
-        return time_stamp
-
-    def _sensor_detectionTarget(self, attr=None):
-        """Extract sensor detected object."""
-        try:
-            detectionTarget = attr[6]
-        except Exception as e:
-            _LOGGER.warning(f'_sensor_detectionTarget Except {e}')
-            detectionTarget = ''
-        return detectionTarget
-
-    def _sensor_image_path(self, attr=None):
-        """Extract sensor file path."""
-        try:
-            path = attr[7]
-        except Exception as e:
-            _LOGGER.warning(f'_sensor_path Except {e}')
-            path = ''
-        return path
+        return self._attr.time
 
     #def _sensor_image_path(self, box, time_stamp):
     #    if not self.is_on:
@@ -351,8 +518,7 @@ class HikvisionBinarySensor(BinarySensorEntity):
             box = self._box
         else:
             box = None
-        time_stamp = self._sensor_last_tripped_time()
-        path = self._path  # self._sensor_image_path(box, time_stamp)
+        path = self._path
         attr = {ATTR_LAST_TRIP_TIME: self._sensor_last_update(),
                 CONF_REGION: region,
                 'box': box,
@@ -370,14 +536,21 @@ class HikvisionBinarySensor(BinarySensorEntity):
         pass
 
     def schedule_update_ha_state(self, force_refresh: bool = False, region='', estate='', attr=None) -> None:
-        self.sensor_region = self._sensor_region(attr)
-        self._box = self._sensor_box(attr)
-        self._path = self._sensor_image_path(attr)
-        self._object = self._sensor_detectionTarget(attr)
+        if attr is None:
+            super(HikvisionBinarySensor, self).schedule_update_ha_state(force_refresh)
+            return
+        self.sensor_region = attr.region_id
+        self._box = attr.box
+        self._path = attr.path
+        self._object = attr.target
         if self._region == self.sensor_region or self.sensor_region == '':
             self._state = (estate == True)
             self._attr = attr
+            started = time.perf_counter()
             super(HikvisionBinarySensor, self).schedule_update_ha_state()
+            metrics = self._cam.camdata.metrics
+            if metrics is not None:
+                metrics.observe(STAGE_STATE, time.perf_counter() - started)
 
     def _update_callback(self, msg, region='', estate='', attr=None):
         """Update the sensor's state, if needed."""
@@ -390,14 +563,20 @@ class HikvisionBinarySensor(BinarySensorEntity):
                 _LOGGER.warning(
                     "%s Called delayed (%ssec) update", self._name, self._delay
                 )
-                self.schedule_update_ha_state(False, region, estate)
+                self.schedule_update_ha_state(False, region, estate, attr)
                 self._timer = None
 
             if self._timer is not None:
                 self._timer()
                 self._timer = None
 
-            self._timer = track_point_in_utc_time(
+            # Async streams call back from the event loop where the
+            # threaded helper can not be used.
+            if self._cam.camdata.is_async:
+                track = async_track_point_in_utc_time
+            else:
+                track = track_point_in_utc_time
+            self._timer = track(
                 self._hass, _delay_update, utcnow() + timedelta(seconds=self._delay)
             )
 
@@ -0,0 +1,307 @@
+"""Recorded clip lookup for event playback."""
+import asyncio
+import collections
+import hashlib
+import logging
+import os
+import time
+
+_LOGGING = logging.getLogger(__name__)
+
+DEFAULT_LOOKUP_TTL = 300
+DEFAULT_LOOKUP_SIZE = 256
+DEFAULT_CACHE_SIZE = 1024  # MiB
+
+CLIP_SUFFIX = '.mp4'
+PART_SUFFIX = '.part'
+READ_SIZE = 65536
+
+
+class ClipLookupCache:
+    """TTL/LRU cache of resolved playbackURIs with request coalescing.
+
+    Keys are (camera, last_tripped_time, delta). Concurrent lookups of a key
+    that is not cached share a single search, failed or empty searches are
+    not cached so a clip that is still being recorded is found later.
+    """
+
+    def __init__(self, ttl=DEFAULT_LOOKUP_TTL, max_entries=DEFAULT_LOOKUP_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, key, search):
+        """Return the cached value of key or await ``search()`` for it."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        pending = asyncio.ensure_future(search())
+        self._pending[key] = pending
+        try:
+            value = await asyncio.shield(pending)
+        finally:
+            if pending.done():
+                self._pending.pop(key, None)
+            else:
+                # The caller went away, let the search finish for the others.
+                pending.add_done_callback(lambda fut: self._finish(key, fut))
+        self._store(key, value)
+        return value
+
+    def cached(self, key):
+        """Return the cached value of key or None."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        """Cache the value of a key resolved by another search."""
+        self._store(key, value)
+
+    def _finish(self, key, future):
+        self._pending.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self._store(key, future.result())
+
+    def _store(self, key, value):
+        if value is None:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @property
+    def stats(self):
+        """Return hit/miss counters."""
+        return {
+            'entries': len(self._entries),
+            'in_flight': len(self._pending),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
+
+
+def clip_id(playback_uri):
+    """Return the cache id of a playbackURI."""
+    return hashlib.sha1(playback_uri.encode()).hexdigest()
+
+
+class ClipFill:
+    """A clip being downloaded into the cache.
+
+    Readers tail the partial file while the download appends to it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.written = 0
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self):
+        """Wait until the download finished or failed."""
+        while not self.done:
+            await self._changed.wait()
+
+    async def iter_chunks(self, start=0):
+        """Yield the clip from ``start`` as it is written."""
+        loop = asyncio.get_running_loop()
+        offset = start
+        f = None
+        try:
+            while True:
+                if offset < self.written:
+                    if f is None:
+                        f = await self._open(loop)
+                    chunk = await loop.run_in_executor(
+                        None, _read, f, offset, min(READ_SIZE, self.written - offset))
+                    offset += len(chunk)
+                    yield chunk
+                elif self.error is not None:
+                    raise self.error
+                elif self.done:
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            if f is not None:
+                f.close()
+
+    async def _open(self, loop):
+        """Open the file, the part file is only there while downloading."""
+        try:
+            return await loop.run_in_executor(None, open, self.path, 'rb')
+        except FileNotFoundError:
+            # Renamed to the cached clip meanwhile, or the download failed
+            await self.wait()
+            if self.error is not None:
+                raise self.error
+            return await loop.run_in_executor(None, open, self.path, 'rb')
+
+
+class ClipDiskCache:
+    """Size bounded LRU cache of downloaded clips keyed by playbackURI."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._files = collections.OrderedDict()
+        self._fills = {}
+        self._tasks = set()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, cid, suffix=CLIP_SUFFIX):
+        return os.path.join(self.directory, cid + suffix)
+
+    def load(self):
+        """Index the clips already on disk, blocking."""
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(PART_SUFFIX):
+                os.unlink(entry.path)
+            elif entry.name.endswith(CLIP_SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len(CLIP_SUFFIX)], stat.st_size))
+        for _, cid, size in sorted(entries):
+            self._files[cid] = size
+            self.size += size
+        _unlink_all(self._evict())
+
+    def __contains__(self, cid):
+        return cid in self._files or cid in self._fills
+
+    def lookup(self, cid):
+        """Return the path of a complete cached clip or None."""
+        if cid not in self._files:
+            return None
+        self._files.move_to_end(cid)
+        self.hits += 1
+        return self._path(cid)
+
+    def filling(self, cid):
+        """Return the ClipFill of a clip being downloaded or None."""
+        return self._fills.get(cid)
+
+    def fill(self, cid, chunks):
+        """Start writing a clip from the async iterator of its ``chunks``."""
+        self.misses += 1
+        fill = ClipFill(self._path(cid, PART_SUFFIX))
+        self._fills[cid] = fill
+        task = asyncio.create_task(self._download(cid, fill, chunks))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return fill
+
+    async def async_stop(self):
+        """Cancel the running downloads, their part files are dropped by load."""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _download(self, cid, fill, chunks):
+        loop = asyncio.get_running_loop()
+        try:
+            f = await loop.run_in_executor(None, open, fill.path, 'wb')
+            try:
+                async for chunk in chunks:
+                    await loop.run_in_executor(None, _write, f, chunk)
+                    fill.written += len(chunk)
+                    fill._notify()
+            finally:
+                f.close()
+            await loop.run_in_executor(None, os.replace, fill.path, self._path(cid))
+        except asyncio.CancelledError:
+            # Readers must not take the partial clip for a complete one
+            fill.error = RuntimeError(f'Download of clip {cid} cancelled')
+            raise
+        except Exception as err:  # pylint: disable=broad-except
+            _LOGGING.warning('Unable to download clip %s: %s', cid, err)
+            fill.error = err
+            await loop.run_in_executor(None, _unlink, fill.path)
+        else:
+            self._files[cid] = fill.written
+            self.size += fill.written
+            fill.path = self._path(cid)
+            # The index is only changed on the loop, the executor deletes
+            await loop.run_in_executor(None, _unlink_all, self._evict())
+        finally:
+            fill.done = True
+            self._fills.pop(cid, None)
+            fill._notify()
+
+    def _evict(self):
+        """Drop least recently used clips above the size limit.
+
+        Returns the paths of the dropped clips for the caller to delete.
+        """
+        paths = []
+        while self.size > self.max_bytes and len(self._files) > 1:
+            cid, size = self._files.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            paths.append(self._path(cid))
+        return paths
+
+    @property
+    def stats(self):
+        """Return cache counters."""
+        return {
+            'clips': len(self._files),
+            'bytes': self.size,
+            'filling': len(self._fills),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def _write(f, data):
+    f.write(data)
+    f.flush()
+
+
+def _read(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _unlink_all(paths):
+    for path in paths:
+        _unlink(path)
@@ -0,0 +1,70 @@
+"""Coalescing of repeated sensor updates before they are published."""
+from .expiry import ExpiryQueue
+
+DEFAULT_MIN_PUBLISH_INTERVAL = 1.0
+
+
+class PublishCoalescer:
+    """Minimum interval between publishes of the same state of a sensor.
+
+    Keys are callback keys (event type, channel, region). A change of
+    state is always published at once. Repeats of the published state
+    within the interval are held back, only the latest one is published
+    when the interval is over, so box and region updates of a chatty
+    camera reach Home Assistant at most once per interval.
+    """
+
+    def __init__(self, default_interval=DEFAULT_MIN_PUBLISH_INTERVAL):
+        self.default_interval = default_interval
+        self.intervals = {}
+        self._last = {}
+        self._pending = {}
+        self._deadlines = ExpiryQueue()
+        self.published = 0
+        self.coalesced = 0
+
+    def interval(self, key):
+        """Return the minimum publish interval of a key in seconds."""
+        return self.intervals.get(key[:2], self.default_interval)
+
+    def offer(self, key, estate, update, now):
+        """Return True when ``update`` is to be published now.
+
+        Otherwise it replaces any update of key held back before and is
+        returned by ``pop_due`` once the interval is over.
+        """
+        last = self._last.get(key)
+        if last is None or last[0] != estate or now - last[1] >= self.interval(key):
+            self._last[key] = (estate, now)
+            if self._pending.pop(key, None) is not None:
+                self._deadlines.cancel(key)
+            self.published += 1
+            return True
+        if key not in self._pending:
+            self._deadlines.schedule(key, last[1] + self.interval(key))
+        self._pending[key] = update
+        self.coalesced += 1
+        return False
+
+    def pop_due(self, now):
+        """Remove and return [(key, update)] of held back updates now due."""
+        due = []
+        for key in self._deadlines.pop_due(now):
+            update = self._pending.pop(key)
+            self._last[key] = (self._last[key][0], now)
+            self.published += 1
+            due.append((key, update))
+        return due
+
+    def next_deadline(self):
+        """Return the earliest deadline of a held back update or None."""
+        return self._deadlines.next_deadline()
+
+    @property
+    def stats(self):
+        """Return publish counters."""
+        return {
+            'published': self.published,
+            'coalesced': self.coalesced,
+            'held': len(self._pending),
+        }
@@ -0,0 +1,125 @@
+"""Alert stream connections shared by the config entries of a device."""
+import asyncio
+import logging
+import threading
+
+_LOGGING = logging.getLogger(__name__)
+
+
+class DeviceConnection:
+    """Camera, client and alert stream of one device.
+
+    ``entries`` are the config entries using the device, the stream is
+    started by the first of them and stopped with the last one. Every
+    channel belongs to a single entry, ``channels`` maps it to that entry.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.lock = threading.Lock()
+        self.opening = asyncio.Lock()
+        self.name = None
+        self.camdata = None
+        self.client = None
+        self.stream_mode = None
+        self.entries = []
+        self.channels = {}
+        self.task = None
+        self._started = False
+
+    def claim_start(self):
+        """Return True for the first caller only, who starts the stream."""
+        with self.lock:
+            if self._started:
+                return False
+            self._started = True
+            return True
+
+    def claim_channels(self, entry, channels):
+        """Assign channels to entry, returns those owned by other entries."""
+        with self.lock:
+            return {channel for channel in channels
+                    if self.channels.setdefault(channel, entry) is not entry}
+
+    @property
+    def started(self):
+        """Return True once the stream was started."""
+        return self._started
+
+    @property
+    def stats(self):
+        """Return the entries and subscriptions of the connection."""
+        return {
+            'host': self.key[0],
+            'port': self.key[1],
+            'stream_mode': self.stream_mode,
+            'started': self._started,
+            'entries': [entry.name for entry in self.entries],
+            'channels': {channel: entry.name for channel, entry in sorted(self.channels.items())},
+            'subscriptions': self.camdata.subscriptions if self.camdata is not None else 0,
+            'reconnect': self.camdata.backoff.stats if self.camdata is not None else None,
+        }
+
+
+class ConnectionManager:
+    """One DeviceConnection per device, reference counted by entry.
+
+    An NVR configured several times, e.g. once per group of channels, is
+    read through a single alertStream whose events are dispatched by
+    channel and region to the entities of every entry.
+    """
+
+    def __init__(self):
+        self._connections = {}
+        self.opened = 0
+        self.shared = 0
+
+    @staticmethod
+    def key(url, port, username):
+        """Return the key identifying a device."""
+        return url.rstrip('/').lower(), int(port), username
+
+    async def async_acquire(self, key, entry, async_open_device):
+        """Return the connection of key with entry added to its users.
+
+        ``async_open_device(connection)`` sets up the camera and client of
+        a new connection, other entries of the device wait for it. If it
+        raises the next entry of the device tries again.
+        """
+        connection = self._connections.get(key)
+        if connection is None:
+            connection = self._connections[key] = DeviceConnection(key)
+        async with connection.opening:
+            if connection.camdata is None:
+                await async_open_device(connection)
+                self.opened += 1
+            else:
+                self.shared += 1
+                _LOGGING.debug('Sharing the alert stream of %s', connection.name)
+            connection.entries.append(entry)
+        return connection
+
+    def release(self, connection, entry):
+        """Remove entry from the users, returns True if it was the last one."""
+        if entry in connection.entries:
+            connection.entries.remove(entry)
+        with connection.lock:
+            for channel, owner in list(connection.channels.items()):
+                if owner is entry:
+                    del connection.channels[channel]
+        if connection.entries:
+            return False
+        if self._connections.get(connection.key) is connection:
+            del self._connections[connection.key]
+        return True
+
+    @property
+    def stats(self):
+        """Return the counters and every open connection by name."""
+        connections = list(self._connections.values())
+        return {
+            'opened': self.opened,
+            'shared': self.shared,
+            'devices': {connection.name: connection.stats
+                        for connection in connections if connection.camdata is not None},
+        }
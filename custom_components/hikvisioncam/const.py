@@ -0,0 +1,51 @@
+"""Constants for the Hikvisioncam integration."""
+DOMAIN = "hikvisioncam"
+
+CONF_IMAGE_WORKERS = "image_workers"
+CONF_IMAGE_QUEUE_SIZE = "image_queue_size"
+CONF_IMAGE_BACKPRESSURE = "image_backpressure"
+CONF_CROP_MAX_SIZE = "crop_max_size"
+CONF_CLIP_LOOKUP_TTL = "clip_lookup_ttl"
+CONF_CLIP_LOOKUP_SIZE = "clip_lookup_size"
+CONF_CLIP_CACHE_DIR = "clip_cache_dir"
+CONF_CLIP_CACHE_SIZE = "clip_cache_size"
+CONF_PREFETCH = "prefetch"
+CONF_EVENT_INDEX = "event_index"
+CONF_STORAGE_DIR = "storage_dir"
+CONF_RETENTION = "retention"
+CONF_MAX_AGE_DAYS = "max_age_days"
+CONF_MAX_SIZE = "max_size"
+CONF_MAX_PER_CAMERA = "max_per_camera"
+CONF_INTERVAL = "interval"
+CONF_EVENT_INDEX_PATH = "event_index_path"
+CONF_EVENT_INDEX_MAX_AGE_DAYS = "event_index_max_age_days"
+CONF_METRICS = "metrics"
+CONF_DEVICE_CACHE_PATH = "device_cache_path"
+CONF_DISCOVERY_CONCURRENCY = "discovery_concurrency"
+CONF_DISCOVERY_TIMEOUT = "discovery_timeout"
+CONF_CLIP_TRIM = "clip_trim"
+CONF_SNAPSHOT_TTL = "snapshot_ttl"
+CONF_CLIP_POST_ROLL = "clip_post_roll"
+CONF_CLIP_CHUNK_SIZE = "clip_chunk_size"
+CONF_CLIP_READ_TIMEOUT = "clip_read_timeout"
+CONF_CLIP_TOTAL_TIMEOUT = "clip_total_timeout"
+CONF_EVENT_TYPES = "event_types"
+CONF_POST_ROLL = "post_roll"
+CONF_MIN_INTERVAL = "min_interval"
+CONF_MAX_CONCURRENT = "max_concurrent"
+
+DATA_CAMERAS = "cameras"
+DATA_CLIP_CACHE = "clip_cache"
+DATA_CLIP_LOOKUP = "clip_lookup"
+DATA_CLIP_POST_ROLL = "clip_post_roll"
+DATA_CLIP_TRIM = "clip_trim"
+DATA_CONNECTIONS = "connections"
+DATA_DISCOVERY = "discovery"
+DATA_EVENT_INDEX = "event_index"
+DATA_FRAMES = "frames"
+DATA_IMAGE_POOL = "image_pool"
+DATA_METRICS = "metrics"
+DATA_PREFETCH = "prefetch"
+DATA_RETENTION = "retention"
+DATA_STORAGE = "storage"
+DATA_TRANSFERS = "transfers"
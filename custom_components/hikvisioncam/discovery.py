@@ -0,0 +1,165 @@
+"""Device discovery with an on-disk cache of device info and event triggers."""
+import asyncio
+import json
+import logging
+import os
+import threading
+import uuid
+
+_LOGGING = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_CONCURRENCY = 4
+
+
+def cache_key(key):
+    """Return the string key of a ConnectionManager device key."""
+    return '{}:{}:{}'.format(*key)
+
+
+class DeviceCache:
+    """Capabilities of every discovered device, kept in a JSON file.
+
+    ``load`` and ``save`` block on the disk and run in the executor.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Read the cache file, a missing or broken file is an empty cache."""
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                devices = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as err:
+            _LOGGING.warning('Ignoring device cache %s: %s', self.path, err)
+            return
+        if isinstance(devices, dict):
+            self._devices = devices
+
+    def save(self):
+        """Write the cache file atomically."""
+        with self._lock:
+            data = json.dumps(self._devices, indent=1, sort_keys=True)
+        tmp = f'{self.path}.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as file:
+                file.write(data)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            _LOGGING.warning('Unable to write device cache %s: %s', self.path, err)
+
+    def get(self, key):
+        """Return the cached capabilities of a device or None."""
+        return self._devices.get(cache_key(key))
+
+    def put(self, key, capabilities):
+        """Store the capabilities of a device, returns True if they changed."""
+        with self._lock:
+            if self._devices.get(cache_key(key)) == capabilities:
+                return False
+            self._devices[cache_key(key)] = capabilities
+            return True
+
+    def __len__(self):
+        return len(self._devices)
+
+
+class DeviceDiscovery:
+    """Discover devices concurrently, at most ``concurrency`` at once.
+
+    The pyHik constructor asks the device for its info and trigger list
+    with blocking calls. Devices found in the cache are set up from it at
+    once and revalidated in the background, the others are discovered in
+    the executor and given up on after ``timeout`` seconds.
+    """
+
+    def __init__(self, hass, cache=None, concurrency=DEFAULT_CONCURRENCY,
+                 timeout=DEFAULT_TIMEOUT):
+        self._hass = hass
+        self.cache = cache
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.cached = 0
+        self.discovered = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.changed = 0
+
+    async def async_camera(self, key, factory):
+        """Return the HikCamera of a device or None if it can not be reached.
+
+        ``factory(discover)`` returns a new HikCamera, asking the device
+        for its capabilities only when ``discover`` is True.
+        """
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            camera = factory(False)
+            camera.apply_capabilities(cached)
+            self.cached += 1
+            self._hass.async_create_background_task(
+                self._async_revalidate(key, camera, factory, cached),
+                f'hikvisioncam revalidate {camera.name}',
+            )
+            return camera
+
+        camera = await self._async_discover(key, factory)
+        if camera is not None:
+            await self._async_store(key, camera.capabilities)
+        return camera
+
+    async def _async_discover(self, key, factory):
+        async with self._semaphore:
+            try:
+                camera = await asyncio.wait_for(
+                    self._hass.async_add_executor_job(factory, True), self.timeout)
+            except asyncio.TimeoutError:
+                # The executor job runs on until the request timeouts of pyHik
+                self.timeouts += 1
+                _LOGGING.warning('Discovery of %s:%s timed out after %ss', key[0], key[1], self.timeout)
+                return None
+        if not camera.event_states:
+            self.failed += 1
+            return None
+        self.discovered += 1
+        return camera
+
+    async def _async_revalidate(self, key, camera, factory, cached):
+        fresh = await self._async_discover(key, factory)
+        if fresh is None:
+            _LOGGING.debug('Unable to revalidate %s, keeping the cached capabilities', camera.name)
+            return
+        fresh.hik_request.close()
+        capabilities = fresh.capabilities
+        if isinstance(fresh.cam_id, uuid.UUID):
+            # pyHik makes up a random id for devices with a short deviceID
+            capabilities['cam_id'] = cached['cam_id']
+        if capabilities == cached:
+            return
+        self.changed += 1
+        camera.update_access(capabilities)
+        if any(capabilities[item] != cached[item]
+               for item in ('name', 'cam_id', 'device_type', 'triggers')):
+            _LOGGING.warning('%s changed its device info or event triggers, '
+                             'restart Home Assistant to update its sensors', camera.name)
+        await self._async_store(key, capabilities)
+
+    async def _async_store(self, key, capabilities):
+        if self.cache is not None and self.cache.put(key, capabilities):
+            await self._hass.async_add_executor_job(self.cache.save)
+
+    @property
+    def stats(self):
+        """Return the discovery counters."""
+        return {
+            'cached_devices': len(self.cache) if self.cache is not None else None,
+            'from_cache': self.cached,
+            'discovered': self.discovered,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'changed': self.changed,
+        }
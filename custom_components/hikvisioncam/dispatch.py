@@ -0,0 +1,45 @@
+"""Callback dispatch index for camera events."""
+import logging
+
+_LOGGING = logging.getLogger(__name__)
+
+
+class CallbackIndex:
+    """Subscribers keyed by (event type, channel, region).
+
+    Lookups are a single dict access whatever the number of registered
+    entities. Subscriber lists are replaced instead of mutated, so a
+    dispatch in progress is not affected by concurrent (un)subscription.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+
+    @staticmethod
+    def key(etype, channel, region=''):
+        """Return the index key of an event type, channel and region."""
+        return etype, int(channel), str(region)
+
+    def add(self, key, callback):
+        """Subscribe callback to key, returns a function unsubscribing it."""
+        self._subscribers[key] = self._subscribers.get(key, ()) + (callback,)
+        _LOGGING.debug('Added update callback to %s on %s', callback, key)
+
+        def remove():
+            self.remove(key, callback)
+        return remove
+
+    def remove(self, key, callback):
+        """Unsubscribe callback from key."""
+        callbacks = tuple(cb for cb in self._subscribers.get(key, ()) if cb != callback)
+        if callbacks:
+            self._subscribers[key] = callbacks
+        else:
+            self._subscribers.pop(key, None)
+
+    def get(self, key):
+        """Return the callbacks subscribed to key."""
+        return self._subscribers.get(key, ())
+
+    def __len__(self):
+        return sum(len(callbacks) for callbacks in self._subscribers.values())
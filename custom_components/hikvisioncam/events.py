@@ -0,0 +1,251 @@
+"""SQLite index of alert events and their snapshots."""
+import collections
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+_LOGGING = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_MAX_AGE_DAYS = 30
+PRUNE_INTERVAL = 3600
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MAX_PENDING = 10000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    camera TEXT NOT NULL,
+    channel INTEGER,
+    event_type TEXT NOT NULL,
+    region TEXT,
+    active INTEGER NOT NULL,
+    time REAL NOT NULL,
+    target TEXT,
+    box TEXT,
+    image TEXT
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE INDEX IF NOT EXISTS events_camera_time ON events (camera, time);
+CREATE INDEX IF NOT EXISTS events_type_time ON events (event_type, time);
+CREATE INDEX IF NOT EXISTS events_image ON events (image) WHERE image IS NOT NULL;
+"""
+
+_INSERT = ('INSERT INTO events (camera, channel, event_type, region, active, time, target, box) '
+           'VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+_SNAPSHOT = 'UPDATE events SET image = ? WHERE camera = ? AND time = ?'
+_FORGET = 'DELETE FROM events WHERE image = ?'
+_PRUNE = 'DELETE FROM events WHERE time < ?'
+_COLUMNS = ('id', 'camera', 'channel', 'event_type', 'region', 'active', 'time',
+            'target', 'box', 'image')
+
+
+class EventIndex:
+    """Index of events written in batches by a background thread.
+
+    ``record`` and ``snapshot`` only queue a row, so the alert stream never
+    waits on the database. Queries use their own connection, the database
+    runs in WAL mode so they do not block the writer.
+
+    Rows older than ``max_age_days`` are deleted by the writer every
+    PRUNE_INTERVAL seconds, None keeps them forever.
+    """
+
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_age_days = max_age_days
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._reader = None
+        self._read_lock = threading.Lock()
+
+        self.recorded = 0
+        self.dropped = 0
+        self.pruned = 0
+
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='HikEventIndex', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def camera(self, name):
+        """Return the index of one camera."""
+        return CameraEvents(self, name)
+
+    def record(self, camera, channel, event_type, region, active, time, target, box):
+        """Queue an event, ``time`` is a POSIX timestamp."""
+        self._queue((_INSERT, (camera, channel, event_type, str(region or ''), int(active),
+                               time, target, json.dumps(list(box)) if box else None)))
+
+    def snapshot(self, camera, time, image):
+        """Queue the snapshot path of a recorded event."""
+        self._queue((_SNAPSHOT, (image, camera, time)))
+
+    def forget(self, images):
+        """Queue the deletion of the events of deleted snapshots."""
+        for image in images:
+            self._queue((_FORGET, (image,)))
+
+    def _queue(self, op):
+        with self._cond:
+            if self._stopped:
+                return
+            if len(self._pending) >= MAX_PENDING:
+                self._pending.popleft()
+                self.dropped += 1
+            self._pending.append(op)
+            if len(self._pending) == MAX_PENDING // 2:
+                # Flush early during event storms
+                self._cond.notify()
+
+    def stop(self):
+        """Write the queued rows and stop the writer."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        with self._read_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    def _connect(self, **kwargs):
+        conn = sqlite3.connect(self.path, **kwargs)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _run(self):
+        try:
+            conn = self._connect()
+            try:
+                conn.executescript(_SCHEMA)
+            except sqlite3.Error:
+                conn.close()
+                raise
+        except sqlite3.Error as err:
+            # Raised by __init__, the writer never starts
+            self._error = err
+            return
+        finally:
+            self._ready.set()
+        next_prune = 0
+        try:
+            while True:
+                with self._cond:
+                    if not self._stopped:
+                        self._cond.wait(self.flush_interval)
+                    ops = list(self._pending)
+                    self._pending.clear()
+                    stopped = self._stopped
+                if ops:
+                    self._write(conn, ops)
+                if stopped:
+                    return
+                if self.max_age_days is not None and time.monotonic() >= next_prune:
+                    next_prune = time.monotonic() + PRUNE_INTERVAL
+                    self._write(conn, [(_PRUNE, (time.time() - self.max_age_days * 86400,))])
+        finally:
+            conn.close()
+
+    def _write(self, conn, ops):
+        try:
+            with conn:
+                # Runs of the same statement go in one executemany
+                start = 0
+                deleted = 0
+                for i in range(1, len(ops) + 1):
+                    if i == len(ops) or ops[i][0] != ops[start][0]:
+                        cursor = conn.executemany(
+                            ops[start][0], [params for _, params in ops[start:i]])
+                        if ops[start][0] in (_FORGET, _PRUNE):
+                            deleted += cursor.rowcount
+                        start = i
+        except sqlite3.Error as err:
+            _LOGGING.error('Unable to write %d events to %s: %s', len(ops), self.path, err)
+            return
+        self.recorded += sum(1 for sql, _ in ops if sql is _INSERT)
+        self.pruned += deleted
+
+    def query(self, camera=None, event_type=None, start=None, end=None,
+              limit=DEFAULT_PAGE_SIZE, cursor=None):
+        """Return (events, next_cursor), newest first, blocking.
+
+        ``start`` and ``end`` are POSIX timestamps, ``cursor`` is the
+        next_cursor of the previous page and None on the last page.
+        """
+        where = []
+        params = []
+        if camera is not None:
+            where.append('camera = ?')
+            params.append(camera)
+        if event_type is not None:
+            where.append('event_type = ?')
+            params.append(event_type)
+        if start is not None:
+            where.append('time >= ?')
+            params.append(start)
+        if end is not None:
+            where.append('time < ?')
+            params.append(end)
+        if cursor is not None:
+            time, _, row_id = cursor.partition(':')
+            where.append('(time < ? OR (time = ? AND id < ?))')
+            params.extend((float(time), float(time), int(row_id)))
+        sql = f'SELECT {", ".join(_COLUMNS)} FROM events'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY time DESC, id DESC LIMIT ?'
+        params.append(limit + 1)
+
+        with self._read_lock:
+            if self._reader is None:
+                self._reader = self._connect(check_same_thread=False)
+            rows = self._reader.execute(sql, params).fetchall()
+
+        events = []
+        for row in rows[:limit]:
+            event = dict(zip(_COLUMNS, row))
+            event['active'] = bool(event['active'])
+            event['box'] = json.loads(event['box']) if event['box'] else None
+            events.append(event)
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = f'{events[-1]["time"]!r}:{events[-1]["id"]}'
+        return events, next_cursor
+
+    @property
+    def stats(self):
+        """Return writer counters."""
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'recorded': self.recorded,
+                'dropped': self.dropped,
+                'pruned': self.pruned,
+            }
+
+
+class CameraEvents:
+    """EventIndex bound to a camera name."""
+
+    def __init__(self, index, name):
+        self._index = index
+        self.name = name
+
+    def record(self, channel, event_type, region, active, time, target, box):
+        """Queue an event of the camera."""
+        self._index.record(self.name, channel, event_type, region, active, time, target, box)
+
+    def snapshot(self, time, image):
+        """Queue the snapshot path of an event of the camera."""
+        self._index.snapshot(self.name, time, image)
@@ -0,0 +1,54 @@
+"""Deadline based expiry of active event states."""
+import heapq
+
+
+class ExpiryQueue:
+    """Min-heap of deadlines keyed by (event type, channel).
+
+    Rescheduling a key pushes a new entry and leaves the old one in the
+    heap, it is skipped when popped. Only entries that are due are ever
+    looked at, so expiry does not depend on the number of sensors.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+
+    def schedule(self, key, deadline):
+        """Set the deadline of key, replacing any previous one."""
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._compact()
+
+    def cancel(self, key):
+        """Forget key, it will not expire."""
+        self._deadlines.pop(key, None)
+
+    def pop_due(self, now):
+        """Remove and return the keys whose deadline is not after now."""
+        heap = self._heap
+        due = []
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                due.append(key)
+        return due
+
+    def next_deadline(self):
+        """Return the earliest pending deadline or None."""
+        heap = self._heap
+        while heap and self._deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _compact(self):
+        self._heap = [(deadline, key) for key, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
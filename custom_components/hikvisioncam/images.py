@@ -0,0 +1,177 @@
+"""Event snapshot persistence off the alert stream reader."""
+import collections
+import io
+import logging
+import math
+import os
+import threading
+import time
+
+from PIL import Image
+
+from .metrics import STAGE_IMAGE
+
+_LOGGING = logging.getLogger(__name__)
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_SKIP_CROP = 'skip_crop'
+POLICIES = [POLICY_DROP_OLDEST, POLICY_SKIP_CROP]
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_POLICY = POLICY_SKIP_CROP
+
+
+def crop_path(path):
+    """Return the file name of the crop saved next to a snapshot."""
+    return f'{path.removesuffix("jpg")}crop.jpg'
+
+
+def crop_image(data, box, max_size=None):
+    """Return the JPEG encoded crop of ``box`` from a JPEG snapshot.
+
+    ``box`` is the TargetRect of the event as [x, y, width, height]
+    fractions of the image. With ``max_size`` the crop is scaled down to fit
+    in a square of that many pixels, and when the full resolution crop is
+    larger than that the JPEG is decoded at a reduced DCT scale (draft mode)
+    so the full frame is never materialised.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        width, height = img.size
+        box_width = width * box[2]
+        box_height = height * box[3]
+        if max_size and max(box_width, box_height) > max_size:
+            scale = max_size / max(box_width, box_height)
+            img.draft('RGB', (math.ceil(width * scale), math.ceil(height * scale)))
+        scaled_width, scaled_height = img.size
+        left = scaled_width * box[0]
+        top = scaled_height * box[1]
+        right = scaled_width * (box[0] + box[2])
+        bottom = scaled_height * (box[1] + box[3])
+        img_crop = img.crop((left, top, right, bottom))
+    if max_size:
+        img_crop.thumbnail((max_size, max_size))
+    out = io.BytesIO()
+    img_crop.save(out, 'JPEG')
+    return out.getvalue()
+
+
+def save_image(data, path, box, max_size=None):
+    """Write an event snapshot and its crop of the target box."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    if not box:
+        return
+    try:
+        crop = crop_image(data, box, max_size)
+    except Exception as err:  # pylint: disable=broad-except
+        _LOGGING.warning('Unable to crop image %s: %s', path, err)
+        return
+    with open(crop_path(path), 'wb') as f:
+        f.write(crop)
+
+
+class ImageWorkerPool:
+    """Bounded pool of threads saving snapshots and crops.
+
+    Jobs wait in a queue of at most ``queue_size`` entries. With the
+    ``drop_oldest`` policy a full queue discards its oldest job. With
+    ``skip_crop`` jobs submitted while the queue is more than half full are
+    only written to disk, and the oldest job is dropped once it is full.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE,
+                 policy=DEFAULT_POLICY, crop_max_size=None):
+        self.queue_size = queue_size
+        self.policy = policy
+        self.crop_max_size = crop_max_size
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.crops_skipped = 0
+        self.failed = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+        self._threads = [
+            threading.Thread(target=self._run, name=f'HikImage{i}', daemon=True)
+            for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, data, path, box, metrics=None):
+        """Queue a snapshot, ``data`` must not be a view into a reused buffer.
+
+        The time taken to save it is recorded in the CameraMetrics ``metrics``.
+        """
+        with self._cond:
+            if self._stopped:
+                return False
+            self.submitted += 1
+            if box and self.policy == POLICY_SKIP_CROP \
+                    and len(self._queue) * 2 >= self.queue_size:
+                self.crops_skipped += 1
+                box = None
+            if len(self._queue) >= self.queue_size:
+                self._queue.popleft()
+                self.dropped += 1
+                _LOGGING.debug('Image queue full, dropped oldest snapshot')
+            self._queue.append((time.monotonic(), data, path, box, metrics))
+            self._cond.notify()
+        return True
+
+    def stop(self, timeout=None):
+        """Finish queued jobs and stop the workers."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    @property
+    def stats(self):
+        """Return counters and queue latency in milliseconds."""
+        with self._cond:
+            started = self.completed + self.failed
+            return {
+                'queued': len(self._queue),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'crops_skipped': self.crops_skipped,
+                'latency_avg_ms': self._latency_total / started * 1000 if started else 0.0,
+                'latency_max_ms': self._latency_max * 1000,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                queued_at, data, path, box, metrics = self._queue.popleft()
+            started = time.monotonic()
+            latency = started - queued_at
+            try:
+                save_image(data, path, box, self.crop_max_size)
+            except Exception as err:
+                _LOGGING.error('Unable to save image %s: %s', path, err)
+                ok = False
+            else:
+                ok = True
+                if metrics is not None:
+                    metrics.observe(STAGE_IMAGE, time.monotonic() - started)
+            with self._cond:
+                self._latency_total += latency
+                self._latency_max = max(self._latency_max, latency)
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
@@ -0,0 +1,143 @@
+"""Latency histograms and counters of the event pipeline."""
+import bisect
+
+STAGE_READ = 'read'
+STAGE_PARSE = 'parse'
+STAGE_IMAGE = 'image'
+STAGE_DISPATCH = 'dispatch'
+STAGE_STATE = 'state'
+STAGES = [STAGE_READ, STAGE_PARSE, STAGE_IMAGE, STAGE_DISPATCH, STAGE_STATE]
+
+# Upper bounds in seconds, doubling from 1us to about 17s
+BOUNDS = [1e-6 * 2 ** i for i in range(25)]
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Fixed log scale buckets, observing is a bisect and two additions.
+
+    Quantiles are interpolated inside their bucket, so they are exact to
+    a factor of two at worst which is plenty to see where time goes.
+    """
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        """Record one duration."""
+        self.counts[bisect.bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """Return the estimated q-quantile in seconds, 0 when empty."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = BOUNDS[i - 1] if i else 0.0
+                upper = BOUNDS[i] if i < len(BOUNDS) else BOUNDS[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return BOUNDS[-1]
+
+
+class CameraMetrics:
+    """Stage histograms and counters of one camera."""
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.bytes_read = 0
+        self.alerts = 0
+        self.parse_errors = 0
+        self.callbacks = 0
+
+    def observe(self, stage, seconds):
+        """Record the duration of a stage."""
+        self.stages[stage].observe(seconds)
+
+    def read(self, size, seconds):
+        """Record the wait for a chunk of the alert stream."""
+        self.bytes_read += size
+        self.stages[STAGE_READ].observe(seconds)
+
+    @property
+    def stats(self):
+        """Return counters and p50/p95/p99 of every stage in milliseconds."""
+        return {
+            'bytes_read': self.bytes_read,
+            'alerts': self.alerts,
+            'parse_errors': self.parse_errors,
+            'callbacks': self.callbacks,
+            'stages': {
+                stage: {
+                    'count': histogram.count,
+                    'total_ms': round(histogram.sum * 1000, 3),
+                    **{f'p{round(q * 100)}_ms': round(histogram.quantile(q) * 1000, 3)
+                       for q in QUANTILES},
+                }
+                for stage, histogram in self.stages.items()
+            },
+        }
+
+
+class PipelineMetrics:
+    """Metrics of all cameras."""
+
+    def __init__(self):
+        self._cameras = {}
+
+    def camera(self, name):
+        """Return the metrics of a camera, created on first use."""
+        metrics = self._cameras.get(name)
+        if metrics is None:
+            metrics = self._cameras[name] = CameraMetrics(name)
+        return metrics
+
+    @property
+    def stats(self):
+        """Return the stats of every camera by name."""
+        return {name: metrics.stats for name, metrics in self._cameras.items()}
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = [
+            '# HELP hikvisioncam_stage_seconds Time spent in an event pipeline stage.',
+            '# TYPE hikvisioncam_stage_seconds histogram',
+        ]
+        for name, metrics in self._cameras.items():
+            camera = _label(name)
+            for stage, histogram in metrics.stages.items():
+                labels = f'camera="{camera}",stage="{stage}"'
+                cumulative = 0
+                for bound, count in zip(BOUNDS, histogram.counts):
+                    cumulative += count
+                    lines.append(f'hikvisioncam_stage_seconds_bucket{{{labels},le="{bound:g}"}} '
+                                 f'{cumulative}')
+                lines.append(f'hikvisioncam_stage_seconds_bucket{{{labels},le="+Inf"}} '
+                             f'{histogram.count}')
+                lines.append(f'hikvisioncam_stage_seconds_sum{{{labels}}} {histogram.sum!r}')
+                lines.append(f'hikvisioncam_stage_seconds_count{{{labels}}} {histogram.count}')
+        for counter, text in (
+                ('bytes_read', 'Bytes read from the alert stream.'),
+                ('alerts', 'Alerts decoded from the alert stream.'),
+                ('parse_errors', 'Alert stream parts that could not be parsed.'),
+                ('callbacks', 'Entity callbacks called.')):
+            lines.append(f'# HELP hikvisioncam_{counter}_total {text}')
+            lines.append(f'# TYPE hikvisioncam_{counter}_total counter')
+            for name, metrics in self._cameras.items():
+                lines.append(f'hikvisioncam_{counter}_total{{camera="{_label(name)}"}} '
+                             f'{getattr(metrics, counter)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _label(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
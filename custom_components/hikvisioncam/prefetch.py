@@ -0,0 +1,103 @@
+"""Background download of event clips into the clip cache."""
+import asyncio
+import logging
+import time
+
+from .api import cache_clip, find_clip
+from .const import DATA_TRANSFERS, DOMAIN
+
+_LOGGING = logging.getLogger(__name__)
+
+DEFAULT_POST_ROLL = 10
+DEFAULT_MIN_INTERVAL = 30
+DEFAULT_MAX_CONCURRENT = 1
+
+TRIP_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class ClipPrefetcher:
+    """Fetch the clip of an event once it ended.
+
+    The lookup starts ``post_roll`` seconds after the event so the recorder
+    closed the segment. Prefetches of a camera are at least
+    ``min_interval`` seconds apart and at most ``max_concurrent`` downloads
+    run at once over all cameras, the NVR only has a few download slots.
+    """
+
+    def __init__(self, hass, clip_cache, event_types,
+                 post_roll=DEFAULT_POST_ROLL, min_interval=DEFAULT_MIN_INTERVAL,
+                 max_concurrent=DEFAULT_MAX_CONCURRENT):
+        self._hass = hass
+        self._clip_cache = clip_cache
+        self.event_types = set(event_types)
+        self.post_roll = post_roll
+        self.min_interval = min_interval
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._last = {}
+        self._tasks = set()
+
+        self.scheduled = 0
+        self.rate_limited = 0
+        self.completed = 0
+        self.not_found = 0
+        self.failed = 0
+
+    def event_ended(self, camera, etype, echid, attr):
+        """Schedule the prefetch of an ended event, callable from any thread."""
+        if etype not in self.event_types:
+            return
+        trip_time = attr.time.strftime(TRIP_TIME_FORMAT)
+        self._hass.loop.call_soon_threadsafe(self._schedule, camera, trip_time)
+
+    def _schedule(self, camera, trip_time):
+        now = time.monotonic()
+        last = self._last.get(camera.name)
+        if last is not None and now - last < self.min_interval:
+            self.rate_limited += 1
+            _LOGGING.debug('Prefetch of %s %s rate limited', camera.name, trip_time)
+            return
+        self._last[camera.name] = now
+        self.scheduled += 1
+        task = asyncio.create_task(self._prefetch(camera, trip_time))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _prefetch(self, camera, trip_time):
+        await asyncio.sleep(self.post_roll)
+        async with self._semaphore:
+            try:
+                download_name = await find_clip(self._hass, camera, trip_time)
+                if download_name is None:
+                    self.not_found += 1
+                    return
+                cid = cache_clip(self._clip_cache, self._hass.data[DOMAIN][DATA_TRANSFERS],
+                                 camera, download_name)
+                fill = self._clip_cache.filling(cid)
+                if fill is not None:
+                    await fill.wait()
+                    if fill.error is not None:
+                        self.failed += 1
+                        return
+            except Exception as err:  # pylint: disable=broad-except
+                _LOGGING.warning('Prefetch of %s %s failed: %s', camera.name, trip_time, err)
+                self.failed += 1
+                return
+            self.completed += 1
+
+    async def async_stop(self):
+        """Cancel pending prefetches."""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    @property
+    def stats(self):
+        """Return prefetch counters."""
+        return {
+            'pending': len(self._tasks),
+            'scheduled': self.scheduled,
+            'rate_limited': self.rate_limited,
+            'completed': self.completed,
+            'not_found': self.not_found,
+            'failed': self.failed,
+        }
@@ -0,0 +1,112 @@
+"""Clip transfers from the recorder with bounded buffering."""
+import asyncio
+import itertools
+import logging
+import time
+
+_LOGGING = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 256  # KiB
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_TOTAL_TIMEOUT = 600
+
+
+class Transfer:
+    """Progress of one clip transfer."""
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        """Return the average throughput in bytes per second."""
+        elapsed = self.elapsed
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+
+class ClipTransfers:
+    """Stream recordings in fixed size chunks with read and total timeouts.
+
+    At most one chunk of ``chunk_size`` bytes is held per transfer, the next
+    one is only read from the recorder once the consumer took the previous
+    one, so a slow client slows the download instead of filling memory.
+    Closing the stream early closes the upstream response right away, which
+    frees the recorder download session.
+    """
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE * 1024,
+                 read_timeout=DEFAULT_READ_TIMEOUT, total_timeout=DEFAULT_TOTAL_TIMEOUT):
+        self.chunk_size = chunk_size
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self._active = {}
+        self._ids = itertools.count()
+
+        self.completed = 0
+        self.aborted = 0
+        self.timeouts = 0
+        self.failed = 0
+        self.bytes = 0
+        self.last_rate = 0.0
+
+    async def stream(self, name, open_stream):
+        """Yield the body of the httpx stream opened by ``open_stream()``."""
+        transfer = Transfer(name)
+        tid = next(self._ids)
+        self._active[tid] = transfer
+        deadline = time.monotonic() + self.total_timeout
+        try:
+            async with open_stream() as response:
+                if response.status_code != 200:
+                    raise ValueError(f'Download failed with status {response.status_code}')
+                chunks = response.aiter_raw(self.chunk_size)
+                while True:
+                    timeout = min(self.read_timeout, deadline - time.monotonic())
+                    if timeout <= 0:
+                        raise asyncio.TimeoutError
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+                    except StopAsyncIteration:
+                        break
+                    transfer.bytes += len(chunk)
+                    yield chunk
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            _LOGGING.warning('Clip transfer %s timed out after %d bytes', name, transfer.bytes)
+            raise
+        except (GeneratorExit, asyncio.CancelledError):
+            # The consumer went away, the upstream response is closed on exit
+            self.aborted += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        else:
+            self.completed += 1
+        finally:
+            del self._active[tid]
+            self.bytes += transfer.bytes
+            self.last_rate = transfer.rate
+            _LOGGING.debug('Clip transfer %s: %d bytes in %.1fs, %.0f bytes/s',
+                           name, transfer.bytes, transfer.elapsed, transfer.rate)
+
+    @property
+    def stats(self):
+        """Return transfer counters and the throughput of running transfers."""
+        return {
+            'active': [
+                {'name': t.name, 'bytes': t.bytes, 'bytes_per_sec': round(t.rate)}
+                for t in self._active.values()],
+            'completed': self.completed,
+            'aborted': self.aborted,
+            'timeouts': self.timeouts,
+            'failed': self.failed,
+            'bytes': self.bytes,
+            'last_bytes_per_sec': round(self.last_rate),
+        }
@@ -0,0 +1,30 @@
+"""State of a sensor event as passed from the camera to its entities."""
+from dataclasses import dataclass
+import datetime
+import sys
+
+# Slots save memory per record, dataclass only adds them since Python 3.10
+_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclass(frozen=True, **_SLOTS)
+class EventRecord:
+    """One published event state.
+
+    Immutable, so the same record is handed to every subscriber and kept
+    by the camera for the snapshot that follows the alert.
+    """
+
+    active: bool
+    channel: int
+    count: int
+    time: datetime.datetime
+    region: str = ''
+    box: tuple = ()
+    target: str = 'others'
+    path: str = ''
+
+    @property
+    def region_id(self):
+        """Return the region as an int or '' when there is none."""
+        return int(self.region) if self.region.isdigit() else ''
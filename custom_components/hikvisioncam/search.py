@@ -0,0 +1,135 @@
+"""Batched ContentMgmt/search of event clips."""
+from datetime import datetime, timedelta, timezone as dt_timezone
+import logging
+import uuid
+import xml.etree.ElementTree as ET
+
+import pytz
+
+_LOGGING = logging.getLogger(__name__)
+
+SEARCH_NAMESPACE = '{http://www.hikvision.com/ver20/XMLSchema}'
+TRIP_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+ISAPI_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Windows closer than this are searched as one time span, the search
+# granularity is one second anyway.
+MERGE_GAP = timedelta(seconds=1)
+PAGE_SIZE = 40
+MAX_PAGES = 25
+
+
+def event_window(timezone, trip_time, delta):
+    """Return the UTC (start, end) searched for a local trip time string."""
+    native_time = datetime.strptime(trip_time, TRIP_TIME_FORMAT)
+    end = pytz.timezone(timezone).localize(native_time, is_dst=None).astimezone(pytz.utc)
+    return end - timedelta(seconds=delta), end
+
+
+def segment_start(playback_uri):
+    """Return the UTC start time in the query of a playbackURI or None."""
+    query = playback_uri.replace('&amp;', '&').partition('?')[2]
+    for param in query.split('&'):
+        key, _, value = param.partition('=')
+        if key.lower() == 'starttime':
+            for fmt in (ISAPI_TIME_FORMAT, '%Y%m%dT%H%M%SZ'):
+                try:
+                    return datetime.strptime(value, fmt).replace(tzinfo=dt_timezone.utc)
+                except ValueError:
+                    pass
+    return None
+
+
+def merge_windows(windows):
+    """Merge overlapping or adjacent (start, end) windows, sorted by start."""
+    merged = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1] + MERGE_GAP:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def search_description(spans, search_id, position=0, max_results=PAGE_SIZE, track_id=101):
+    """Return the CMSearchDescription of a page over several time spans."""
+    time_spans = ''.join(
+        f'<timeSpan><startTime>{start.strftime(ISAPI_TIME_FORMAT)}</startTime>'
+        f'<endTime>{end.strftime(ISAPI_TIME_FORMAT)}</endTime></timeSpan>'
+        for start, end in spans)
+    return ('<?xml version="1.0" encoding="utf-8"?><CMSearchDescription>'
+            f'<searchID>{search_id}</searchID>'
+            f'<trackIDList><trackID>{track_id}</trackID></trackIDList>'
+            f'<timeSpanList>{time_spans}</timeSpanList>'
+            f'<maxResults>{max_results}</maxResults>'
+            f'<searchResultPostion>{position}</searchResultPostion>'
+            '<metadataList><metadataDescriptor>//recordType.meta.std-cgi.com</metadataDescriptor></metadataList>'
+            '</CMSearchDescription>')
+
+
+def _parse_time(text):
+    value = datetime.fromisoformat(text.strip().replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=dt_timezone.utc)
+    return value
+
+
+def parse_search_result(xml_string):
+    """Return (segments, more, matches) of a CMSearchResult page.
+
+    Segments are (start, end, playbackURI) tuples in result order, matches
+    counts every item of the page including those without a playbackURI.
+    """
+    ns = SEARCH_NAMESPACE
+    root = ET.fromstring(xml_string)
+    segments = []
+    matches = 0
+    for item in root.iterfind(f'{ns}matchList/{ns}searchMatchItem'):
+        matches += 1
+        uri = item.findtext(f'{ns}mediaSegmentDescriptor/{ns}playbackURI')
+        if not uri:
+            continue
+        start = item.findtext(f'{ns}timeSpan/{ns}startTime')
+        end = item.findtext(f'{ns}timeSpan/{ns}endTime')
+        try:
+            segments.append((_parse_time(start), _parse_time(end), uri))
+        except (AttributeError, ValueError):
+            # No usable time span, assume it covers the whole search
+            segments.append((None, None, uri))
+    more = root.findtext(f'{ns}responseStatusStrg') == 'MORE'
+    return segments, more, matches
+
+
+def match_segment(window, segments):
+    """Return the last segment overlapping a window, like a single search."""
+    start, end = window
+    found = None
+    for segment in segments:
+        seg_start, seg_end, _ = segment
+        if seg_start is None or (seg_start <= end and seg_end >= start):
+            if found is None or found[0] is None \
+                    or (seg_start is not None and seg_start >= found[0]):
+                found = segment
+    return found
+
+
+async def search_segments(client, auth, root_url, spans):
+    """Page through the recordings of several time spans in one search."""
+    url_search = f'{root_url}/ISAPI/ContentMgmt/search'
+    search_id = str(uuid.uuid4()).upper()
+    segments = []
+    # The device counts every match item, with or without a playbackURI
+    position = 0
+    for _ in range(MAX_PAGES):
+        r = await client.post(
+            url_search, content=search_description(spans, search_id, position), auth=auth)
+        r.raise_for_status()
+        page, more, matches = parse_search_result(r.text)
+        segments.extend(page)
+        position += matches
+        if not more or not matches:
+            break
+    else:
+        _LOGGING.warning('Clip search stopped after %d results', len(segments))
+    return segments
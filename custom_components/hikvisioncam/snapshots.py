@@ -0,0 +1,48 @@
+"""Snapshots fetched on demand from the ISAPI picture endpoint."""
+import httpx
+
+from .clips import ClipLookupCache
+from .images import crop_image
+
+DEFAULT_FRAME_TTL = 1.0
+DEFAULT_FRAME_ENTRIES = 64
+
+STREAM_MAIN = 'main'
+STREAM_SUB = 'sub'
+STREAMS = {STREAM_MAIN: 1, STREAM_SUB: 2}
+FULL_FRAME = (0.0, 0.0, 1.0, 1.0)
+
+
+class FrameCache(ClipLookupCache):
+    """Recent frames by (camera, streaming channel id).
+
+    Dashboards polling a camera from several clients are served from one
+    picture request per ``ttl`` seconds, concurrent requests of a frame
+    that is not cached share a single fetch.
+    """
+
+    def __init__(self, ttl=DEFAULT_FRAME_TTL, max_entries=DEFAULT_FRAME_ENTRIES):
+        super().__init__(ttl, max_entries)
+
+
+def channel_id(channel, stream=STREAM_MAIN):
+    """Return the streaming channel id, 101 is the main stream of channel 1."""
+    return int(channel) * 100 + STREAMS[stream]
+
+
+async def fetch_frame(client, auth, root_url, stream_id):
+    """Return (content type, bytes) of a snapshot or None if the device has none."""
+    url = f'{root_url}/ISAPI/Streaming/channels/{stream_id}/picture'
+    r = await client.get(url, auth=auth)
+    if r.status_code != httpx.codes.OK:
+        return None
+    return r.headers.get('Content-Type', 'image/jpeg'), r.content
+
+
+def render_frame(data, crop=None, size=None):
+    """Return the JPEG of a frame cropped and scaled down.
+
+    ``crop`` is [x, y, width, height] fractions of the frame like the
+    TargetRect of an event, ``size`` the longest side in pixels.
+    """
+    return crop_image(data, crop or FULL_FRAME, size)
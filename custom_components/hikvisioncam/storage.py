@@ -0,0 +1,231 @@
+"""Sharded snapshot storage and its retention sweeper."""
+import datetime
+import logging
+import os
+import threading
+import time
+
+_LOGGING = logging.getLogger(__name__)
+
+LEGACY_ROOT = '/config/www/hikvision'
+DAY_FORMAT = '%Y-%m-%d'
+
+DEFAULT_SWEEP_INTERVAL = 300
+DEFAULT_SWEEP_BATCH = 500
+
+
+class SnapshotStorage:
+    """Snapshot layout ``<root>/<camera>/<YYYY-MM-DD>/``.
+
+    A directory holds one day of one camera, so no directory grows without
+    bound and retention can drop whole days.
+    """
+
+    def __init__(self, root=LEGACY_ROOT):
+        self.root = root
+
+    def directory(self, camera, time_stamp):
+        """Return the directory of the snapshots of a camera at a time."""
+        day = datetime.datetime.fromtimestamp(time_stamp).strftime(DAY_FORMAT)
+        return os.path.join(self.root, safe_name(camera), day)
+
+
+def safe_name(camera):
+    """Return a camera name usable as a directory name."""
+    name = str(camera).replace(os.sep, '_').strip('.')
+    return name or '_'
+
+
+def _day_files(path):
+    """Return [(mtime, size, path)] of the files of a day, oldest first."""
+    files = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        pass
+    files.sort()
+    return files
+
+
+class RetentionSweeper:
+    """Incrementally delete snapshots above age, size and count limits.
+
+    Every ``sweep`` deletes at most ``batch`` files, oldest days first, so
+    a large backlog is worked off over several sweeps instead of one long
+    blocking pass. File counts and sizes of past days are remembered
+    between sweeps, only recent days are listed again.
+
+    Files left directly in the root by the former flat layout are only
+    subject to ``max_age_days``. ``on_deleted(paths)`` is called with the
+    files deleted by a sweep.
+    """
+
+    def __init__(self, root, max_age_days=None, max_bytes=None, max_per_camera=None,
+                 batch=DEFAULT_SWEEP_BATCH):
+        self.root = root
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        self.max_per_camera = max_per_camera
+        self.batch = batch
+        self._days = {}
+        self._lock = threading.Lock()
+        self._removed = []
+        self.on_deleted = None
+
+        self.sweeps = 0
+        self.deleted = 0
+        self.freed = 0
+        self.last_duration = 0.0
+
+    def sweep(self):
+        """Run one bounded sweep, blocking, returns the files deleted."""
+        if not self._lock.acquire(blocking=False):
+            return 0
+        started = time.monotonic()
+        try:
+            self._budget = self.batch
+            self._removed = []
+            self._scan()
+            if self.max_age_days is not None:
+                self._sweep_age()
+            if self.max_per_camera is not None:
+                self._sweep_count()
+            if self.max_bytes is not None:
+                self._sweep_size()
+            deleted = self.batch - self._budget
+            self.sweeps += 1
+            if self._removed and self.on_deleted is not None:
+                self.on_deleted(self._removed)
+            return deleted
+        finally:
+            self.last_duration = time.monotonic() - started
+            self._lock.release()
+
+    def _scan(self):
+        """Refresh the (count, bytes) of the day directories."""
+        recent = (datetime.date.today() - datetime.timedelta(days=1)).strftime(DAY_FORMAT)
+        seen = set()
+        try:
+            cameras = [e for e in os.scandir(self.root) if e.is_dir(follow_symlinks=False)]
+        except FileNotFoundError:
+            cameras = []
+        for camera in cameras:
+            with os.scandir(camera.path) as days:
+                for day in days:
+                    if not day.is_dir(follow_symlinks=False):
+                        continue
+                    key = (camera.name, day.name)
+                    seen.add(key)
+                    # Snapshots are only added to today's directory
+                    if key not in self._days or day.name >= recent:
+                        files = _day_files(day.path)
+                        self._days[key] = [len(files), sum(f[1] for f in files)]
+        for key in set(self._days) - seen:
+            del self._days[key]
+
+    def _delete(self, key, count=None, size=None):
+        """Delete the oldest files of a day, up to a count or a size."""
+        path = os.path.join(self.root, *key)
+        freed = 0
+        removed = 0
+        for _, file_size, file_path in _day_files(path):
+            if self._budget <= 0 or (count is not None and removed >= count) \
+                    or (size is not None and freed >= size):
+                break
+            try:
+                os.unlink(file_path)
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                _LOGGING.warning('Unable to delete %s: %s', file_path, err)
+                continue
+            self._budget -= 1
+            self._removed.append(file_path)
+            removed += 1
+            freed += file_size
+        self.deleted += removed
+        self.freed += freed
+        stats = self._days[key]
+        stats[0] -= removed
+        stats[1] -= freed
+        if stats[0] <= 0:
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+            else:
+                del self._days[key]
+        return removed
+
+    def _sweep_age(self):
+        cutoff_day = datetime.date.today() - datetime.timedelta(days=self.max_age_days)
+        cutoff = cutoff_day.strftime(DAY_FORMAT)
+        for key in sorted(k for k in self._days if k[1] < cutoff):
+            if self._budget <= 0:
+                return
+            self._delete(key)
+
+        # Flat layout leftovers, by modification time
+        cutoff_time = time.mktime(cutoff_day.timetuple())
+        try:
+            with os.scandir(self.root) as entries:
+                for entry in entries:
+                    if self._budget <= 0:
+                        return
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                        if stat.st_mtime >= cutoff_time:
+                            continue
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        continue
+                    except OSError as err:
+                        _LOGGING.warning('Unable to delete %s: %s', entry.path, err)
+                        continue
+                    self._removed.append(entry.path)
+                    self._budget -= 1
+                    self.deleted += 1
+                    self.freed += stat.st_size
+        except FileNotFoundError:
+            pass
+
+    def _sweep_count(self):
+        per_camera = {}
+        for key, (count, _) in self._days.items():
+            per_camera[key[0]] = per_camera.get(key[0], 0) + count
+        for camera, count in per_camera.items():
+            excess = count - self.max_per_camera
+            for key in sorted(k for k in self._days if k[0] == camera):
+                if excess <= 0 or self._budget <= 0:
+                    break
+                excess -= self._delete(key, count=excess)
+
+    def _sweep_size(self):
+        excess = sum(size for _, size in self._days.values()) - self.max_bytes
+        # Oldest day over all cameras first
+        for key in sorted(self._days, key=lambda k: (k[1], k[0])):
+            if excess <= 0 or self._budget <= 0:
+                break
+            before = self._days[key][1]
+            self._delete(key, size=excess)
+            excess -= before - self._days.get(key, (0, 0))[1]
+
+    @property
+    def stats(self):
+        """Return usage and sweep counters."""
+        days = list(self._days.values())
+        return {
+            'files': sum(count for count, _ in days),
+            'bytes': sum(size for _, size in days),
+            'days': len(days),
+            'sweeps': self.sweeps,
+            'deleted': self.deleted,
+            'freed': self.freed,
+            'last_sweep_ms': round(self.last_duration * 1000, 1),
+        }
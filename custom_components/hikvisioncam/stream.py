@@ -0,0 +1,431 @@
+"""Incremental parsing of the Hikvision alertStream."""
+from __future__ import annotations
+
+import functools
+import logging
+import time
+from typing import NamedTuple
+import xml.etree.ElementTree as ET
+
+from pyhik.constants import ID_TYPES, XML_NAMESPACE
+
+_LOGGING = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 16384
+MAX_HEADER_SIZE = 8192
+# XML parts up to this size are buffered and parsed in one go, which is
+# cheaper than the streaming parser, larger ones are streamed.
+MAX_BUFFERED_XML = 65536
+
+_HEADER_END = b'\r\n\r\n'
+
+
+def parse_boundary(content_type):
+    """Return the multipart boundary declared in a Content-Type header."""
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'boundary':
+            return value.strip('"')
+    return None
+
+
+class MultipartParser:
+    """Incremental multipart/mixed parser.
+
+    Raw bytes are fed in chunks of any size. Every complete part is handed
+    to ``on_part(content_type, body)`` where ``body`` is a memoryview into
+    the parser buffer: it is only valid for the duration of the call and
+    must be copied if it has to outlive it.
+
+    When ``open_part(content_type, length)`` is given and returns a sink for
+    a part, the body is not buffered but passed to ``sink.feed(view)`` as it
+    arrives, followed by ``sink.close()`` at the end of the part. ``length``
+    is None when the part has no Content-Length.
+    """
+
+    def __init__(self, on_part, boundary=None, open_part=None):
+        self._on_part = on_part
+        self._open_part = open_part
+        self._buffer = bytearray()
+        self._delimiter = None
+        self._part = None
+        self._sink = None
+        self._remaining = 0
+        if boundary:
+            self._set_boundary(boundary.encode('latin-1'))
+
+    def _set_boundary(self, boundary):
+        if boundary.startswith(b'--'):
+            boundary = boundary[2:]
+        self._delimiter = b'\r\n--' + boundary
+
+    def reset(self):
+        """Drop any partially received part."""
+        self._buffer.clear()
+        self._part = None
+        self._sink = None
+
+    def feed(self, data):
+        """Consume a chunk of the stream and dispatch finished parts."""
+        buf = self._buffer
+        buf += data
+        pos = 0
+        try:
+            while True:
+                if self._part is None:
+                    # Devices pad some parts with extra CRLFs
+                    while buf.startswith(b'\r\n', pos):
+                        pos += 2
+                    end = buf.find(_HEADER_END, pos)
+                    if end == -1:
+                        if len(buf) - pos > MAX_HEADER_SIZE:
+                            _LOGGING.warning('Discarding %d bytes of unparsable stream data',
+                                             len(buf) - pos)
+                            pos = len(buf)
+                        break
+                    part = self._parse_headers(bytes(buf[pos:end]))
+                    pos = end + len(_HEADER_END)
+                    if part is None:
+                        # No boundary line, padding rather than a part
+                        continue
+                    self._part = part
+                    content_type, length = part
+                    if self._open_part is not None and content_type is not None:
+                        self._sink = self._open_part(content_type, length)
+                        self._remaining = length
+
+                if self._sink is not None:
+                    pos = self._stream(buf, pos)
+                    if self._sink is not None:
+                        break
+                    continue
+
+                content_type, length = self._part
+                if length is not None:
+                    if len(buf) - pos < length:
+                        break
+                    body_end = pos + length
+                else:
+                    # No Content-Length, the body runs up to the next boundary
+                    body_end = buf.find(self._delimiter or b'\r\n--', pos)
+                    if body_end == -1:
+                        break
+
+                self._part = None
+                if content_type is not None:
+                    self._dispatch(buf, content_type, pos, body_end)
+                pos = body_end
+        finally:
+            if pos:
+                del buf[:pos]
+
+    def _stream(self, buf, pos):
+        """Pass the available body of a streamed part to its sink."""
+        sink = self._sink
+        if self._remaining is not None:
+            end = min(len(buf), pos + self._remaining)
+            self._remaining -= end - pos
+            done = not self._remaining
+        else:
+            delimiter = self._delimiter or b'\r\n--'
+            end = buf.find(delimiter, pos)
+            done = end != -1
+            if not done:
+                # Hold back what could be the start of the delimiter
+                end = max(pos, len(buf) - len(delimiter) + 1)
+        if end > pos:
+            with memoryview(buf) as view:
+                body = view[pos:end]
+                try:
+                    sink.feed(body)
+                finally:
+                    body.release()
+        if done:
+            self._part = None
+            self._sink = None
+            sink.close()
+        return end
+
+    def _dispatch(self, buf, content_type, start, end):
+        with memoryview(buf) as view:
+            body = view[start:end]
+            try:
+                self._on_part(content_type, body)
+            finally:
+                body.release()
+
+    def _parse_headers(self, block):
+        """Return (content_type, content_length) from a part header block.
+
+        Returns None for a block without a boundary line.
+        """
+        content_type = None
+        length = None
+        boundary = False
+        for line in block.split(b'\r\n'):
+            if not line:
+                continue
+            if line.startswith(b'--'):
+                if self._delimiter is None:
+                    self._set_boundary(line.strip())
+                boundary = True
+                continue
+            name, sep, value = line.partition(b':')
+            if not sep:
+                continue
+            name = name.strip().lower()
+            if name == b'content-type':
+                content_type = value.strip().decode('latin-1').lower()
+            elif name == b'content-length':
+                try:
+                    length = int(value)
+                except ValueError:
+                    _LOGGING.error('Can not parse content length %r', value)
+        if not boundary:
+            return None
+        return content_type, length
+
+
+class AlertEvent(NamedTuple):
+    """Fields of one EventNotificationAlert."""
+
+    event_type: str
+    active: bool
+    channel: int | None
+    count: int
+    region_id: str = ''
+    box: tuple = ()
+    target: str = 'others'
+
+
+_EVENT_FIELDS = ('eventType', 'eventState', 'activePostCount', *ID_TYPES)
+_REGION_FIELDS = ('regionID', 'detectionTarget')
+
+
+def alert_namespace(root_tag):
+    """Return the namespace of an alert the way pyHik resolves it."""
+    nmsp = root_tag.split('}')[0].strip('{')
+    return nmsp if nmsp.startswith('http') else XML_NAMESPACE
+
+
+@functools.lru_cache(maxsize=8)
+def alert_tags(namespace):
+    """Map fully qualified alert tags of a namespace to field names."""
+    prefix = '{%s}' % namespace
+    return {prefix + name: name for name in
+            (*_EVENT_FIELDS, *_REGION_FIELDS, 'DetectionRegionList',
+             'DetectionRegionEntry', 'TargetRect')}
+
+
+def build_event(fields, region, box):
+    """Return the AlertEvent of extracted field texts.
+
+    ``region`` holds the texts of the first DetectionRegionEntry and ``box``
+    the texts of its TargetRect leaves. Raises KeyError when a required
+    field is missing and ValueError when it can not be converted.
+    """
+    channel = None
+    for idtype in ID_TYPES:
+        try:
+            # Need to make sure this is actually a number
+            channel = int(fields[idtype])
+            break
+        except (KeyError, ValueError, TypeError):
+            # Field must be absent, not an integer or blank
+            pass
+
+    event = AlertEvent(fields['eventType'].lower(),
+                       fields['eventState'] == 'active',
+                       channel,
+                       int(fields['activePostCount']))
+    # All three are needed, otherwise the event has no usable region.
+    if box is None or 'regionID' not in region or 'detectionTarget' not in region:
+        return event
+    try:
+        box = tuple(float(text) for text in box)
+    except (TypeError, ValueError):
+        return event
+    return event._replace(region_id=region['regionID'], box=box,
+                          target=region['detectionTarget'])
+
+
+class AlertDecoder:
+    """Single pass EventNotificationAlert decoder for parsed trees.
+
+    Fully qualified tag names are resolved once per namespace, so decoding
+    is one walk over the top level elements and the first detection region
+    with dict lookups instead of building a query for every field.
+    """
+
+    def __init__(self):
+        self.namespace = None
+        self._tags = {}
+
+    def decode(self, tree):
+        """Return the AlertEvent of a parsed EventNotificationAlert."""
+        if self.namespace is None:
+            self.namespace = alert_namespace(tree.tag)
+            self._tags = alert_tags(self.namespace)
+        tags = self._tags
+
+        fields = {}
+        entry = None
+        for child in tree:
+            name = tags.get(child.tag)
+            if name is None:
+                continue
+            if name == 'DetectionRegionList':
+                if entry is None and len(child):
+                    entry = child[0]
+            else:
+                fields[name] = child.text
+
+        region = {}
+        box = None
+        if entry is not None:
+            for child in entry:
+                name = tags.get(child.tag)
+                if name == 'TargetRect':
+                    box = [q.text for q in child.iter() if not len(q)]
+                elif name is not None:
+                    region[name] = child.text
+        return build_event(fields, region, box)
+
+
+class AlertParser:
+    """Streaming EventNotificationAlert decoder.
+
+    Used as the target of an expat driven XMLParser, so no tree and no
+    intermediate strings are built: only the text of the fields of interest
+    is kept and ``on_event(event)`` is called as soon as the root element
+    closes. Memory use does not depend on the size of the alert.
+
+    ``on_parsed(seconds)``, when given, receives the time spent parsing an
+    alert before its ``on_event`` call.
+    """
+
+    def __init__(self, on_event, on_parsed=None):
+        self._on_event = on_event
+        self._on_parsed = on_parsed
+        self.namespace = None
+        self._tags = {}
+        self._parser = None
+        self._reset()
+
+    def _reset(self):
+        self._elapsed = 0.0
+        self._started = 0.0
+        self._failed = False
+        self._depth = 0
+        self._fields = {}
+        self._region = {}
+        self._box = None
+        self._in_rect = False
+        self._in_region = False
+        self._entry_seen = False
+        self._in_entry = False
+        self._text = None
+        self._text_depth = 0
+
+    def open(self, content_type=None, length=None):
+        """Start a new alert document, returns the sink for its bytes."""
+        self._reset()
+        self._parser = ET.XMLParser(target=self)
+        return self
+
+    def feed(self, data):
+        """Feed raw bytes of the current document."""
+        if self._failed:
+            return
+        self._started = time.perf_counter()
+        try:
+            self._parser.feed(data)
+        except ET.ParseError as err:
+            _LOGGING.warning('XML parse error in stream: %s', err)
+            self._failed = True
+        self._elapsed += time.perf_counter() - self._started
+
+    def close(self):
+        """End of the current document."""
+        parser, self._parser = self._parser, None
+        if self._failed or parser is None:
+            return
+        self._started = time.perf_counter()
+        try:
+            parser.close()
+        except ET.ParseError as err:
+            _LOGGING.warning('XML parse error in stream: %s', err)
+
+    # XMLParser target interface
+
+    def start(self, tag, attrib):
+        self._depth += 1
+        depth = self._depth
+        if self._text is not None:
+            return
+        if depth == 1:
+            if self.namespace is None:
+                self.namespace = alert_namespace(tag)
+                self._tags = alert_tags(self.namespace)
+            return
+        name = self._tags.get(tag)
+        if depth == 2:
+            if name == 'DetectionRegionList':
+                self._in_region = True
+            elif name is not None:
+                self._capture(depth)
+        elif self._in_region and depth == 3:
+            # Only the first entry is reported
+            self._in_entry = name == 'DetectionRegionEntry' and not self._entry_seen
+            self._entry_seen = True
+        elif self._in_entry:
+            if depth == 4:
+                if name == 'TargetRect':
+                    self._box = []
+                    self._in_rect = True
+                elif name in _REGION_FIELDS:
+                    self._capture(depth)
+            elif depth == 5 and self._in_rect:
+                self._capture(depth)
+
+    def _capture(self, depth):
+        self._text = []
+        self._text_depth = depth
+
+    def data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+    def end(self, tag):
+        depth = self._depth
+        self._depth -= 1
+        text = self._text
+        if text is not None:
+            if depth != self._text_depth:
+                return
+            self._text = None
+            text = ''.join(text)
+            if depth == 2:
+                self._fields[self._tags[tag]] = text
+            elif depth == 4:
+                self._region[self._tags[tag]] = text
+            else:
+                self._box.append(text)
+        elif depth == 2:
+            self._in_region = False
+        elif depth == 3:
+            self._in_entry = False
+        elif depth == 4:
+            self._in_rect = False
+        elif depth == 1:
+            self._emit()
+
+    def _emit(self):
+        try:
+            event = build_event(self._fields, self._region, self._box)
+        except (AttributeError, KeyError, ValueError) as err:
+            _LOGGING.error('Problem finding attribute: %s', err)
+            return
+        if self._on_parsed is not None:
+            self._on_parsed(self._elapsed + time.perf_counter() - self._started)
+        self._on_event(event)
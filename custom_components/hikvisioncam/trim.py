@@ -0,0 +1,414 @@
+"""Cut recordings to an event window without re-encoding.
+
+Recorders answer ContentMgmt/download with whole segments, either as MP4
+or as a Hikvision MPEG program stream (PS). Both are cut on keyframes by
+rewriting only the container: a TrimPlan is the new file header followed
+by byte ranges of the original file, so the media data is streamed from
+disk as it is.
+"""
+import asyncio
+import logging
+import mmap
+import struct
+from typing import NamedTuple
+
+_LOGGING = logging.getLogger(__name__)
+
+# Boxes holding other boxes that have to be walked to reach the sample tables
+_CONTAINERS = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+_HIK_HEADER = b'IMKH'
+_HIK_HEADER_SIZE = 40
+_PS_CLOCK = 90000
+DEFAULT_TRIM_POST_ROLL = 10
+READ_SIZE = 65536
+
+
+class TrimPlan(NamedTuple):
+    """A trimmed file, ``header`` followed by ``ranges`` of the source."""
+
+    header: bytes
+    ranges: list
+
+    @property
+    def size(self):
+        return len(self.header) + sum(length for _, length in self.ranges)
+
+
+def trim_plan(path, start, end):
+    """Return the TrimPlan of seconds ``start`` to ``end`` of a recording.
+
+    Returns None when the format is not supported or nothing would be cut,
+    the recording is then served whole.
+    """
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return None
+    try:
+        if data[:4] == _HIK_HEADER or data[:4] == b'\x00\x00\x01\xba':
+            return _trim_ps(data, start, end)
+        return _trim_mp4(data, start, end)
+    except (IndexError, KeyError, ValueError, struct.error) as err:
+        _LOGGING.warning('Unable to trim %s: %s', path, err)
+        return None
+    finally:
+        data.close()
+
+
+async def iter_plan(path, plan):
+    """Yield the bytes of a TrimPlan, reading the source in the executor."""
+    loop = asyncio.get_running_loop()
+    yield plan.header
+    with open(path, 'rb') as f:
+        for offset, length in plan.ranges:
+            f.seek(offset)
+            while length > 0:
+                chunk = await loop.run_in_executor(None, f.read, min(READ_SIZE, length))
+                if not chunk:
+                    raise ValueError(f'{path} is shorter than planned')
+                length -= len(chunk)
+                yield chunk
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for offset, length in ranges:
+        if merged and merged[-1][0] + merged[-1][1] == offset:
+            merged[-1] = (merged[-1][0], merged[-1][1] + length)
+        else:
+            merged.append((offset, length))
+    return merged
+
+
+# MPEG program stream
+
+def _scr(data, pos):
+    """Return the system clock reference base of the pack header at pos."""
+    b4, b5, b6, b7, b8 = data[pos + 4:pos + 9]
+    return (((b4 & 0x38) << 27) | ((b4 & 0x03) << 28) | (b5 << 20)
+            | ((b6 & 0xf8) << 12) | ((b6 & 0x03) << 13) | (b7 << 5) | (b8 >> 3))
+
+
+def _ps_packs(data, pos):
+    """Yield (offset, scr, keyframe) of the packs of a program stream.
+
+    Hikvision streams put a system header or a stream map in front of every
+    keyframe, so a pack containing one starts a keyframe.
+    """
+    size = len(data)
+    pack = None
+    while pos + 6 <= size:
+        if data[pos:pos + 3] != b'\x00\x00\x01':
+            pos = data.find(b'\x00\x00\x01', pos + 1)
+            if pos == -1:
+                break
+            continue
+        code = data[pos + 3]
+        if code == 0xba:
+            if pack is not None:
+                yield pack
+            pack = [pos, _scr(data, pos), False]
+            pos += 14 + (data[pos + 13] & 0x07)
+        elif code == 0xb9:
+            # Program end
+            break
+        else:
+            if code in (0xbb, 0xbc) and pack is not None:
+                pack[2] = True
+            pos += 6 + int.from_bytes(data[pos + 4:pos + 6], 'big')
+    if pack is not None:
+        yield pack
+
+
+def _trim_ps(data, start, end):
+    header = b''
+    pos = 0
+    if data[:4] == _HIK_HEADER:
+        header = bytes(data[:_HIK_HEADER_SIZE])
+        pos = _HIK_HEADER_SIZE
+
+    first = None
+    cut_start = None
+    cut_end = None
+    for offset, scr, keyframe in _ps_packs(data, pos):
+        if first is None:
+            first = scr
+        elapsed = ((scr - first) % (1 << 33)) / _PS_CLOCK
+        if elapsed > end:
+            cut_end = offset
+            break
+        if keyframe and (elapsed <= start or cut_start is None):
+            cut_start = offset
+    if cut_start is None:
+        return None
+    if cut_end is None:
+        cut_end = len(data)
+    if cut_start == pos and cut_end == len(data):
+        return None
+    return TrimPlan(header, [(cut_start, cut_end - cut_start)])
+
+
+# MP4
+
+def _boxes(data, pos, end):
+    """Yield (type, start, payload_start, end) of the boxes in a range."""
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise ValueError(f'Bad {kind!r} box size {size}')
+        yield kind, pos, pos + header, pos + size
+        pos += size
+
+
+def _parse_tree(data, pos, end):
+    """Return the boxes of a range as [type, payload or children] nodes."""
+    tree = []
+    for kind, _, payload, box_end in _boxes(data, pos, end):
+        if kind in _CONTAINERS:
+            tree.append([kind, _parse_tree(data, payload, box_end)])
+        else:
+            tree.append([kind, bytes(data[payload:box_end])])
+    return tree
+
+
+def _serialize(tree):
+    out = []
+    for kind, body in tree:
+        if isinstance(body, list):
+            body = _serialize(body)
+        out.append(struct.pack('>I4s', len(body) + 8, kind))
+        out.append(body)
+    return b''.join(out)
+
+
+def _child(node, kind):
+    for child in node[1]:
+        if child[0] == kind:
+            return child
+    return None
+
+
+def _table(payload, fmt, header=8):
+    """Return the entries of a full box table with an entry count."""
+    count = struct.unpack_from('>I', payload, header - 4)[0]
+    item = struct.calcsize(fmt)
+    return [struct.unpack_from(fmt, payload, header + i * item) for i in range(count)]
+
+
+class _Track:
+    """Sample table of one trak box."""
+
+    def __init__(self, trak):
+        self.trak = trak
+        mdia = _child(trak, b'mdia')
+        self.handler = _child(mdia, b'hdlr')[1][8:12]
+        mdhd = _child(mdia, b'mdhd')[1]
+        self.timescale = struct.unpack_from('>I', mdhd, 20 if mdhd[0] == 1 else 12)[0]
+        self.stbl = _child(_child(mdia, b'minf'), b'stbl')
+        tables = {kind: body for kind, body in self.stbl[1]}
+
+        sizes = tables[b'stsz']
+        sample_size, count = struct.unpack_from('>II', sizes, 4)
+        if sample_size:
+            self.sizes = [sample_size] * count
+        else:
+            self.sizes = list(struct.unpack_from(f'>{count}I', sizes, 12))
+
+        if b'co64' in tables:
+            chunks = [o for o, in _table(tables[b'co64'], '>Q')]
+        else:
+            chunks = [o for o, in _table(tables[b'stco'], '>I')]
+
+        # Expand sample to chunk runs into per sample offsets and descriptions
+        self.offsets = []
+        self.descriptions = []
+        runs = _table(tables[b'stsc'], '>III')
+        for i, (first, per_chunk, description) in enumerate(runs):
+            last = runs[i + 1][0] if i + 1 < len(runs) else len(chunks) + 1
+            for chunk in range(first, last):
+                offset = chunks[chunk - 1]
+                for _ in range(per_chunk):
+                    if len(self.offsets) == count:
+                        break
+                    self.offsets.append(offset)
+                    self.descriptions.append(description)
+                    offset += self.sizes[len(self.offsets) - 1]
+
+        self.times = []
+        self.deltas = []
+        time = 0
+        for run, delta in _table(tables[b'stts'], '>II'):
+            for _ in range(run):
+                self.times.append(time)
+                self.deltas.append(delta)
+                time += delta
+
+        self.composition = None
+        if b'ctts' in tables:
+            self.composition = []
+            self.composition_version = tables[b'ctts'][0]
+            # Version 1 offsets are signed, version 0 ones never get that large
+            for run, offset in _table(tables[b'ctts'], '>Ii'):
+                self.composition.extend([offset] * run)
+
+        self.sync = None
+        if b'stss' in tables:
+            self.sync = {n - 1 for n, in _table(tables[b'stss'], '>I')}
+
+        if not len(self.sizes) == len(self.offsets) == len(self.times):
+            raise ValueError('Inconsistent sample tables')
+
+    def keyframe_before(self, seconds):
+        """Return the time of the last sync sample at or before seconds."""
+        limit = seconds * self.timescale
+        found = 0
+        for i, time in enumerate(self.times):
+            if time > limit:
+                break
+            if self.sync is None or i in self.sync:
+                found = time
+        return found / self.timescale
+
+    def select(self, start, end):
+        """Return the indices of the samples decoded in [start, end)."""
+        first = start * self.timescale
+        last = end * self.timescale
+        return [i for i, time in enumerate(self.times) if first <= time < last]
+
+
+def _run_lengths(values):
+    runs = []
+    for value in values:
+        if runs and runs[-1][1] == value:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, value])
+    return runs
+
+
+def _full_box(entries, fmt, version=0):
+    body = [struct.pack('>BxxxI', version, len(entries))]
+    body.extend(struct.pack(fmt, *entry) for entry in entries)
+    return b''.join(body)
+
+
+def _rebuild_stbl(track, samples, chunk_offsets, large):
+    """Return the stbl children of the selected samples, one chunk each."""
+    stbl = []
+    for kind, body in track.stbl[1]:
+        if kind == b'stsd':
+            stbl.append([kind, body])
+    stbl.append([b'stts', _full_box(
+        _run_lengths(track.deltas[i] for i in samples), '>II')])
+    if track.composition is not None:
+        stbl.append([b'ctts', _full_box(
+            _run_lengths(track.composition[i] for i in samples), '>Ii',
+            track.composition_version)])
+    if track.sync is not None:
+        stbl.append([b'stss', _full_box(
+            [(n + 1,) for n, i in enumerate(samples) if i in track.sync], '>I')])
+    runs = []
+    for n, i in enumerate(samples):
+        if not runs or runs[-1][2] != track.descriptions[i]:
+            runs.append((n + 1, 1, track.descriptions[i]))
+    stbl.append([b'stsc', _full_box(runs, '>III')])
+    sizes = [track.sizes[i] for i in samples]
+    stbl.append([b'stsz', struct.pack('>III', 0, 0, len(sizes))
+                 + struct.pack(f'>{len(sizes)}I', *sizes)])
+    if large:
+        stbl.append([b'co64', _full_box([(o,) for o in chunk_offsets], '>Q')])
+    else:
+        stbl.append([b'stco', _full_box([(o,) for o in chunk_offsets], '>I')])
+    return stbl
+
+
+def _set_duration(payload, offset_v0, offset_v1, duration):
+    """Return a mvhd/tkhd/mdhd payload with a new duration."""
+    payload = bytearray(payload)
+    if payload[0] == 1:
+        struct.pack_into('>Q', payload, offset_v1, duration)
+    else:
+        struct.pack_into('>I', payload, offset_v0, min(duration, 0xffffffff))
+    return bytes(payload)
+
+
+def _trim_mp4(data, start, end):
+    top = {}
+    for kind, box_start, payload, box_end in _boxes(data, 0, len(data)):
+        top.setdefault(kind, (box_start, payload, box_end))
+    if b'moov' not in top or b'moof' in top:
+        # Fragmented files are not supported
+        return None
+    ftyp = b''
+    if b'ftyp' in top:
+        ftyp = bytes(data[top[b'ftyp'][0]:top[b'ftyp'][2]])
+    moov = [b'moov', _parse_tree(data, top[b'moov'][1], top[b'moov'][2])]
+    if _child(moov, b'mvex') is not None:
+        return None
+
+    traks = [child for child in moov[1] if child[0] == b'trak']
+    tracks = [_Track(trak) for trak in traks]
+    video = next((t for t in tracks if t.handler == b'vide'), None)
+    if video is None or not video.times:
+        return None
+    start = video.keyframe_before(start)
+
+    selected = [track.select(start, end) for track in tracks]
+    if all(len(s) == len(t.times) for s, t in zip(selected, tracks)):
+        return None
+
+    # Interleave the samples of all tracks by decode time
+    order = sorted(
+        ((track.times[i] / track.timescale, n, i)
+         for n, (track, samples) in enumerate(zip(tracks, selected)) for i in samples))
+    data_size = sum(tracks[n].sizes[i] for _, n, i in order)
+
+    mvhd = _child(moov, b'mvhd')
+    movie_timescale = struct.unpack_from('>I', mvhd[1], 20 if mvhd[1][0] == 1 else 12)[0]
+
+    def build(mdat_start, large):
+        offsets = [[] for _ in tracks]
+        position = mdat_start
+        for _, n, i in order:
+            offsets[n].append(position)
+            position += tracks[n].sizes[i]
+        movie_duration = 0
+        for track, trak, samples, chunk_offsets in zip(tracks, traks, selected, offsets):
+            duration = sum(track.deltas[i] for i in samples)
+            movie_duration = max(movie_duration,
+                                 duration * movie_timescale // track.timescale)
+            mdia = _child(trak, b'mdia')
+            mdhd = _child(mdia, b'mdhd')
+            mdhd[1] = _set_duration(mdhd[1], 16, 24, duration)
+            tkhd = _child(trak, b'tkhd')
+            tkhd[1] = _set_duration(tkhd[1], 20, 28,
+                                    duration * movie_timescale // track.timescale)
+            # Edit lists refer to the old timeline
+            trak[1] = [child for child in trak[1] if child[0] != b'edts']
+            track.stbl[1] = _rebuild_stbl(track, samples, chunk_offsets, large)
+        mvhd[1] = _set_duration(mvhd[1], 16, 24, movie_duration)
+        return _serialize([moov])
+
+    # 32 bit chunk offsets unless the file gets too large for them
+    large = False
+    while True:
+        mdat_start = len(ftyp) + len(build(0, large)) + (16 if large else 8)
+        if large or mdat_start + data_size <= 0xffffffff:
+            break
+        large = True
+    moov_bytes = build(mdat_start, large)
+    if large:
+        mdat = struct.pack('>I4sQ', 1, b'mdat', data_size + 16)
+    else:
+        mdat = struct.pack('>I4s', data_size + 8, b'mdat')
+
+    ranges = _merge_ranges((tracks[n].offsets[i], tracks[n].sizes[i]) for _, n, i in order)
+    return TrimPlan(ftyp + moov_bytes + mdat, ranges)
@@ -1,12 +1,28 @@
 import pyhik.hikvision
 
+import asyncio
 import datetime
+import http.client
 import logging
 import time
-from PIL import Image
-import io
-import threading
+import socket
+import urllib.parse
+import httpx
 import requests
+import urllib3
+from requests.auth import HTTPDigestAuth
+
+from .backoff import PROBE_INTERVAL, PROBE_TIMEOUT, ReconnectBackoff
+from .coalesce import PublishCoalescer
+from .dispatch import CallbackIndex
+from .expiry import ExpiryQueue
+from .images import save_image
+from .metrics import STAGE_DISPATCH, STAGE_IMAGE, STAGE_PARSE
+from .record import EventRecord
+from .storage import LEGACY_ROOT
+from .stream import (
+    MAX_BUFFERED_XML, READ_CHUNK_SIZE, AlertDecoder, AlertParser, MultipartParser,
+    parse_boundary)
 
 
 try:
@@ -29,12 +45,49 @@ from pyhik.constants import (
 
 _LOGGING = logging.getLogger(__name__)
 
+DEFAULT_STALE_AFTER = 5
+
 REGION_IDS = [1, 2, 3, 4]
 REGION_SENSORS = ['Line Crossing',
                   'Entering Region',
                   ]
 
 
+def iter_raw(stream, chunk_size=READ_CHUNK_SIZE):
+    """Yield whatever bytes are available on a streamed response."""
+    # read1 returns as soon as any data arrived instead of waiting for a
+    # full chunk, urllib3 before 2.0 has no read1 and reads whole chunks.
+    read = getattr(stream.raw, 'read1', None)
+    if read is None:
+        yield from stream.raw.stream(chunk_size, decode_content=False)
+        return
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def connect_failed(err):
+    """Return True if err means the device did not accept the connection.
+
+    Resets, protocol errors and read timeouts come from a device that
+    answered, probing it tells nothing new.
+    """
+    if isinstance(err, (httpx.ConnectError, httpx.ConnectTimeout,
+                        requests.exceptions.ConnectTimeout,
+                        urllib3.exceptions.NewConnectionError)):
+        return True
+    # requests wraps the urllib3 error in a MaxRetryError
+    reason = None
+    if isinstance(err, requests.exceptions.ConnectionError) and err.args:
+        reason = err.args[0]
+    if isinstance(reason, urllib3.exceptions.MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError,
+                               urllib3.exceptions.ConnectTimeoutError))
+
+
 def box_normalization(box):
     if not box:
         return None
@@ -54,27 +107,131 @@ def box_normalization(box):
         return [x[0], y[0], x[-1], y[-1]]
 
 
+class AsyncWatchdog:
+    """Watchdog timer running on the event loop instead of a Timer thread."""
+
+    def __init__(self, timeout, handler):
+        self.time = timeout
+        self.handler = handler
+        self._timer = None
+
+    def start(self):
+        """Start the watchdog timer."""
+        self._timer = asyncio.get_running_loop().call_later(self.time, self.handler)
+
+    def pet(self):
+        """Reset watchdog timer."""
+        self.stop()
+        self.start()
+
+    def stop(self):
+        """Stop the watchdog timer."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
 class HikCamera(pyhik.hikvision.HikCamera):
     def __init__(self, host=None, port=DEFAULT_PORT,
-                 usr=None, pwd=None, verify_ssl=True):
+                 usr=None, pwd=None, verify_ssl=True, discover=True):
+        # Without discover nothing is asked from the device, the caller
+        # sets it up with apply_capabilities
+        self._discover = discover
         super(HikCamera, self).__init__(host, port, usr, pwd, verify_ssl)
         self.curent_event_region = {}
-        self.current_attr = []
+        self.current_event = None
+        self.image_pool = None
+        self.event_index = None
+        self.storage = None
+        self.metrics = None
+        self.on_event_end = None
+        self._tripped = set()
+        self._loop = None
+        self._httpx_auth = None
+        self._decoder = AlertDecoder()
+        self._alert_parser = AlertParser(self._process_alert, self._observe_parse)
+        self._callbacks = CallbackIndex()
+        self._expiry = ExpiryQueue()
+        self.coalescer = PublishCoalescer()
+        self.backoff = ReconnectBackoff()
+        self._stale_timer = None
+        self.stale_after = {}
+
+    def initialize(self):
+        """Initialize deviceInfo and available events when discovering."""
+        if self._discover:
+            super(HikCamera, self).initialize()
+
+    @property
+    def capabilities(self):
+        """Return the device info and event triggers found by discovery."""
+        return {
+            'name': self.name,
+            'cam_id': str(self.cam_id),
+            'device_type': self.device_type,
+            'digest': isinstance(self.hik_request.auth, HTTPDigestAuth),
+            'namespace': {context: self.namespace[context]
+                          for context in (CONTEXT_INFO, CONTEXT_TRIG)},
+            'triggers': {sensor: [channel[1] for channel in channels]
+                         for sensor, channels in (self.event_states or {}).items()},
+        }
+
+    def apply_capabilities(self, capabilities):
+        """Set the device up from capabilities instead of asking it."""
+        self.name = capabilities['name']
+        self.cam_id = capabilities['cam_id']
+        self.device_type = capabilities['device_type']
+        now = datetime.datetime.now()
+        self.event_states = {sensor: [[False, channel, 0, now] for channel in channels]
+                             for sensor, channels in capabilities['triggers'].items()}
+        self.update_access(capabilities)
+
+    def update_access(self, capabilities):
+        """Take over the authentication and namespaces of capabilities."""
+        if capabilities['digest']:
+            self.hik_request.auth = HTTPDigestAuth(self.usr, self.pwd)
+        else:
+            self.hik_request.auth = (self.usr, self.pwd)
+        self._httpx_auth = None
+        self.namespace.update(capabilities['namespace'])
+
+    @property
+    def is_async(self):
+        """Return True when the event stream runs on the event loop."""
+        return self._loop is not None
+
+    @property
+    def subscriptions(self):
+        """Return the number of registered event callbacks."""
+        return len(self._callbacks)
+
+    @property
+    def httpx_auth(self):
+        """Return the httpx equivalent of the negotiated requests auth.
+
+        The instance is kept, httpx.DigestAuth remembers the last challenge
+        so later requests authenticate without a 401 round-trip.
+        """
+        if self._httpx_auth is None:
+            if isinstance(self.hik_request.auth, HTTPDigestAuth):
+                self._httpx_auth = httpx.DigestAuth(self.usr, self.pwd)
+            else:
+                self._httpx_auth = httpx.BasicAuth(self.usr, self.pwd)
+        return self._httpx_auth
 
     def alert_stream(self, reset_event, kill_event):
         """Open event stream."""
         _LOGGING.debug('Stream Thread Started: %s, %s', self.name, self.cam_id)
-        start_event = False
-        parse_string = ""
-        fail_count = 0
 
         url = '%s/ISAPI/Event/notification/alertStream' % self.root_url
 
         # pylint: disable=too-many-nested-blocks
         while True:
-            next_content = False
-            raw = io.BytesIO()
-
+            if kill_event.is_set():
+                # Asked to stop while waiting to reconnect
+                _LOGGING.debug('Stopping event stream thread for %s', self.name)
+                return
+            self.backoff.attempt()
             try:
                 stream = self.hik_request.get(url, stream=True,
                                               timeout=(CONNECT_TIMEOUT,
@@ -88,75 +245,24 @@ class HikCamera(pyhik.hikvision.HikCamera):
                     raise ValueError('Connection unsucessful.')
                 else:
                     _LOGGING.debug('%s Connection Successful.', self.name)
-                    fail_count = 0
+                    self._stream_connected()
                     self.watchdog.start()
 
-                for line in stream.iter_lines(chunk_size=1):
-                    # _LOGGING.debug('Processing line from %s', self.name)
-                    # filter out keep-alive new lines
-                    if line:
-                        str_line = line.decode("utf-8", "ignore")
-
-                        if 'image/jpeg' in str_line:
-                            next_content = True
-                            continue
-
-                        if next_content:
-                            try:
-                                content_length = int(line.decode().split(' ')[1])
-                            except Exception as e:
-                                _LOGGING.error(f'Can not parse content length {e}')
-
-                            next_content = False
-                            time_stamp = self._sensor_last_tripped_time()
-                            try:
-                                box = self.current_attr[5]
-                            except Exception:
-                                box = False
-                            path = self.current_attr[7] #self._sensor_image_path(self.name, box, time_stamp, self.current_attr[6], self.current_attr[4])
-                            with open(path, 'wb') as f:
-                                chunk = stream.raw.read(content_length+3)  # remove \n\r\n
-                                fixed_chunk = chunk.removeprefix(b'\n\r\n')  # remove \n\r\n
-                                f.write(fixed_chunk)
-                            raw = io.BytesIO(fixed_chunk)
-                            with Image.open(raw) as img:
-                                box = self.current_attr[5]
-                                if box:
-                                    width, height = img.size
-                                    left = width * box[0] #*100/100
-                                    top = height * box [1]
-                                    right = width * (box[0] + box [2])
-                                    bottom = height * (box[1] + box[3])
-                                    object = (left, top, right, bottom)
-                                    try:
-                                        img_crop = img.crop(object)
-                                        img_crop.save(f'{path.removesuffix("jpg")}crop.jpg')
-
-                                    except Exception as ee:
-                                        _LOGGING.info(f'_get_image EXCEPTION 0 {ee}')
-                                else:
-                                    pass
-                            continue
-                        # New events start with --boundry
-                        if str_line.find('<EventNotificationAlert') != -1:
-                            # Start of event message
-                            start_event = True
-                            parse_string = str_line
-                        elif str_line.find('</EventNotificationAlert>') != -1:
-                            # Message end found found
-                            parse_string += str_line
-                            start_event = False
-                            if parse_string:
-                                try:
-                                    tree = ET.fromstring(parse_string)
-                                    self.process_stream(tree)
-                                    self.update_stale()
-                                except ET.ParseError as err:
-                                    _LOGGING.warning('XML parse error in stream.')
-                                parse_string = ""
-                        else:
-                            if start_event:
-                                parse_string += str_line
+                parser = MultipartParser(
+                    self._handle_part,
+                    parse_boundary(stream.headers.get('Content-Type', '')),
+                    self._open_part)
+                metrics = self.metrics
+                chunks = iter_raw(stream)
+                while True:
+                    # Only the wait for the socket, parsing is its own stage
+                    started = time.perf_counter()
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    if metrics is not None:
+                        metrics.read(len(chunk), time.perf_counter() - started)
+                    parser.feed(chunk)
 
                     if kill_event.is_set():
                         # We were asked to stop the thread so lets do so.
@@ -175,155 +281,356 @@ class HikCamera(pyhik.hikvision.HikCamera):
                 elif reset_event.is_set():
                     # We need to reset the connection.
                     raise ValueError('Watchdog failed.')
+                raise ValueError('Stream closed by the device.')
 
-            except (ValueError,
+            except (ValueError, OSError,
+                    http.client.HTTPException,
+                    urllib3.exceptions.HTTPError,
                     requests.exceptions.ConnectionError,
                     requests.exceptions.ChunkedEncodingError) as err:
-                fail_count += 1
+                unreachable = connect_failed(err)
                 reset_event.clear()
-                _LOGGING.warning('%s Connection Failed (count=%d). Waiting %ss. Err: %s',
-                                 self.name, fail_count, (fail_count * 5) + 5, err)
-                parse_string = ""
                 self.watchdog.stop()
                 self.hik_request.close()
-                time.sleep(5)
-                self.update_stale()
-                time.sleep(fail_count * 5)
+                self._wait_reconnect(self._stream_failed(err, unreachable), kill_event)
                 continue
+            except Exception as err:  # pylint: disable=broad-except
+                # Anything else is a failed attempt too, the thread keeps running
+                _LOGGING.exception('%s Unexpected error in the event stream', self.name)
+                reset_event.clear()
+                self.watchdog.stop()
+                self.hik_request.close()
+                self._wait_reconnect(self._stream_failed(err, False), kill_event)
 
+    def _wait_reconnect(self, delay, kill_event):
+        """Wait before reconnecting, cut short once the device answers again.
 
-    def process_stream(self, tree):
-        """Process incoming event stream packets."""
-        if not self.namespace[CONTEXT_ALERT]:
-            self.fetch_namespace(tree, CONTEXT_ALERT)
+        Only a device that refused connections, or failed a probe during
+        the wait, ends it early. With the breaker open the wait also lasts
+        until the device answers.
+        """
+        deadline = time.monotonic() + delay
+        down = self.backoff.unreachable
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 and not self.backoff.is_open:
+                return
+            if kill_event.wait(min(remaining, PROBE_INTERVAL) if remaining > 0
+                               else PROBE_INTERVAL):
+                return
+            self.update_stale()
+            if not (down or self.backoff.is_open):
+                continue
+            if not self._probe():
+                down = True
+            elif down or time.monotonic() >= deadline:
+                _LOGGING.debug('%s answers a probe, reconnecting', self.name)
+                return
 
+    def _probe(self):
+        """Return True if the device accepts connections."""
         try:
-            etype = SENSOR_MAP[tree.find(
-                self.element_query('eventType', CONTEXT_ALERT)).text.lower()]
+            socket.create_connection(self._address, PROBE_TIMEOUT).close()
+        except OSError:
+            return False
+        return True
+
+    async def async_alert_stream(self, client):
+        """Open event stream on the running event loop.
+
+        Runs until cancelled, ``client`` is an httpx.AsyncClient owned by
+        the caller.
+        """
+        _LOGGING.debug('Stream Task Started: %s, %s', self.name, self.cam_id)
+        self._loop = asyncio.get_running_loop()
+        self.watchdog = AsyncWatchdog(self.watchdog.time, self.watchdog_handler)
+        auth = self.httpx_auth
 
-            # Since this pasing is different and not really usefull for now, just return without error.
-            if len(etype) > 0 and etype == 'Ongoing Events':
-                return
+        url = '%s/ISAPI/Event/notification/alertStream' % self.root_url
+        alt_url = '%s/Event/notification/alertStream' % self.root_url
 
-            estate = tree.find(
-                self.element_query('eventState', CONTEXT_ALERT)).text
+        try:
+            while True:
+                self.backoff.attempt()
+                try:
+                    async with client.stream('GET', url, auth=auth) as stream:
+                        if stream.status_code == httpx.codes.NOT_FOUND and url != alt_url:
+                            # Try alternate URL for stream
+                            url = alt_url
+                            continue
 
-            for idtype in ID_TYPES:
-                echid = tree.find(self.element_query(idtype, CONTEXT_ALERT))
-                if echid is not None:
-                    try:
-                        # Need to make sure this is actually a number
-                        echid = int(echid.text)
-                        break
-                    except (ValueError, TypeError) as err:
-                        # Field must not be an integer or is blank
-                        pass
+                        if stream.status_code != httpx.codes.OK:
+                            raise ValueError('Connection unsucessful.')
+                        _LOGGING.debug('%s Connection Successful.', self.name)
+                        self._stream_connected()
+                        self.reset_thrd.clear()
+                        self.watchdog.start()
+
+                        parser = MultipartParser(
+                            self._handle_part,
+                            parse_boundary(stream.headers.get('Content-Type', '')),
+                            self._open_part)
+                        metrics = self.metrics
+                        chunks = stream.aiter_raw()
+                        while True:
+                            # Only the wait for the socket, parsing is its own stage
+                            started = time.perf_counter()
+                            try:
+                                chunk = await chunks.__anext__()
+                            except StopAsyncIteration:
+                                break
+                            if metrics is not None:
+                                metrics.read(len(chunk), time.perf_counter() - started)
+                            parser.feed(chunk)
+                            if self.reset_thrd.is_set():
+                                # We need to reset the connection.
+                                raise ValueError('Watchdog failed.')
+                        raise ValueError('Stream closed by the device.')
+
+                except (ValueError, httpx.HTTPError) as err:
+                    unreachable = connect_failed(err)
+                    self.watchdog.stop()
+                    await self._async_wait_reconnect(self._stream_failed(err, unreachable))
+                except Exception as err:  # pylint: disable=broad-except
+                    # Anything else is a failed attempt too, only cancelling ends the task
+                    _LOGGING.exception('%s Unexpected error in the event stream', self.name)
+                    self.watchdog.stop()
+                    await self._async_wait_reconnect(self._stream_failed(err, False))
+        finally:
+            _LOGGING.debug('Stopping event stream task for %s', self.name)
+            self.watchdog.stop()
+            if self._stale_timer is not None:
+                self._stale_timer.cancel()
+                self._stale_timer = None
+
+    async def _async_wait_reconnect(self, delay):
+        """Wait before reconnecting, cut short once the device answers again.
+
+        Only a device that refused connections, or failed a probe during
+        the wait, ends it early. With the breaker open the wait also lasts
+        until the device answers.
+        """
+        deadline = time.monotonic() + delay
+        down = self.backoff.unreachable
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 and not self.backoff.is_open:
+                return
+            await asyncio.sleep(min(remaining, PROBE_INTERVAL) if remaining > 0
+                                else PROBE_INTERVAL)
+            self.update_stale()
+            if not (down or self.backoff.is_open):
+                continue
+            if not await self._async_probe():
+                down = True
+            elif down or time.monotonic() >= deadline:
+                _LOGGING.debug('%s answers a probe, reconnecting', self.name)
+                return
 
-            ecount = tree.find(
-                self.element_query('activePostCount', CONTEXT_ALERT)).text
+    async def _async_probe(self):
+        """Return True if the device accepts connections."""
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(*self._address), PROBE_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        return True
+
+    @property
+    def _address(self):
+        """Return the host and port of the device."""
+        url = urllib.parse.urlsplit(self.root_url)
+        return url.hostname, url.port or (443 if url.scheme == 'https' else 80)
+
+    def _stream_connected(self):
+        """Record a successful stream connection."""
+        if self.backoff.connected():
+            _LOGGING.info('%s Reconnected.', self.name)
+
+    def _stream_failed(self, err, unreachable):
+        """Record a failed stream connection, returns the seconds to wait."""
+        delay = self.backoff.failed(err, unreachable)
+        if not self.backoff.is_open:
+            _LOGGING.warning('%s Connection Failed (count=%d). Waiting %.1fs. Err: %s',
+                             self.name, self.backoff.failures, delay, err)
+        elif self.backoff.failures == self.backoff.threshold:
+            _LOGGING.warning('%s Connection Failed %d times, retrying at most every %.0fs '
+                             'once it answers. Err: %s',
+                             self.name, self.backoff.failures, self.backoff.max_delay, err)
+        else:
+            _LOGGING.debug('%s Connection Failed (count=%d). Waiting %.1fs. Err: %s',
+                           self.name, self.backoff.failures, delay, err)
+        return delay
+
+    def _open_part(self, content_type, length):
+        """Return the streaming sink for large XML parts of the alert stream."""
+        if 'xml' in content_type and (length is None or length > MAX_BUFFERED_XML):
+            return self._alert_parser.open(content_type, length)
+        return None
+
+    def _handle_part(self, content_type, body):
+        """Handle one buffered multipart part, an error only loses the part."""
+        try:
+            self._read_part(content_type, body)
+        except Exception:  # pylint: disable=broad-except
+            _LOGGING.exception('%s Unable to handle a %s part', self.name, content_type)
+
+    def _read_part(self, content_type, body):
+        """Handle one buffered multipart part of the alert stream."""
+        if content_type.startswith('image/jpeg'):
+            event = self.current_event
+            if event is None:
+                _LOGGING.debug('%s Image received before any event', self.name)
+                return
+            self._submit_image(body, event.path, event.box)
+            if self.event_index is not None:
+                self.event_index.snapshot(event.time.timestamp(), event.path)
+        elif 'xml' in content_type:
+            started = time.perf_counter()
             try:
-                region_id = tree.find(f"{self.element_query('DetectionRegionList', CONTEXT_ALERT)}"
-                                      f"/{self.element_query('DetectionRegionEntry', CONTEXT_ALERT)}"
-                                      f"/{self.element_query('regionID', CONTEXT_ALERT)}").text
-                #box_tree = tree.find(f"{self.element_query('DetectionRegionList', CONTEXT_ALERT)}"
-                #                     f"/{self.element_query('DetectionRegionEntry', CONTEXT_ALERT)}"
-                #                     f"/{self.element_query('RegionCoordinatesList', CONTEXT_ALERT)}")
-
-
-                detectionTarget = tree.find(f"{self.element_query('DetectionRegionList', CONTEXT_ALERT)}"
-                                            f"/{self.element_query('DetectionRegionEntry', CONTEXT_ALERT)}"
-                                            f"/{self.element_query('detectionTarget', CONTEXT_ALERT)}").text
-
-                box_tree = tree.find(f"{self.element_query('DetectionRegionList', CONTEXT_ALERT)}"
-                                                   f"/{self.element_query('DetectionRegionEntry', CONTEXT_ALERT)}"
-                                                   f"/{self.element_query('TargetRect', CONTEXT_ALERT)}")
-
-                box = [float(q.text) for q in box_tree.iter() if not q]
-            except:
-                region_id = ''
-                box = []
-                detectionTarget = 'others'
-        except (AttributeError, KeyError, IndexError) as err:
+                event = self._decode(ET.fromstring(body))
+            except ET.ParseError:
+                _LOGGING.warning('XML parse error in stream.')
+                if self.metrics is not None:
+                    self.metrics.parse_errors += 1
+                return
+            if self.metrics is not None:
+                self.metrics.observe(STAGE_PARSE, time.perf_counter() - started)
+            if event is not None:
+                self.process_event(event)
+            self.update_stale()
+
+    def _observe_parse(self, seconds):
+        """Record the parse time of a streamed alert."""
+        if self.metrics is not None:
+            self.metrics.observe(STAGE_PARSE, seconds)
+
+    def _process_alert(self, event):
+        """Handle an alert decoded from the stream."""
+        if not self.namespace[CONTEXT_ALERT]:
+            self.namespace[CONTEXT_ALERT] = self._alert_parser.namespace
+        try:
+            self.process_event(event)
+        except Exception:  # pylint: disable=broad-except
+            _LOGGING.exception('%s Unable to process %s', self.name, event)
+        self.update_stale()
+
+    def _submit_image(self, data, path, box):
+        """Save an image without blocking the stream reader."""
+        if self.image_pool is not None:
+            self.image_pool.submit(bytes(data), path, box, self.metrics)
+        elif self._loop is not None:
+            future = self._loop.run_in_executor(None, self._save_image, bytes(data), path, box)
+            future.add_done_callback(self._image_done)
+        else:
+            self._save_image(data, path, box)
+
+    def _save_image(self, data, path, box):
+        started = time.perf_counter()
+        save_image(data, path, box)
+        if self.metrics is not None:
+            self.metrics.observe(STAGE_IMAGE, time.perf_counter() - started)
+
+    def _image_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            _LOGGING.error('%s Unable to save image: %s', self.name, future.exception())
+
+    def process_stream(self, tree):
+        """Process incoming event stream packets."""
+        event = self._decode(tree)
+        if event is not None:
+            self.process_event(event)
+
+    def _decode(self, tree):
+        """Return the AlertEvent of a parsed alert or None."""
+        try:
+            event = self._decoder.decode(tree)
+        except (AttributeError, KeyError, ValueError) as err:
+            _LOGGING.error('Problem finding attribute: %s', err)
+            if self.metrics is not None:
+                self.metrics.parse_errors += 1
+            return None
+        if not self.namespace[CONTEXT_ALERT]:
+            self.namespace[CONTEXT_ALERT] = self._decoder.namespace
+        return event
+
+    def process_event(self, event):
+        """Update states and publish changes for a decoded alert."""
+        if self.metrics is not None:
+            self.metrics.alerts += 1
+        try:
+            etype = SENSOR_MAP[event.event_type]
+        except KeyError as err:
             _LOGGING.error('Problem finding attribute: %s', err)
             return
 
+        # Since this pasing is different and not really usefull for now, just return without error.
+        if etype == 'Ongoing Events':
+            return
+
+        estate = event.active
+        echid = event.channel
+        region_id = event.region_id
+        box = event.box
+
         # Take care of keep-alive
         if len(etype) > 0 and etype == 'Video Loss':
             self.watchdog.pet()
 
         # Track state if it's in the event list.
-        if len(etype) > 0:
+        if len(etype) > 0 and echid is not None:
             state = self.fetch_attributes(etype, echid)
             if state:
-                # Determine if state has changed
-                # If so, publish, otherwise do nothing
-                estate = (estate == 'active')
-                old_state = state[0]
                 eventTime = datetime.datetime.now()
                 path = self._sensor_image_path(self.name, box, eventTime.timestamp(), etype, region_id)
-                attr = [estate, echid, int(ecount),
-                        eventTime,
-                        region_id, box, detectionTarget, path]
-                self.current_attr = attr
-                #self.update_attributes(etype, echid, attr)
+                attr = EventRecord(estate, echid, event.count, eventTime,
+                                   region_id, box, event.target, path)
+                self.current_event = attr
+                if self.event_index is not None:
+                    self.event_index.record(echid, etype, region_id, estate,
+                                            eventTime.timestamp(), event.target, box)
                 if estate:
                     self.curent_event_region.update({etype: region_id})
-                if True:  # estate != old_state:
-                    if not region_id:
-                        region_id = self.curent_event_region.get(etype, '')
-
-                    if etype in REGION_SENSORS and not estate:
-                        for r in REGION_IDS:
-                            self.publish_changes(etype, echid, str(r), estate, attr)
-                    else:
-                        self.publish_changes(etype, echid, region_id, estate, attr)
+                    self._expiry.schedule(
+                        (etype, echid),
+                        time.monotonic() + self.stale_after.get(etype, DEFAULT_STALE_AFTER))
+                else:
+                    self._expiry.cancel((etype, echid))
+                # Repeated states are coalesced in publish_changes
+                self._publish_event(etype, echid, region_id, estate, attr)
                 self.watchdog.pet()
 
+    def _publish_event(self, etype, echid, region_id, estate, attr):
+        """Publish a state to the entities of an event type and channel."""
+        if not region_id:
+            region_id = self.curent_event_region.get(etype, '')
+
+        if etype in REGION_SENSORS and not estate:
+            for r in REGION_IDS:
+                self.publish_changes(etype, echid, str(r), estate, attr)
+        else:
+            self.publish_changes(etype, echid, region_id, estate, attr)
+
     def _sensor_last_tripped_time(self):
         """Extract sensor last update time."""
-        try:
-            attr = self.current_attr  #self._cam.get_attributes(self._sensor, self._channel)
-            time_stamp = attr[3].timestamp()
-        except Exception as e:
-            _LOGGING.warning(f'_sensor_last_tripped_time Except {e}')
+        if self.current_event is None:
             return time.time()
-        return time_stamp
+        return self.current_event.time.timestamp()
 
     def _sensor_image_path(self, name, box, time_stamp, etype, region):
         #if not self.is_on:
         #    return ''
+        if self.storage is not None:
+            directory = self.storage.directory(name, time_stamp)
+        else:
+            directory = LEGACY_ROOT
         if box:
-            filename = f'/config/www/hikvision/image_{name}_{time_stamp}_{etype}_{region}_{box[0]}_{box[1]}_{box[2]}_{box[3]}.jpg'
+            filename = f'{directory}/image_{name}_{time_stamp}_{etype}_{region}_{box[0]}_{box[1]}_{box[2]}_{box[3]}.jpg'
         else:
-            filename = f'/config/www/hikvision/image_{name}_{time_stamp}_{etype}_{region}_full.jpg'
+            filename = f'{directory}/image_{name}_{time_stamp}_{etype}_{region}_full.jpg'
         return filename
 
-    def get_image(self, box, path):
-        t = threading.Thread(target=self._get_image, args=(box, path,), name='GetImage')
-        t.start()
-
-    def _get_image(self, box, path):
-        url = '%s/ISAPI/Streaming/channels/101/picture'
-        try:
-            response = self.hik_request.get(url % self.root_url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=True)
-            raw = io.BytesIO(response.content)
-            try:
-                with Image.open(raw) as img:
-                    if box:
-                        try:
-                            img_crop = img.crop(box)
-                            img_crop.save(path)
-                            img.save(f'{path}.orig.jpg')
-                        except Exception as ee:
-                            _LOGGING.info(f'_get_image EXCEPTION 0 {ee}')
-                    else:
-                        img.save(path)
-            except Exception as eee:
-                _LOGGING.info(f'_get_image EXCEPTION eee {eee}')
-
-        except Exception as e:
-            _LOGGING.info(f'_get_image EXCEPTION {e}')
-
     def update_attributes(self, event, channel, attr):
         """Update attribute list for current event/channel."""
         try:
@@ -335,34 +642,85 @@ class HikCamera(pyhik.hikvision.HikCamera):
                            event, channel)
 
     def update_stale(self):
-        """Update stale active statuses"""
+        """Update stale active statuses and publish held back updates."""
         # Some events don't post an inactive XML, only active.
-        # If we don't get an active update for 5 seconds we can
-        # assume the event is no longer active and update accordingly.
-        for etype, echannels in self.event_states.items():
-            for eprop in echannels:
-                if eprop[3] is not None:
-                    sec_elap = ((datetime.datetime.now()-eprop[3])
-                                .total_seconds())
-                    # print('Seconds since last update: {}'.format(sec_elap))
-                    if sec_elap > 5 and eprop[0] is True:
-                        _LOGGING.debug('Updating stale event %s on CH(%s)',
-                                       etype, eprop[1])
-                        attr = [False, eprop[1], eprop[2],
-                                datetime.datetime.now()]
-                        self.update_attributes(etype, eprop[1], attr)
-                        self.publish_changes(etype, eprop[1], estate=False, attr=attr)
+        # If we don't get an active update within the stale time of the
+        # event type we can assume the event is no longer active and
+        # update accordingly.
+        now = time.monotonic()
+        for etype, echid in self._expiry.pop_due(now):
+            _LOGGING.debug('Updating stale event %s on CH(%s)', etype, echid)
+            attr = EventRecord(False, echid, 0, datetime.datetime.now())
+            self._publish_event(etype, echid, '', False, attr)
+        for key, (region, estate, attr) in self.coalescer.pop_due(now):
+            self._publish(key, region, estate, attr)
+
+        if self._loop is not None:
+            # Expire on time even when the camera goes quiet
+            if self._stale_timer is not None:
+                self._stale_timer.cancel()
+                self._stale_timer = None
+            deadlines = [d for d in (self._expiry.next_deadline(),
+                                     self.coalescer.next_deadline()) if d is not None]
+            if deadlines:
+                deadline = min(deadlines)
+                self._stale_timer = self._loop.call_later(
+                    deadline - time.monotonic(), self.update_stale)
 
     def publish_changes(self, etype, echid, region='', estate=None, attr=None):
         """Post updates for specified event type."""
-        _LOGGING.warning('%s Update: %s, %s',
-                         self.name, etype, self.fetch_attributes(etype, echid))
+        if self.on_event_end is not None:
+            self._track_trip(etype, echid, estate, attr)
+        key = CallbackIndex.key(etype, echid, region)
+        if self.coalescer.offer(key, estate, (region, estate, attr), time.monotonic()):
+            self._publish(key, region, estate, attr)
+
+    def _publish(self, key, region, estate, attr):
+        """Post an update that passed the coalescer."""
+        etype, echid, _ = key
+        if _LOGGING.isEnabledFor(logging.DEBUG):
+            _LOGGING.debug('%s Update: %s, %s',
+                           self.name, etype, self.fetch_attributes(etype, echid))
         signal = 'ValueChanged.{}'.format(self.cam_id)
         sender = '{}.{}'.format(etype, echid)
         if dispatcher:
             dispatcher.send(signal=signal, sender=sender)
 
-        self._do_update_callback(f'{self.cam_id}.{etype}.{echid}{region}', region, estate, attr)
+        self._do_event_callback(key, region, estate, attr)
+
+    def _track_trip(self, etype, echid, estate, attr):
+        """Call on_event_end on the active to inactive transition of an event."""
+        key = (etype, echid)
+        if estate:
+            self._tripped.add(key)
+        elif key in self._tripped:
+            self._tripped.discard(key)
+            self.on_event_end(etype, echid, attr)
+
+    def add_event_callback(self, callback, etype, channel, region=''):
+        """Register callback for an event type, channel and region.
+
+        Returns a function removing the callback again.
+        """
+        return self._callbacks.add(CallbackIndex.key(etype, channel, region), callback)
+
+    def _do_event_callback(self, key, region='', estate=None, attr=None):
+        """Call callbacks registered for an event type, channel and region."""
+        callbacks = self._callbacks.get(key)
+        if not callbacks and not self._updateCallbacks:
+            return
+        started = time.perf_counter()
+        etype, echid, region_key = key
+        msg = f'{self.cam_id}.{etype}.{echid}{region_key}'
+        for callback in callbacks:
+            _LOGGING.debug('Update callback %s for sensor %s', callback, key)
+            callback(msg, region, estate, attr)
+        if self._updateCallbacks:
+            # Legacy subscribers registered with add_update_callback
+            self._do_update_callback(msg, region, estate, attr)
+        if self.metrics is not None:
+            self.metrics.callbacks += len(callbacks)
+            self.metrics.observe(STAGE_DISPATCH, time.perf_counter() - started)
 
     def _do_update_callback(self, msg, region='', estate=None, attr=None):
         """Call registered callback functions."""